@@ -26,6 +26,7 @@
 import os
 
 import pwem
+import pyworkflow as pw
 import pyworkflow.utils as pwutils
 
 from .constants import *
@@ -44,6 +45,18 @@ class Plugin(pwem.Plugin):
     def _defineVariables(cls):
         cls._defineVar(ISONET_CUDA_LIB, pwem.Config.CUDA_LIB)
         cls._defineEmVar(ISONET_HOME, 'isonet-' + ISONET_VERSION)
+        cls._defineVar(ISONET_CACHE_DIR,
+                       os.path.join(pw.Config.SCIPION_USER_DATA, 'isonetCache'))
+        cls._defineVar(ISONET_CACHE_SIZE, '200')
+        cls._defineVar(ISONET_WORKER, 'False')
+
+    @classmethod
+    def getCache(cls):
+        """ Return the cache shared by all the runs to reuse the
+        deconvolved tomograms and masks. """
+        from .cache import PreprocessCache
+        maxSize = float(cls.getVar(ISONET_CACHE_SIZE)) * 1024 ** 3
+        return PreprocessCache(cls.getVar(ISONET_CACHE_DIR), maxSize)
 
     @classmethod
     def getEnviron(cls):
@@ -73,14 +86,90 @@ class Plugin(pwem.Plugin):
         return neededProgs
 
     @classmethod
-    def runIsoNet(cls, protocol, program, args, cwd=None, useCpu=False):
+    def getActivatedEnviron(cls):
+        """ Return the (environ, python) of the activated IsoNet env. The
+        env is activated only once and the variables it sets are cached (see
+        ActivationCache). Return None if it cannot be resolved. """
+        from .cache import ActivationCache
+        activationCmd = '%s %s' % (cls.getCondaActivationCmd(),
+                                   cls.getIsoNetActivationCmd())
+        cache = ActivationCache(cls.getVar(ISONET_CACHE_DIR))
+        environ = cls.getEnviron()
+        activated = cache.get(getIsoNetEnvName(ISONET_VERSION), activationCmd,
+                              environ)
+        if activated is None:
+            return None
+        variables, python = activated
+        environ.update(variables)
+        return environ, python
+
+    @classmethod
+    def useWorker(cls):
+        """ Whether IsoNet commands are run by a persistent worker (see
+        isonet/worker.py) instead of a new process every time """
+        return str(cls.getVar(ISONET_WORKER)).lower() in ['true', '1', 'yes']
+
+    @classmethod
+    def runIsoNet(cls, protocol, program, args, cwd=None):
         """ Run IsonNet command from a given protocol. """
-        fullProgram = '%s %s && %s' % (cls.getCondaActivationCmd(),
-                                       cls.getIsoNetActivationCmd(),
-                                       program)
+        activated = cls.getActivatedEnviron()
+        if activated is not None and cls.useWorker():
+            # Run the command in the warm worker of this node
+            from .worker import getSocketPath, getWorkerArgs
+            environ, python = activated
+            socketPath = getSocketPath(getIsoNetEnvName(ISONET_VERSION))
+            cls._runJob(protocol, python,
+                        getWorkerArgs(socketPath, program, args),
+                        env=environ, cwd=cwd)
+            return
+
+        if activated is not None:
+            # Call the env python straight, without activating it
+            environ, python = activated
+            cls._runJob(protocol, '%s %s' % (python, program), args,
+                        env=environ, cwd=cwd)
+            return
+
+        # The programs (isonet.py or the engines) are python scripts, run
+        # with the env python as above
+        fullProgram = '%s %s && python %s' % (cls.getCondaActivationCmd(),
+                                              cls.getIsoNetActivationCmd(),
+                                              program)
+
+        cls._runJob(protocol, fullProgram, args, env=cls.getEnviron(), cwd=cwd)
 
-        protocol.runJob(fullProgram, args, env=cls.getEnviron(), cwd=cwd,
-                        numberOfMpi=1)
+    @classmethod
+    def runEngine(cls, protocol, engine, args, cwd=None):
+        """ Run one of the native engines (isonet.engines) from a given
+        protocol. They do not need the IsoNet environment. """
+        cls._runJob(protocol, pw.PYTHON,
+                    '-m isonet.engines.%s %s' % (engine, args), cwd=cwd)
+
+    @classmethod
+    def getEngineProgram(cls, engine):
+        """ Path of a native engine to be run as a script by runIsoNet, for
+        the engines that need the IsoNet environment """
+        return os.path.join(os.path.dirname(__file__), 'engines',
+                            engine + '.py')
+
+    @classmethod
+    def _runJob(cls, protocol, program, args, env=None, cwd=None):
+        """ Run a job from a protocol step. If the step is monitored, the
+        job is launched through the monitor to record the resources it
+        uses. """
+        from .monitor import StepMonitor, getMonitorArgs
+        monitor = StepMonitor.current()
+        if monitor is None:
+            protocol.runJob(program, args, env=env, cwd=cwd, numberOfMpi=1)
+            return
+
+        jobStatsFile = monitor.newJobStatsFile()
+        try:
+            protocol.runJob(pw.PYTHON,
+                            getMonitorArgs(jobStatsFile, program, args),
+                            env=env, cwd=cwd, numberOfMpi=1)
+        finally:
+            monitor.addJobStats(jobStatsFile)
 
     @classmethod
     def getProgram(cls, program):
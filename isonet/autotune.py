@@ -0,0 +1,143 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Batch size and steps per epoch of refine and predict chosen from the memory
+the IsoNet UNet needs for the cube size and network params, instead of a
+fixed default. The estimation follows the network IsoNet builds: at every
+depth convs_per_depth convolutions (plus batch normalization and
+activation), a strided convolution (or pooling) to go down and a transposed
+one plus the skip connection to go up.
+"""
+import math
+
+BYTES_PER_VALUE = 4  # float32
+# Training keeps the gradient of every feature map, plus the weights, their
+# gradients and the two Adam moments
+TRAINING_MAP_FACTOR = 2
+TRAINING_PARAM_FACTOR = 4
+# Memory kept by the framework and the cudnn workspaces
+RESERVED_FRACTION = 0.2
+MAX_BATCH = 64
+# IsoNet refine: min(subtomograms * 6 / batch_size, 200)
+SAMPLES_PER_SUBTOMO = 6
+MAX_STEPS_PER_EPOCH = 200
+
+DEFAULT_NETWORK = {'unet_depth': 3,
+                   'filter_base': 64,
+                   'convs_per_depth': 3,
+                   'kernel': '3,3,3',
+                   'batch_normalization': True,
+                   'pool': False}
+
+
+def _networkParams(networkParams):
+    params = dict(DEFAULT_NETWORK)
+    params.update({k: v for k, v in (networkParams or {}).items()
+                   if v is not None})
+    return params
+
+
+def getFeatureMaps(size, networkParams=None):
+    """ Return the (voxels, channels) of the feature maps of the UNet for a
+    cube of the given size and a list of the skip connections """
+    params = _networkParams(networkParams)
+    perConv = 3 if params['batch_normalization'] else 2
+    maps, skips = [], []
+    for depth in range(params['unet_depth'] + 1):
+        voxels = max(1, size // 2 ** depth) ** 3
+        channels = params['filter_base'] * 2 ** depth
+        maps.extend([(voxels, channels)] * perConv * params['convs_per_depth'])
+        if depth < params['unet_depth']:
+            skips.append((voxels, channels))
+            # Down (strided convolution or pooling)
+            maps.append((max(1, size // 2 ** (depth + 1)) ** 3, channels))
+    for voxels, channels in reversed(skips):
+        # Up, concatenated with the skip connection
+        maps.append((voxels, channels))
+        maps.append((voxels, 2 * channels))
+        maps.extend([(voxels, channels)] * perConv * params['convs_per_depth'])
+    maps.append((size ** 3, 1))
+    return maps, skips
+
+
+def getNumberOfWeights(networkParams=None):
+    """ Approximated number of weights of the UNet """
+    params = _networkParams(networkParams)
+    kernel = 1
+    for k in str(params['kernel']).split(','):
+        kernel *= int(k)
+    weights = 0
+    inChannels = 1
+    for depth in range(params['unet_depth'] + 1):
+        channels = params['filter_base'] * 2 ** depth
+        for _ in range(params['convs_per_depth']):
+            weights += kernel * inChannels * channels
+            inChannels = channels
+        if depth < params['unet_depth']:
+            weights += kernel * channels * channels  # Down
+    for depth in reversed(range(params['unet_depth'])):
+        channels = params['filter_base'] * 2 ** depth
+        weights += kernel * inChannels * channels  # Up
+        inChannels = 2 * channels
+        for _ in range(params['convs_per_depth']):
+            weights += kernel * inChannels * channels
+            inChannels = channels
+    return weights + inChannels
+
+
+def estimateMemory(size, networkParams=None, training=True):
+    """ Return the (bytes per sample, fixed bytes) the UNet needs for cubes
+    of the given size. Training keeps every feature map for the backward
+    pass; prediction only the skip connections and two consecutive maps. """
+    maps, skips = getFeatureMaps(size, networkParams)
+    weights = getNumberOfWeights(networkParams) * BYTES_PER_VALUE
+    if training:
+        sample = sum(v * c for v, c in maps) * TRAINING_MAP_FACTOR
+        fixed = weights * TRAINING_PARAM_FACTOR
+    else:
+        biggest = sorted(v * c for v, c in maps)[-2:]
+        sample = sum(v * c for v, c in skips) + sum(biggest)
+        fixed = weights
+    return sample * BYTES_PER_VALUE, fixed
+
+
+def getBatchSize(memory, size, networkParams=None, training=True,
+                 devices=1):
+    """ Return the largest batch that fits in the memory (bytes) of every
+    device, a multiple of the number of devices (IsoNet splits the batches
+    among the GPUs). It is at least one sample per device. """
+    sample, fixed = estimateMemory(size, networkParams, training)
+    available = memory * (1 - RESERVED_FRACTION) - fixed
+    perDevice = int(available // sample) if available > 0 else 0
+    perDevice = max(1, min(perDevice, MAX_BATCH // devices or 1))
+    return perDevice * devices
+
+
+def getStepsPerEpoch(numberOfSubtomos, batchSize):
+    """ Steps per epoch of refine for the given number of subtomograms """
+    steps = int(numberOfSubtomos * SAMPLES_PER_SUBTOMO / batchSize)
+    return max(1, min(steps, MAX_STEPS_PER_EPOCH))
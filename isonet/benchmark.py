@@ -0,0 +1,395 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Benchmark of the plugin side of the workflow on synthetic tomograms, so it
+runs on any CPU-only machine without IsoNet, a dataset or a GPU. The IsoNet
+programs are replaced by the native engines and every stage (staging, star
+files, defocus, deconvolution, mask, extraction and output set) is timed
+separately. The best time of several repeats is kept. The defocus and
+output stages run the methods of the protocol on sets stored in sqlite, as
+they are in a project.
+
+The results are compared with a JSON baseline and the run fails if a stage
+is slower than the baseline beyond a threshold:
+
+    python -m isonet.benchmark --size 128,512,512 --tomograms 4 \\
+        --baseline isonet_benchmark.json
+
+The baseline is written if it does not exist (or with --update).
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import mrcfile
+import numpy as np
+
+from .constants import DEFOCUS_NEAREST_ZERO, DEFOCUS_DOSE_WEIGHTED
+from .convert import writeTomoStarFile, splitTomoStarFile, mergeStarFiles
+from .engines import deconv, mask, extract
+from .staging import stageFile
+from .star import StarTable
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZE = (64, 256, 256)
+DEFAULT_TOMOGRAMS = 4
+DEFAULT_REPEATS = 3
+# A stage is a regression if it is this fraction slower than the baseline...
+DEFAULT_THRESHOLD = 0.25
+# ...and at least these seconds, so the noise of the fast stages is ignored
+MIN_DIFFERENCE = 0.05
+
+PIXEL_SIZE = 10.0
+DEFOCUS = 3.0  # um
+TILTS = 61
+DOSE_PER_TILT = 3.0  # e/A^2
+NUMBER_SUBTOMOS = 20
+CUBE_SIZE = 16
+CROP_SIZE = 24
+SLAB_SIZE = 32
+# Default chunk_size of IsoNet deconv
+DECONV_CHUNK_SIZE = 200
+
+
+def writeSyntheticTomogram(fileName, shape, seed=0, particles=50):
+    """ Write a float32 MRC tomogram with gaussian noise and random
+    spherical particles, slab by slab so big tomograms fit in memory """
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(0, 1, (particles, 3)) * shape
+    radii = rng.uniform(2, max(3, min(shape) / 8), particles)
+    y, x = np.ogrid[:shape[1], :shape[2]]
+    with mrcfile.new_mmap(fileName, shape=shape, mrc_mode=2,
+                          overwrite=True) as mrc:
+        for z0 in range(0, shape[0], SLAB_SIZE):
+            z1 = min(z0 + SLAB_SIZE, shape[0])
+            slab = rng.normal(0, 1, (z1 - z0,) + tuple(shape[1:]))
+            for (cz, cy, cx), radius in zip(centers, radii):
+                if cz + radius < z0 or cz - radius >= z1:
+                    continue
+                z = np.arange(z0, z1)[:, None, None]
+                inside = ((z - cz) ** 2 + (y - cy) ** 2 + (x - cx) ** 2 <
+                          radius ** 2)
+                slab[inside] -= 2.0  # Dense particles are dark
+            mrc.data[z0:z1] = slab
+        mrc.voxel_size = PIXEL_SIZE
+
+
+class Benchmark:
+    """ Stages of the workflow run on a set of synthetic tomograms. Every
+    stage is a method <name>Stage that uses the outputs of the previous
+    ones, all of them within the working folder of a repeat. """
+    STAGES = ['staging', 'star', 'defocus', 'deconv', 'mask', 'extract',
+              'output']
+
+    def __init__(self, folder, size=DEFAULT_SIZE,
+                 numberOfTomograms=DEFAULT_TOMOGRAMS):
+        self.folder = folder
+        self.size = tuple(size)
+        self.numberOfTomograms = numberOfTomograms
+        self.inputFolder = os.path.join(folder, 'input')
+        self.tsIds = ['TS_%02d' % i for i in range(1, numberOfTomograms + 1)]
+
+    def getInputFile(self, tsId):
+        return os.path.join(self.inputFolder, tsId + '.mrc')
+
+    def _getPath(self, *paths):
+        return os.path.join(self.workFolder, *paths)
+
+    def generate(self):
+        """ Write the synthetic tomograms (once for all the repeats) """
+        os.makedirs(self.inputFolder, exist_ok=True)
+        for seed, tsId in enumerate(self.tsIds):
+            if not os.path.exists(self.getInputFile(tsId)):
+                writeSyntheticTomogram(self.getInputFile(tsId), self.size,
+                                       seed)
+
+    def writeInputSets(self):
+        """ Write the input sets of the protocol: the tomograms and the
+        tilt series with their CTF (dose symmetric acquisition from 0
+        degrees) """
+        from tomo.objects import (SetOfTomograms, Tomogram, SetOfTiltSeries,
+                                  TiltSeries, TiltImage, SetOfCTFTomoSeries,
+                                  CTFTomoSeries, CTFTomo)
+        setFiles = [os.path.join(self.inputFolder, name) for name in
+                    ['tomograms.sqlite', 'tiltseries.sqlite', 'ctfs.sqlite']]
+        for setFile in setFiles:
+            if os.path.exists(setFile):
+                os.remove(setFile)
+
+        self.tomoSet = SetOfTomograms(filename=setFiles[0])
+        self.tomoSet.setSamplingRate(PIXEL_SIZE)
+        for tsId in self.tsIds:
+            tomo = Tomogram()
+            tomo.setSamplingRate(PIXEL_SIZE)
+            tomo.setTsId(tsId)
+            tomo.setLocation(self.getInputFile(tsId))
+            tomo.setOrigin()
+            self.tomoSet.append(tomo)
+        self.tomoSet.write()
+
+        rng = np.random.default_rng(0)
+        angles = np.linspace(-60, 60, TILTS)
+        acqOrders = np.empty(TILTS, dtype=int)
+        acqOrders[np.argsort(np.abs(angles), kind='stable')] = \
+            np.arange(1, TILTS + 1)
+        tsSet = SetOfTiltSeries(filename=setFiles[1])
+        tsSet.setSamplingRate(PIXEL_SIZE)
+        self.ctfSet = SetOfCTFTomoSeries(filename=setFiles[2])
+        self.ctfSet.setSetOfTiltSeries(tsSet)
+        for tsId in self.tsIds:
+            tiltSeries = TiltSeries(tsId=tsId)
+            tsSet.append(tiltSeries)
+            for index, (angle, order) in enumerate(zip(angles, acqOrders),
+                                                   start=1):
+                tiltImage = TiltImage()
+                tiltImage.setTsId(tsId)
+                tiltImage.setIndex(index)
+                tiltImage.setTiltAngle(float(angle))
+                tiltImage.setAcquisitionOrder(int(order))
+                tiltImage.getAcquisition().setAccumDose(order * DOSE_PER_TILT)
+                tiltSeries.append(tiltImage)
+            tiltSeries.write(properties=False)
+            tsSet.update(tiltSeries)
+
+            ctfSeries = CTFTomoSeries()
+            ctfSeries.setTiltSeries(tiltSeries)
+            ctfSeries.setTsId(tsId)
+            self.ctfSet.append(ctfSeries)
+            for index, order in enumerate(acqOrders, start=1):
+                defocus = float(rng.normal(DEFOCUS * 10000, 2000))
+                ctf = CTFTomo()
+                ctf.setIndex(index)
+                ctf.setAcquisitionOrder(int(order))
+                ctf.setStandardDefocus(defocus, defocus, 0.0)
+                ctfSeries.append(ctf)
+            ctfSeries.write(properties=False)
+            self.ctfSet.update(ctfSeries)
+        tsSet.write()
+        self.ctfSet.write()
+
+    def _createProtocol(self):
+        """ Reconstruction protocol (out of any project) whose methods the
+        stages run """
+        from .protocols import ProtIsoNetTomoReconstruction
+        protocol = ProtIsoNetTomoReconstruction()
+        protocol.inputTomograms.set(self.tomoSet)
+        protocol.inputSetOfCtfTomoSeries.set(self.ctfSet)
+        protocol.predictFolder = self._getPath('predicted')
+        return protocol
+
+    def run(self, repeats=DEFAULT_REPEATS, stages=None):
+        """ Return a dict {stage: seconds} with the best time of every
+        stage in the given number of repeats """
+        stages = stages or self.STAGES
+        self.generate()
+        if {'defocus', 'output'} & set(stages):
+            self.writeInputSets()
+        times = OrderedDict((stage, []) for stage in stages)
+        for repeat in range(repeats):
+            self.workFolder = os.path.join(self.folder, 'run%02d' % repeat)
+            os.makedirs(self.workFolder)
+            try:
+                for stage in stages:
+                    start = time.perf_counter()
+                    getattr(self, stage + 'Stage')()
+                    times[stage].append(time.perf_counter() - start)
+                    logger.info("%s: %0.3f s" % (stage, times[stage][-1]))
+            finally:
+                shutil.rmtree(self.workFolder)
+        return OrderedDict((stage, min(t)) for stage, t in times.items())
+
+    def getTomoFile(self, tsId):
+        return self._getPath('tomograms', tsId + '.mrc')
+
+    def getTomoStarFile(self, tsId):
+        return self._getPath('tomograms_star', tsId + '.star')
+
+    def stagingStage(self):
+        os.makedirs(self._getPath('tomograms'))
+        for tsId in self.tsIds:
+            stageFile(self.getInputFile(tsId), self.getTomoFile(tsId))
+
+    def starStage(self):
+        """ The tomograms star file as prepare_star writes it, split in one
+        file per tomogram, merged back and updated as the steps do """
+        os.makedirs(self._getPath('tomograms_star'))
+        starFile = self._getPath('tomograms.star')
+        StarTable(rlnIndex=np.arange(1, len(self.tsIds) + 1),
+                  rlnMicrographName=[self.getTomoFile(t) for t in self.tsIds],
+                  rlnPixelSize=PIXEL_SIZE,
+                  rlnDefocus=0.0,
+                  rlnNumberSubtomo=NUMBER_SUBTOMOS,
+                  rlnMaskBoundary='None').write(starFile)
+        splitTomoStarFile(starFile, self._getPath('tomograms_star'),
+                          dict(enumerate(self.tsIds, start=1)),
+                          {tsId: DEFOCUS * 10000 for tsId in self.tsIds})
+        for index, tsId in enumerate(self.tsIds, start=1):
+            writeTomoStarFile(self.getTomoStarFile(tsId), index,
+                              self.getTomoFile(tsId), PIXEL_SIZE,
+                              DEFOCUS * 10000, NUMBER_SUBTOMOS)
+        mergeStarFiles([self.getTomoStarFile(t) for t in self.tsIds],
+                       starFile)
+
+    def defocusStage(self):
+        """ Defocus of every tilt series, with both modes, read from the
+        CTF and tilt series sets by the protocol """
+        for mode in [DEFOCUS_NEAREST_ZERO, DEFOCUS_DOSE_WEIGHTED]:
+            protocol = self._createProtocol()
+            protocol.defocusMode.set(mode)
+            protocol.getDefocusValues()
+
+    def deconvStage(self):
+        os.makedirs(self._getPath('deconv'))
+        chunkSize = min(DECONV_CHUNK_SIZE, max(self.size))
+        for tsId in self.tsIds:
+            deconv.deconvolve(self.getTomoFile(tsId),
+                              self._getPath('deconv', tsId + '.mrc'),
+                              PIXEL_SIZE, DEFOCUS, chunkSize=chunkSize)
+
+    def maskStage(self):
+        os.makedirs(self._getPath('mask'))
+        for tsId in self.tsIds:
+            mask.makeMask(self._getPath('deconv', tsId + '.mrc'),
+                          self._getPath('mask', tsId + '_mask.mrc'))
+
+    def extractStage(self):
+        os.makedirs(self._getPath('subtomos'))
+        starFiles = []
+        for seed, tsId in enumerate(self.tsIds):
+            starFiles.append(self._getPath('subtomos', tsId + '.star'))
+            extract.extractSubtomograms(
+                self._getPath('deconv', tsId + '.mrc'),
+                self._getPath('subtomos', tsId), starFiles[-1],
+                NUMBER_SUBTOMOS, CUBE_SIZE, CROP_SIZE, PIXEL_SIZE,
+                self._getPath('mask', tsId + '_mask.mrc'), seed)
+        mergeStarFiles(starFiles, self._getPath('subtomo.star'))
+
+    def outputStage(self):
+        """ Output set of the predicted tomograms (the deconvolved ones
+        stand for them), built by the protocol as createOutputStep does """
+        from tomo.objects import SetOfTomograms
+        protocol = self._createProtocol()
+        os.makedirs(protocol.predictFolder)
+        for tsId in self.tsIds:
+            stageFile(self._getPath('deconv', tsId + '.mrc'),
+                      protocol.getPredictedFile(tsId))
+        tomoSet = SetOfTomograms(filename=self._getPath('tomograms.sqlite'))
+        tomoSet.copyInfo(self.tomoSet)
+        protocol._appendOutputTomograms(tomoSet, self.tsIds)
+        tomoSet.write()
+        tomoSet.close()
+
+
+def findRegressions(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """ Return the (stage, baselineTime, time) of the stages slower than
+    the baseline by more than threshold (fraction of the baseline time) """
+    for key in ['size', 'tomograms']:
+        if results[key] != baseline[key]:
+            raise ValueError("The %s of the baseline (%s) is not the one of "
+                             "the benchmark (%s)" % (key, baseline[key],
+                                                     results[key]))
+    regressions = []
+    for stage, seconds in results['stages'].items():
+        baseTime = baseline['stages'].get(stage)
+        if baseTime is None:
+            continue
+        if (seconds > baseTime * (1 + threshold) and
+                seconds - baseTime > MIN_DIFFERENCE):
+            regressions.append((stage, baseTime, seconds))
+    return regressions
+
+
+def runBenchmark(folder, size=DEFAULT_SIZE,
+                 numberOfTomograms=DEFAULT_TOMOGRAMS,
+                 repeats=DEFAULT_REPEATS, stages=None):
+    """ Run the benchmark in folder and return the results as they are
+    written to the baseline """
+    benchmark = Benchmark(folder, size, numberOfTomograms)
+    return {'size': list(benchmark.size),
+            'tomograms': numberOfTomograms,
+            'repeats': repeats,
+            'stages': benchmark.run(repeats, stages)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', default=','.join(map(str, DEFAULT_SIZE)),
+                        help='Tomogram size as z,y,x')
+    parser.add_argument('--tomograms', type=int, default=DEFAULT_TOMOGRAMS)
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS)
+    parser.add_argument('--stages', default=None,
+                        help='Comma separated, default: %s'
+                             % ','.join(Benchmark.STAGES))
+    parser.add_argument('--baseline', default=None,
+                        help='JSON file with the times to compare with')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument('--update', action='store_true',
+                        help='Write the results to the baseline')
+    parser.add_argument('--work_dir', default=None,
+                        help='Folder for the tomograms (a temporary one by '
+                             'default)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    size = tuple(int(s) for s in args.size.split(','))
+    stages = args.stages.split(',') if args.stages else None
+    folder = args.work_dir or tempfile.mkdtemp(prefix='isonet_benchmark_')
+    try:
+        results = runBenchmark(folder, size, args.tomograms, args.repeats,
+                               stages)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(folder)
+    print(json.dumps(results, indent=2))
+
+    if args.baseline is None:
+        return 0
+    if args.update or not os.path.exists(args.baseline):
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Baseline written to %s" % args.baseline)
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = findRegressions(results, baseline, args.threshold)
+    for stage, baseTime, seconds in regressions:
+        print("REGRESSION %s: %0.3f s (baseline %0.3f s, +%0.0f%%)"
+              % (stage, seconds, baseTime, 100 * (seconds / baseTime - 1)))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
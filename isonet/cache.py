@@ -0,0 +1,247 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import threading
+from contextlib import contextmanager
+
+from .staging import stageFile, DETACHED_METHODS
+
+logger = logging.getLogger(__name__)
+
+CHECKSUMS_FILE = 'checksums.json'
+LOCK_FILE = '.lock'
+ENTRY_EXT = '.mrc'
+ACTIVATION_FILE = 'activation.json'
+# Mark of the line with the activated environment in the resolution output
+ENVIRON_MARK = 'ISONET_ENVIRON='
+# Variables set by the shell, not by the activation
+SHELL_VARS = ['PWD', 'OLDPWD', 'SHLVL', '_']
+
+
+def fileChecksum(fileName, blockSize=8 * 1024 * 1024):
+    """ Return the sha256 of the content of a file. """
+    sha = hashlib.sha256()
+    with open(fileName, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+@contextmanager
+def lockFolder(path):
+    """ Serialize the access to a folder shared by threads and processes """
+    with open(os.path.join(path, LOCK_FILE), 'w') as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+
+class PreprocessCache:
+    """ Content addressed cache of the volumes produced by the preprocessing
+    steps (CTF deconvolution and masks), shared by all the protocol runs.
+
+    Entries are keyed by the checksum of the input volume plus the
+    parameters that produce them. The cache is bounded in size and the
+    least recently used entries are evicted first (the entry mtime is
+    refreshed on every hit).
+    """
+    def __init__(self, path, maxSize):
+        """
+        Params:
+            path: folder where the cache lives.
+            maxSize: maximum size of the cache in bytes.
+        """
+        self.path = path
+        self.maxSize = maxSize
+        os.makedirs(self.path, exist_ok=True)
+
+    def _lock(self):
+        """ Serialize the access to the cache between threads and
+        processes (several runs can share the same cache). """
+        return lockFolder(self.path)
+
+    def checksum(self, fileName):
+        """ Return the checksum of a file, reusing the one computed before
+        if the file has not changed (same path, size and mtime). """
+        fileName = os.path.realpath(fileName)
+        stat = os.stat(fileName)
+        fileKey = '%s:%d:%d' % (fileName, stat.st_size, stat.st_mtime_ns)
+        checksumsFile = os.path.join(self.path, CHECKSUMS_FILE)
+
+        with self._lock():
+            checksums = self._readChecksums(checksumsFile)
+        if fileKey in checksums:
+            return checksums[fileKey]
+
+        checksum = fileChecksum(fileName)
+        with self._lock():
+            checksums = self._readChecksums(checksumsFile)
+            checksums[fileKey] = checksum
+            with open(checksumsFile + '.tmp', 'w') as f:
+                json.dump(checksums, f)
+            os.replace(checksumsFile + '.tmp', checksumsFile)
+        return checksum
+
+    @staticmethod
+    def _readChecksums(checksumsFile):
+        if not os.path.exists(checksumsFile):
+            return dict()
+        with open(checksumsFile) as f:
+            return json.load(f)
+
+    @staticmethod
+    def getKey(*values):
+        """ Build the key of an entry from the checksum of its input and the
+        parameters used to generate it. """
+        return hashlib.sha256(repr(values).encode()).hexdigest()
+
+    def _getEntry(self, key):
+        return os.path.join(self.path, key + ENTRY_EXT)
+
+    def fetch(self, key, target):
+        """ Bring the cached entry to target. Return False if the key is not
+        in the cache. """
+        entry = self._getEntry(key)
+        with self._lock():
+            if not os.path.exists(entry):
+                return False
+            os.utime(entry)
+        # Out of the lock, the entry is cloned or copied to a temporary
+        # file. If it is evicted meanwhile, it is a miss.
+        try:
+            stageFile(entry, target, DETACHED_METHODS)
+        except FileNotFoundError:
+            return False
+        logger.info("Reusing %s from the IsoNet cache" % os.path.basename(target))
+        return True
+
+    def store(self, key, source):
+        """ Add source to the cache and evict the least recently used entries
+        if the cache grows beyond its maximum size. """
+        entry = self._getEntry(key)
+        # Never a link to source: the steps rewrite their outputs in place
+        stageFile(source, entry, DETACHED_METHODS)
+        with self._lock():
+            # A copy keeps the mtime of source, the entry is the newest one
+            os.utime(entry)
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for fileName in os.listdir(self.path):
+            if fileName.endswith(ENTRY_EXT):
+                stat = os.stat(os.path.join(self.path, fileName))
+                entries.append((stat.st_mtime, stat.st_size, fileName))
+        totalSize = sum(entry[1] for entry in entries)
+        for _, size, fileName in sorted(entries):
+            if totalSize <= self.maxSize:
+                break
+            os.remove(os.path.join(self.path, fileName))
+            totalSize -= size
+            logger.info("Evicted %s from the IsoNet cache" % fileName)
+
+
+class ActivationCache:
+    """ Environment variables and python executable of activated conda
+    environments, so programs can be launched with the env python without
+    activating it in a new shell every time.
+
+    Entries are keyed by the env name and are valid while the env does not
+    change (the mtime of its conda-meta/history, updated by every conda
+    install, or of its prefix folder).
+    """
+    _threadLock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+        self._file = os.path.join(self.path, ACTIVATION_FILE)
+
+    @staticmethod
+    def getEnvMTime(prefix):
+        for fileName in [os.path.join(prefix, 'conda-meta', 'history'), prefix]:
+            if os.path.exists(fileName):
+                return os.path.getmtime(fileName)
+        return None
+
+    def _readEntries(self):
+        if not os.path.exists(self._file):
+            return dict()
+        with open(self._file) as f:
+            return json.load(f)
+
+    def _isValid(self, entry):
+        return (entry is not None and os.path.exists(entry['python']) and
+                self.getEnvMTime(entry['prefix']) == entry['mtime'])
+
+    def get(self, envName, activationCmd, environ):
+        """ Return (variables, python) of the activated env, resolving it
+        with activationCmd (run with the environ dict) if it is not cached.
+        variables are the ones set by the activation (e.g. PATH,
+        LD_LIBRARY_PATH or CONDA_PREFIX). Return None if it cannot be
+        resolved. """
+        with self._threadLock, lockFolder(self.path):
+            entries = self._readEntries()
+            entry = entries.get(envName)
+            if not self._isValid(entry):
+                entry = self._resolve(activationCmd, environ)
+                if entry is None:
+                    return None
+                entries[envName] = entry
+                with open(self._file + '.tmp', 'w') as f:
+                    json.dump(entries, f, indent=1)
+                os.replace(self._file + '.tmp', self._file)
+        return entry['environ'], entry['python']
+
+    def _resolve(self, activationCmd, environ):
+        """ Activate the env in a shell and get its environment """
+        script = ('import json, os, sys; print("%s" + json.dumps('
+                  '{"environ": dict(os.environ), "python": sys.executable, '
+                  '"prefix": sys.prefix}))' % ENVIRON_MARK)
+        cmd = '%s && python -c \'%s\'' % (activationCmd, script)
+        logger.info("Resolving the environment of: %s" % activationCmd)
+        result = subprocess.run(cmd, shell=True, env=environ,
+                                stdout=subprocess.PIPE, universal_newlines=True)
+        lines = [line for line in result.stdout.splitlines()
+                 if line.startswith(ENVIRON_MARK)]
+        if result.returncode != 0 or not lines:
+            logger.warning("The environment could not be resolved, it will be "
+                           "activated on every call")
+            return None
+        entry = json.loads(lines[-1][len(ENVIRON_MARK):])
+        entry['environ'] = {key: value for key, value in entry['environ'].items()
+                            if environ.get(key) != value and
+                            key not in SHELL_VARS}
+        entry['mtime'] = self.getEnvMTime(entry['prefix'])
+        return entry
@@ -42,6 +42,9 @@ ISONET_ACTIVATION_CMD = 'conda activate %s' % (getIsoNetEnvName(ISONET_VERSION))
 
 ISONET_CUDA_LIB = 'ISONET_CUDA_LIB'
 ISONET_HOME = 'ISONET_HOME'
+ISONET_CACHE_DIR = 'ISONET_CACHE_DIR'
+ISONET_CACHE_SIZE = 'ISONET_CACHE_SIZE'  # In GB
+ISONET_WORKER = 'ISONET_WORKER'
 
 # IsoNet programs
 ISONET_SCRIPT = 'isonet.py'
@@ -54,13 +57,48 @@ PROGRAM_PREDICT = 'predict'
 
 NOISE_MODE = ['ramp', 'hamming', 'noFilter']
 
+# Backends of the preprocessing steps: IsoNet programs or the native ones
+# (isonet.engines)
+ENGINES = ['IsoNet', 'Native']
+ENGINE_ISONET = 0
+ENGINE_NATIVE = 1
+ENGINE_MASK = 'mask'
+ENGINE_DECONV = 'deconv'
+ENGINE_EXTRACT = 'extract'
+# Runs within the IsoNet environment, it needs tensorflow
+ENGINE_PREDICT = 'predict'
+ENGINE_QUANTIZE = 'quantize'
+
+# Variants of a trained model used by the native predict engine (see
+# isonet.engines.quantize)
+MODEL_PRECISIONS = ['float32', 'float16', 'dynamic', 'int8']
+PRECISION_FLOAT32 = 0
+
+# Defocus of a tomogram from its CTF tomo series
+DEFOCUS_MODES = ['Nearest to 0', 'Dose weighted']
+DEFOCUS_NEAREST_ZERO = 0
+DEFOCUS_DOSE_WEIGHTED = 1
+
 TOMOGRAMFOLDER = 'tomograms'
 DECONVFOLDER = 'deconv'
 SUBTOMOGRAMFOLDER = 'subtomograms'
 RESULTFOLDER = 'results'
 MASKFOLDER = 'mask'
 PREDICTEDFOLDER = 'predicted'
+# Results of a refinement resumed after the given iteration
+RESUMEFOLDER = 'resume_iter%02d'
+TOMOSTARFOLDER = 'stars'
+# Features used to choose the training tomograms
+FEATURESFOLDER = 'features'
 
 OUTPUT_TOMO_STAR_FILE = 'tomograms.star'
 OUTPUT_TOMO_DECONV_STAR_FILE = 'tomograms_new.star'
 OUTPUT_SUBTOMO_STAR_FILE = 'subtomograms.star'
+# Features of all the tomograms and the ones chosen for the training
+TRAINING_TOMO_STAR_FILE = 'training_tomograms.star'
+STEP_STATS_FILE = 'step_stats.json'
+
+# Suffix IsoNet adds to the predicted tomograms
+PREDICTED_SUFFIX = '_corrected'
+# Mark of the tomograms predicted in streaming not yet in the output set
+PREDICTED_DONE_SUFFIX = '.done'
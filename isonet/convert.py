@@ -0,0 +1,334 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import re
+import sqlite3
+from contextlib import closing
+
+import mrcfile
+import numpy as np
+from pyworkflow.utils import removeBaseExt
+
+from .star import StarTable
+
+
+def parseTomoIdx(tomoIdx):
+    """ Parse an IsoNet tomo_idx string (e.g. 1,2,4 or 5-10,15,16) and
+    return the list of selected indexes. Return None if nothing is
+    selected, meaning all tomograms. """
+    if tomoIdx is None or not tomoIdx.strip():
+        return None
+    indexes = []
+    for item in tomoIdx.split(','):
+        item = item.strip()
+        if '-' in item:
+            start, end = item.split('-')
+            indexes.extend(range(int(start), int(end) + 1))
+        elif item:
+            indexes.append(int(item))
+    return indexes
+
+
+def getTomoIndexes(tsIds, tomoIdx=None):
+    """ Return a dict {rlnIndex: tsId} with the indexes that IsoNet
+    prepare_star will assign to the tomograms (sorted by file name, that
+    is <tsId>.mrc, so 'a-1' goes before 'a'), restricted to the ones listed
+    in tomoIdx. """
+    selected = parseTomoIdx(tomoIdx)
+    tomoIndexes = dict()
+    for index, tsId in enumerate(sorted(tsIds, key=lambda t: t + '.mrc'),
+                                 start=1):
+        if selected is None or index in selected:
+            tomoIndexes[index] = tsId
+    return tomoIndexes
+
+
+# Accumulated dose (e/A^2) at which the weight of a tilt is 1/e in the dose
+# weighted defocus
+DOSE_DECAY = 30.0
+
+
+def splitInShards(sizes, numberOfShards):
+    """ Split the tomograms of a dict {tsId: size} in at most numberOfShards
+    lists with a similar total size. The biggest tomograms are assigned
+    first, each one to the lightest shard. Every shard keeps the input
+    order and empty shards are dropped. """
+    order = {tsId: i for i, tsId in enumerate(sizes)}
+    shards = [[] for _ in range(max(1, numberOfShards))]
+    loads = [0] * len(shards)
+    for tsId in sorted(sizes, key=lambda t: (-sizes[t], order[t])):
+        lightest = loads.index(min(loads))
+        shards[lightest].append(tsId)
+        loads[lightest] += sizes[tsId]
+    return [sorted(shard, key=order.get) for shard in shards if shard]
+
+
+def selectDefocus(tilts, doseWeighted=False, doseDecay=None):
+    """ Return the defocus of a tilt series from the (tiltAngle, defocus,
+    accumDose) of its tilts: the one of the tilt nearest to 0 degrees or
+    the average weighted by exp(-accumDose / doseDecay), so the first
+    acquired tilts (less radiation damage) weight more. """
+    if not tilts:
+        raise ValueError("There are no CTF values for the tilt series")
+    if not doseWeighted:
+        return min(tilts, key=lambda t: abs(t[0]))[1]
+    doseDecay = DOSE_DECAY if doseDecay is None else doseDecay
+    weights = np.exp(-np.array([t[2] or 0 for t in tilts]) / doseDecay)
+    return float(np.average([t[1] for t in tilts], weights=weights))
+
+
+# Terms of a compound select (SQLITE_MAX_COMPOUND_SELECT is 500)
+MAX_UNION_TERMS = 400
+
+
+def readSetOfSetsColumns(setFile, parentLabel, labels):
+    """ Read some attributes of the items of every set of a set of sets
+    stored by the pyworkflow sqlite mapper (e.g. the tilt images of a
+    SetOfTiltSeries, kept in the id<seriesId>_Objects tables) without
+    loading the objects: the columns of all the sets are projected in
+    a few UNION ALL queries.
+    Params:
+        setFile: sqlite file of the set of sets.
+        parentLabel: attribute of the sets used as key (e.g. _tsId).
+        labels: attributes to read (e.g. _tiltAngle), None where missing.
+    Return a dict {parentValue: [tuple of values of every item]}, with the
+    items in id order.
+    """
+    with closing(sqlite3.connect('file:%s?mode=ro' % setFile,
+                                 uri=True)) as conn:
+        tables = {row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table'")}
+        parentColumn = dict(conn.execute(
+            "SELECT label_property, column_name FROM Classes"))[parentLabel]
+        parents = [(objId, value) for objId, value in conn.execute(
+            "SELECT id, %s FROM Objects ORDER BY id" % parentColumn)
+                   if 'id%d_Objects' % objId in tables]
+
+        columns = {objId: dict() for objId, _ in parents}
+        for chunk in _chunks(parents, MAX_UNION_TERMS):
+            query = ' UNION ALL '.join(
+                "SELECT %d, label_property, column_name FROM id%d_Classes"
+                % (objId, objId) for objId, _ in chunk)
+            for objId, label, column in conn.execute(query):
+                columns[objId][label] = column
+
+        items = {value: [] for _, value in parents}
+        for chunk in _chunks(parents, MAX_UNION_TERMS):
+            query = ' UNION ALL '.join(
+                "SELECT %d, id, %s FROM id%d_Objects"
+                % (objId, ', '.join(columns[objId].get(label, 'NULL')
+                                    for label in labels), objId)
+                for objId, _ in chunk)
+            for row in conn.execute(query + ' ORDER BY 1, 2'):
+                items[dict(chunk)[row[0]]].append(tuple(row[2:]))
+    return items
+
+
+def _chunks(values, size):
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+
+def matchCtfTilts(tilts, ctfs):
+    """ Pair the tilt images of a series with their CTF estimations by
+    acquisition order, or by tilt index if the acquisition order is not
+    set in both of them.
+    Params:
+        tilts: list of (tiltAngle, accumDose, acquisitionOrder, index).
+        ctfs: list of (defocus, acquisitionOrder, index).
+    Return a list of (tiltAngle, defocus, accumDose) as selectDefocus
+    expects. """
+    useOrder = (all(t[2] is not None for t in tilts) and
+                all(c[1] is not None for c in ctfs))
+    key = 2 if useOrder else 3
+    tiltsByKey = {tilt[key]: tilt for tilt in tilts}
+    matched = []
+    for ctf in ctfs:
+        tilt = tiltsByKey.get(ctf[key - 1])
+        if tilt is not None:
+            matched.append((tilt[0], ctf[0], tilt[1]))
+    return matched
+
+
+def getMrcDimensions(fileName):
+    """ Return the (x, y, z) dimensions of a MRC file, reading only its
+    header """
+    with mrcfile.open(fileName, header_only=True, permissive=True) as mrc:
+        header = mrc.header
+        return int(header.nx), int(header.ny), int(header.nz)
+
+
+def writeTomoStarFile(fileName, index, tomoFile, pixelSize, defocus,
+                      numberSubtomos):
+    """ Write the star file of a single tomogram with the same columns that
+    IsoNet prepare_star uses. """
+    StarTable(rlnIndex=[index],
+              rlnMicrographName=[tomoFile],
+              rlnPixelSize=[float(pixelSize)],
+              rlnDefocus=[float(defocus)],
+              rlnNumberSubtomo=[numberSubtomos],
+              rlnMaskBoundary=['None']).write(fileName)
+
+
+def readStarRow(starFile):
+    """ Return the first row of a star file (e.g. the one of a tomogram
+    star file) as a dict. """
+    return StarTable.read(starFile).getRow(0)
+
+
+def countStarRows(starFile):
+    """ Number of rows of a star file (e.g. subtomograms of a star file) """
+    return len(StarTable.read(starFile))
+
+
+def updateStarFile(starFile, **values):
+    """ Set the given column values in all the rows of a star file, adding
+    the columns that do not exist yet. """
+    table = StarTable.read(starFile)
+    table.update(**values)
+    table.write(starFile)
+
+
+def splitTomoStarFile(starFile, outputFolder, tomoIndexes,
+                      defocusValues=None):
+    """ Split the tomograms star file generated by prepare_star in one star
+    file per tomogram, so each one can be processed in an independent step.
+    Params:
+        starFile: tomograms star file generated by IsoNet.
+        outputFolder: folder where the tomogram star files will be written.
+        tomoIndexes: dict {rlnIndex: tsId} of the tomograms to be written.
+        defocusValues: optional dict {tsId: defocus} to fill rlnDefocus.
+    Return a dict {tsId: starFile}.
+    """
+    table = StarTable.read(starFile)
+    selected = table.select(np.isin(table['rlnIndex'], list(tomoIndexes)))
+    tsIds = [removeBaseExt(name) for name in selected['rlnMicrographName']]
+    if defocusValues is not None:
+        selected['rlnDefocus'] = [float(defocusValues[tsId]) for tsId in tsIds]
+    starFiles = dict()
+    for i, tsId in enumerate(tsIds):
+        tomoStarFile = os.path.join(outputFolder, tsId + '.star')
+        selected.select([i]).write(tomoStarFile)
+        starFiles[tsId] = tomoStarFile
+    return starFiles
+
+
+def mergeStarFiles(starFiles, outputStarFile):
+    """ Join the rows of several star files (with the same columns) in a
+    single star file. """
+    tables = [StarTable.read(starFile) for starFile in starFiles]
+    if tables:
+        StarTable.concatenate(tables).write(outputStarFile)
+
+
+def parseTrainingLoss(logFile):
+    """ Return the loss of the last training epoch reported by keras in the
+    log of the refine step, None if it is not found. """
+    loss = None
+    if os.path.exists(logFile):
+        with open(logFile) as f:
+            for match in re.finditer(r'\s- loss: ([-+.\deE]+)', f.read()):
+                loss = float(match.group(1))
+    return loss
+
+
+# Keras saves the models with the earliest HDF5 format (superblock v0/v1)
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+MODEL_REGEX = re.compile(r'model_iter(\d+)\.h5$')
+RESUME_REGEX = re.compile(r'resume_iter(\d+)$')
+
+
+def isCompleteModel(modelFile):
+    """ Whether a model file is not truncated: it is an HDF5 file at least
+    as long as the end of file address of its superblock """
+    try:
+        with open(modelFile, 'rb') as f:
+            header = f.read(64)
+    except OSError:
+        return False
+    if not header.startswith(HDF5_SIGNATURE) or len(header) < 24:
+        return False
+    version = header[8]
+    if version in (0, 1):
+        offsetSize = header[13]
+        eofPos = 24 + (4 if version == 1 else 0) + 2 * offsetSize
+    else:
+        offsetSize = header[9]
+        eofPos = 12 + 2 * offsetSize
+    eofBytes = header[eofPos:eofPos + offsetSize]
+    if len(eofBytes) < offsetSize:
+        return False
+    return os.path.getsize(modelFile) >= int.from_bytes(eofBytes, 'little')
+
+
+def findCheckpoints(resultsFolder):
+    """ Return a dict {iteration: modelFile} with the complete models of a
+    refinement. A refinement resumed after iteration N writes its models
+    to the resume_iterN folder, their iterations are offset by N. """
+    checkpoints = dict()
+    if not os.path.isdir(resultsFolder):
+        return checkpoints
+    folders = [(0, resultsFolder)]
+    for name in os.listdir(resultsFolder):
+        match = RESUME_REGEX.match(name)
+        if match:
+            folders.append((int(match.group(1)),
+                            os.path.join(resultsFolder, name)))
+    for offset, folder in sorted(folders):
+        for name in os.listdir(folder):
+            match = MODEL_REGEX.match(name)
+            modelFile = os.path.join(folder, name)
+            if match and isCompleteModel(modelFile):
+                checkpoints[offset + int(match.group(1))] = modelFile
+    return checkpoints
+
+
+def findLastCheckpoint(resultsFolder):
+    """ Return the (iteration, modelFile) of the last complete iteration
+    without gaps since the first one, (0, None) if there is none """
+    checkpoints = findCheckpoints(resultsFolder)
+    iteration = 0
+    while iteration + 1 in checkpoints:
+        iteration += 1
+    return iteration, checkpoints.get(iteration)
+
+
+def getResumedNoiseSchedule(noiseLevels, noiseStartIters, doneIterations):
+    """ Shift the noise schedule of refine (comma separated strings) to
+    resume it after doneIterations. The level in use at that point starts
+    at the first resumed iteration. """
+    levels = [l.strip() for l in noiseLevels.split(',') if l.strip()]
+    starts = [int(s) for s in noiseStartIters.split(',') if s.strip()]
+    resumedLevels, resumedStarts = [], []
+    for level, start in zip(levels, starts):
+        start = max(1, start - doneIterations)
+        if resumedStarts and resumedStarts[-1] == start:
+            # Overridden by a later level, as in the IsoNet schedule
+            resumedLevels.pop()
+            resumedStarts.pop()
+        resumedLevels.append(level)
+        resumedStarts.append(start)
+    return ','.join(resumedLevels), ','.join(str(s) for s in resumedStarts)
@@ -0,0 +1,228 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Native version of IsoNet deconv: Wiener-like CTF deconvolution of a
+tomogram processed in overlapping chunks with a bounded memory use.
+
+The tomogram is split in chunks the same way IsoNet does (cubes of
+chunk_size plus the overlapping margin, symmetric padding at the borders and
+every chunk normalized to the mean and std of its input). Chunks are read
+from the memory mapped tomogram and the central part of each one is written
+straight to the memory mapped output, so only the chunks being deconvolved
+are loaded. Chunks are processed by a pool of threads, scipy.fft releases
+the GIL.
+"""
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+
+import mrcfile
+import numpy as np
+import scipy.fft
+
+logger = logging.getLogger(__name__)
+
+# Approximated peak memory of a chunk being deconvolved: input, half
+# spectrum, filtered spectrum and output, plus the fft work buffers
+BYTES_PER_VOXEL = 24
+DEFAULT_OVERLAP = 0.25
+DEFAULT_MEMORY = 8 * 1024 ** 3
+# Chunks that fit in the memory budget when the chunk size is chosen
+# automatically, so the result does not depend on the number of threads
+AUTO_CHUNKS = 4
+
+
+def ctf1d(length, pixelSize, voltage, cs, defocus, amplitude, phaseShift):
+    """ 1D CTF from 0 to Nyquist (tom_ctf1d in IsoNet, SI units) """
+    ny = 1 / pixelSize
+    lambda1 = 12.2643247 / np.sqrt(voltage * (1.0 + voltage * 0.978466e-6)) * 1e-10
+    lambda2 = lambda1 * 2
+    points = np.arange(0, length).astype(np.float64) / (2 * length) * ny
+    k2 = points ** 2
+    term1 = lambda1 ** 3 * cs * k2 ** 2
+    w = np.pi / 2 * (term1 + lambda2 * defocus * k2) - phaseShift
+    return -np.sqrt(1 - amplitude ** 2) * np.sin(w) + np.cos(w) * amplitude
+
+
+def wiener1d(pixelSize, voltage, cs, defocus, snrfalloff, deconvstrength,
+             highpassnyquist, phaseflipped=False, phaseShift=0):
+    """ Return the frequencies (normalized to Nyquist) and the 1D Wiener
+    filter IsoNet uses to deconvolve the tomograms.
+    Params:
+        pixelSize: in A.
+        voltage: in kV.
+        cs: in mm.
+        defocus: in um (underfocus positive).
+    """
+    data = np.arange(0, 1 + 1 / 2047., 1 / 2047.)
+    highpass = np.minimum(1, data / highpassnyquist) * np.pi
+    highpass = 1 - np.cos(highpass)
+    snr = np.exp(-data * snrfalloff * 100 / pixelSize) * \
+        (10 ** (3 * deconvstrength)) * highpass + 1e-6
+    ctf = ctf1d(2048, pixelSize * 1e-10, voltage * 1e3, cs * 1e-3,
+                -defocus * 1e-6, 0.07, phaseShift / 180 * np.pi)
+    if phaseflipped:
+        ctf = np.abs(ctf)
+    return data, ctf / (ctf * ctf + 1 / snr)
+
+
+def wienerRamp(shape, frequencies, wiener):
+    """ Sample the 1D filter in the half spectrum (rfftn layout) of a volume
+    of the given shape. """
+    coords = []
+    for i, length in enumerate(shape):
+        last = i == len(shape) - 1
+        freqs = (np.fft.rfftfreq(length) if last else np.fft.fftfreq(length)) * length
+        freqs = freqs.astype(np.float32) / max(1, length // 2)
+        shape1 = [1] * len(shape)
+        shape1[i] = len(freqs)
+        coords.append(freqs.reshape(shape1))
+    r = np.sqrt(sum(c ** 2 for c in coords))
+    r = np.minimum(1, r)
+    return np.interp(r, frequencies, wiener).astype(np.float32)
+
+
+def _symmetricIndexes(start, size, length):
+    """ Indexes of the voxels start:start+size of an axis of the given
+    length padded in 'symmetric' mode """
+    idx = np.arange(start, start + size) % (2 * length)
+    return np.where(idx < length, idx, 2 * length - 1 - idx)
+
+
+def _readPadded(data, starts, size):
+    """ Read a cube of a volume padded in 'symmetric' mode, starting at the
+    given (possibly negative) position. Only the region covering the cube is
+    read from data. """
+    indexes = [_symmetricIndexes(start, size, length)
+               for start, length in zip(starts, data.shape)]
+    region = tuple(slice(idx.min(), idx.max() + 1) for idx in indexes)
+    block = np.asarray(data[region], dtype=np.float32)
+    local = [idx - idx.min() for idx in indexes]
+    return block[np.ix_(*local)]
+
+
+def getChunkSize(chunkSize, overlap, memory, threads):
+    """ Return the chunk size and number of threads that fit in the memory
+    budget (in bytes). Without chunk size, the largest one that lets
+    AUTO_CHUNKS chunks in memory is used. """
+    def chunkBytes(size):
+        return int(size * (1 + overlap)) ** 3 * BYTES_PER_VOXEL
+
+    if chunkSize is None:
+        chunkSize = int((memory / AUTO_CHUNKS / BYTES_PER_VOXEL) ** (1 / 3) /
+                        (1 + overlap))
+    while chunkSize > 8 and chunkBytes(chunkSize) > memory:
+        chunkSize = chunkSize // 2
+    threads = max(1, min(threads, int(memory // chunkBytes(chunkSize))))
+    return chunkSize, threads
+
+
+def deconvolve(tomoFile, outputFile, pixelSize, defocus, voltage=300.0,
+               cs=2.7, snrfalloff=1.0, deconvstrength=1.0,
+               highpassnyquist=0.02, chunkSize=None, overlap=None,
+               memory=DEFAULT_MEMORY, threads=4):
+    """ CTF deconvolve a tomogram as IsoNet deconv does with chunks.
+    Params:
+        pixelSize: in A.
+        defocus: in um.
+        chunkSize: side of the chunks (without the overlap). If None, the
+            largest that fits in memory is used.
+        overlap: overlap rate of the chunks.
+        memory: maximum memory (in bytes) used by the chunks in process.
+        threads: number of chunks processed concurrently.
+    """
+    overlap = DEFAULT_OVERLAP if overlap is None else overlap
+    requested = chunkSize
+    chunkSize, threads = getChunkSize(chunkSize, overlap, memory, threads)
+    if requested is not None and chunkSize != requested:
+        logger.info("Chunk size reduced from %d to %d to fit in %0.1f GB"
+                    % (requested, chunkSize, memory / 1024 ** 3))
+    cropSize = int(chunkSize * (1 + overlap))
+    pad = int((cropSize - chunkSize) / 2)
+
+    frequencies, wiener = wiener1d(pixelSize, voltage, cs, defocus,
+                                   snrfalloff, deconvstrength, highpassnyquist)
+    ramp = wienerRamp((cropSize,) * 3, frequencies, wiener)
+
+    with mrcfile.mmap(tomoFile, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        shape = data.shape
+        nChunks = [length // chunkSize + 1 for length in shape]
+        logger.info("Deconvolving %s in %d chunks of %d voxels with %d threads"
+                    % (tomoFile, np.prod(nChunks), cropSize, threads))
+
+        with mrcfile.new_mmap(outputFile, shape=shape, mrc_mode=2,
+                              overwrite=True) as out:
+
+            def deconvolveChunk(chunkIndex):
+                starts = [i * chunkSize for i in chunkIndex]
+                cube = _readPadded(data, [s - pad for s in starts], cropSize)
+                result = scipy.fft.irfftn(scipy.fft.rfftn(cube) * ramp,
+                                          s=cube.shape)
+                result = result / np.std(result) * np.std(cube) + np.mean(cube)
+                target = tuple(slice(s, min(s + chunkSize, length))
+                               for s, length in zip(starts, shape))
+                core = tuple(slice(pad, pad + t.stop - t.start) for t in target)
+                out.data[target] = result[core]
+
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                # list() propagates the exceptions of the threads
+                list(executor.map(deconvolveChunk,
+                                  product(*[range(n) for n in nChunks])))
+
+            out.voxel_size = pixelSize
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('tomo_file')
+    parser.add_argument('output_file')
+    parser.add_argument('--pixel_size', type=float, required=True)
+    parser.add_argument('--defocus', type=float, required=True,
+                        help='Defocus in A')
+    parser.add_argument('--voltage', type=float, default=300.0)
+    parser.add_argument('--cs', type=float, default=2.7)
+    parser.add_argument('--snrfalloff', type=float, default=1.0)
+    parser.add_argument('--deconvstrength', type=float, default=1.0)
+    parser.add_argument('--highpassnyquist', type=float, default=0.02)
+    parser.add_argument('--chunk_size', type=int, default=None)
+    parser.add_argument('--overlap_rate', type=float, default=None)
+    parser.add_argument('--memory', type=float, default=DEFAULT_MEMORY / 1024 ** 3,
+                        help='Memory budget in GB')
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    # IsoNet reads the defocus of the star file in A and uses it in um
+    deconvolve(args.tomo_file, args.output_file, args.pixel_size,
+               args.defocus / 10000.0, args.voltage, args.cs, args.snrfalloff,
+               args.deconvstrength, args.highpassnyquist, args.chunk_size,
+               args.overlap_rate, int(args.memory * 1024 ** 3), args.threads)
+
+
+if __name__ == '__main__':
+    main()
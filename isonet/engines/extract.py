@@ -0,0 +1,216 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Native version of IsoNet extract. Cube centers are sampled inside the mask
+as IsoNet does and all the cubes of a tomogram are gathered at once from the
+memory mapped tomogram. They are written either to a single MRC volume
+stack, referred to as <index>@<stack> (1-based, as in Relion) in the
+subtomograms star file, or to a folder with a file per subtomogram, the
+layout IsoNet refine reads.
+"""
+import argparse
+import logging
+import os
+
+import mrcfile
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from ..star import StarTable
+
+logger = logging.getLogger(__name__)
+
+STACK_EXT = '.mrcs'
+# Candidate centers drawn per subtomogram when they must be spaced
+OVERSAMPLING = 8
+SUBTOMO_COLUMNS = ['rlnSubtomoIndex', 'rlnImageName', 'rlnCubeSize',
+                   'rlnCropSize', 'rlnPixelSize']
+
+
+def sampleSeeds(shape, number, cropSize, mask=None, rng=None):
+    """ Pick random cube centers where the mask is not 0 and the whole cube
+    is inside the volume (create_cube_seeds in IsoNet). The mask is scanned
+    slice by slice, so it can be memory mapped. Returns a (number, 3)
+    array of z, y, x sorted by z. """
+    rng = np.random.default_rng() if rng is None else rng
+    border = [slice(cropSize // 2, length - cropSize + cropSize // 2 + 1)
+              for length in shape]
+    zs = range(border[0].start, border[0].stop)
+    height = max(0, border[1].stop - border[1].start)
+    width = max(0, border[2].stop - border[2].start)
+
+    def validVoxels(z):
+        if mask is None:
+            return np.arange(height * width)
+        return np.flatnonzero(np.asarray(mask[z])[border[1], border[2]])
+
+    if mask is None:
+        counts = np.full(len(zs), height * width)
+    else:
+        counts = np.array([len(validVoxels(z)) for z in zs], dtype=int)
+    total = counts.sum()
+    if total == 0:
+        raise ValueError("There is no room to extract cubes of %d voxels "
+                         "inside the mask" % cropSize)
+    ranks = np.sort(rng.choice(total, number, replace=total < number))
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    sliceIdx = np.searchsorted(offsets, ranks, side='right') - 1
+
+    seeds = np.empty((number, 3), dtype=int)
+    for i in np.unique(sliceIdx):
+        selected = sliceIdx == i
+        flat = validVoxels(zs[i])[ranks[selected] - offsets[i]]
+        seeds[selected, 0] = zs[i]
+        seeds[selected, 1] = flat // width + border[1].start
+        seeds[selected, 2] = flat % width + border[2].start
+    return seeds
+
+
+def spaceSeeds(candidates, number, minDistance):
+    """ Keep the first candidates (up to number) that are at least
+    minDistance voxels away (along some axis) from the ones kept before, so
+    cubes of that size do not overlap. Returned sorted by z. """
+    cells = dict()
+    kept = []
+    for seed in candidates:
+        cell = tuple(seed // minDistance)
+        neighbours = (cells.get((cell[0] + dz, cell[1] + dy, cell[2] + dx), [])
+                      for dz in (-1, 0, 1) for dy in (-1, 0, 1)
+                      for dx in (-1, 0, 1))
+        if any(np.max(np.abs(seed - other)) < minDistance
+               for others in neighbours for other in others):
+            continue
+        cells.setdefault(cell, []).append(seed)
+        kept.append(seed)
+        if len(kept) == number:
+            break
+    kept = np.array(kept, dtype=int).reshape(-1, 3)
+    return kept[np.argsort(kept[:, 0], kind='stable')]
+
+
+def cropCubes(data, seeds, cropSize):
+    """ Gather the cubes centered at the seeds in one vectorized read (a
+    sliding window view of the volume indexed with the cube corners). """
+    windows = sliding_window_view(data, (cropSize,) * 3)
+    corners = seeds - cropSize // 2
+    return np.asarray(windows[corners[:, 0], corners[:, 1], corners[:, 2]],
+                      dtype=np.float32)
+
+
+def getImageName(index, stackFile):
+    return '%06d@%s' % (index, stackFile)
+
+
+def parseImageName(imageName):
+    """ Return the (0-based index, stack file) of an <index>@<stack> image
+    name, and (None, file) for a single volume. """
+    if '@' in imageName:
+        index, fileName = imageName.split('@', 1)
+        return int(index) - 1, fileName
+    return None, imageName
+
+
+def extractSubtomograms(tomoFile, output, starFile, number, cubeSize,
+                        cropSize, pixelSize, maskFile=None, seed=None,
+                        minDistance=None):
+    """ Extract number subtomograms of cropSize from a tomogram and write
+    the star file listing them. The output is a stack (STACK_EXT) or a
+    folder for a file per subtomogram (<folder name>_<index>.mrc). With
+    minDistance, the centers are at least that far from each other (fewer
+    subtomograms are extracted if they do not fit). """
+    rng = np.random.default_rng(seed)
+    candidates = number if minDistance is None else number * OVERSAMPLING
+    with mrcfile.mmap(tomoFile, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        if maskFile is not None:
+            with mrcfile.mmap(maskFile, mode='r', permissive=True) as maskMrc:
+                seeds = sampleSeeds(data.shape, candidates, cropSize,
+                                    maskMrc.data, rng)
+        else:
+            seeds = sampleSeeds(data.shape, candidates, cropSize, rng=rng)
+        if minDistance is not None:
+            seeds = spaceSeeds(rng.permutation(seeds), number, minDistance)
+            if len(seeds) < number:
+                logger.warning("Only %d subtomograms %d voxels apart fit in "
+                               "%s" % (len(seeds), minDistance, tomoFile))
+        cubes = cropCubes(data, seeds, cropSize)
+
+    indexes = np.arange(1, len(cubes) + 1)
+    if output.endswith(STACK_EXT):
+        with mrcfile.new(output, overwrite=True) as stack:
+            stack.set_data(cubes)
+            stack.voxel_size = pixelSize
+        imageNames = [getImageName(i, output) for i in indexes]
+    else:
+        imageNames = writeSubtomograms(cubes, output, pixelSize)
+
+    table = StarTable(dict(zip(SUBTOMO_COLUMNS, [
+        indexes, imageNames,
+        np.full(len(cubes), cubeSize), np.full(len(cubes), cropSize),
+        np.full(len(cubes), float(pixelSize))])))
+    table.write(starFile)
+
+
+def writeSubtomograms(cubes, folder, pixelSize):
+    """ Write every cube to its own MRC file in folder and return their
+    names """
+    os.makedirs(folder, exist_ok=True)
+    baseName = os.path.basename(os.path.normpath(folder))
+    fileNames = []
+    for index, cube in enumerate(cubes, start=1):
+        fileName = os.path.join(folder, '%s_%06d.mrc' % (baseName, index))
+        with mrcfile.new(fileName, overwrite=True) as mrc:
+            mrc.set_data(cube)
+            mrc.voxel_size = pixelSize
+        fileNames.append(fileName)
+    return fileNames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('tomo_file')
+    parser.add_argument('output', help='Stack (%s) or folder for a file '
+                                       'per subtomogram' % STACK_EXT)
+    parser.add_argument('star_file')
+    parser.add_argument('--number_subtomos', type=int, required=True)
+    parser.add_argument('--cube_size', type=int, required=True)
+    parser.add_argument('--crop_size', type=int, required=True)
+    parser.add_argument('--pixel_size', type=float, required=True)
+    parser.add_argument('--mask_file', default=None)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--min_distance', type=int, default=None,
+                        help='Minimum distance between the subtomograms')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    extractSubtomograms(args.tomo_file, args.output, args.star_file,
+                        args.number_subtomos, args.cube_size, args.crop_size,
+                        args.pixel_size, args.mask_file, args.seed,
+                        args.min_distance)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Native version of IsoNet make_mask. The mask is the product of a density
+mask (local maximum of the smoothed tomogram) and a std mask (local standard
+deviation), both computed on the tomogram binned by 2.
+"""
+import argparse
+
+import mrcfile
+import numpy as np
+from scipy import ndimage
+
+EPS = 0.001
+
+
+def _resample(data, axis, size):
+    """ Linear interpolation of data to size elements along axis, sampling
+    the centers of the output voxels (as skimage resize does). """
+    length = data.shape[axis]
+    coords = (np.arange(size) + 0.5) * length / size - 0.5
+    coords = np.clip(coords, 0, length - 1)
+    low = np.minimum(np.floor(coords).astype(int), length - 2)
+    weights = (coords - low).astype(data.dtype)
+    shape = [1] * data.ndim
+    shape[axis] = size
+    weights = weights.reshape(shape)
+    return (np.take(data, low, axis=axis) * (1 - weights) +
+            np.take(data, low + 1, axis=axis) * weights)
+
+
+def binTomogram(data, slabSize=64):
+    """ Bin a volume by 2 with anti aliasing (gaussian of sigma
+    (factor - 1) / 2 and linear interpolation, as skimage resize does). The
+    volume (e.g. a memory mapped MRC) is read in slabs along z, so only the
+    binned result is fully loaded in memory. """
+    shape = np.array(data.shape)
+    binShape = shape // 2
+    sigma = (shape / binShape - 1) / 2
+    # Gaussian radius along z (scipy truncates it at 4 sigma)
+    halo = int(4.0 * sigma[0] + 0.5)
+    binnedXY = np.empty((shape[0], binShape[1], binShape[2]), dtype=np.float32)
+
+    for start in range(0, shape[0], slabSize):
+        end = min(start + slabSize, shape[0])
+        haloStart = max(start - halo, 0)
+        haloEnd = min(end + halo, shape[0])
+        slab = np.asarray(data[haloStart:haloEnd], dtype=np.float32)
+        slab = ndimage.gaussian_filter(slab, sigma, mode='mirror')
+        slab = slab[start - haloStart:end - haloStart]
+        slab = _resample(slab, 1, binShape[1])
+        binnedXY[start:end] = _resample(slab, 2, binShape[2])
+
+    return _resample(binnedXY, 0, binShape[0])
+
+
+def maxMask(tomo, side, percentage):
+    """ Keep the percentage of voxels with the highest local density (lowest
+    values, particles are dark). """
+    filtered = ndimage.maximum_filter(-tomo.astype(np.float32), 2 * side + 1,
+                                      mode='reflect')
+    return filtered > np.percentile(filtered, 100 - percentage)
+
+
+def stdMask(tomo, side, percentage):
+    """ Keep the percentage of voxels with the highest local standard
+    deviation. """
+    size = 2 * side + 1
+    tomo = tomo.astype(np.float32)
+    # Box means with zero padding, rescaled to the voxels inside the box.
+    # Their number is separable, so it is applied per axis by broadcasting
+    # and only two volumes besides the tomogram are allocated.
+    mean = ndimage.uniform_filter(tomo, size, mode='constant')
+    meanSq = ndimage.uniform_filter(np.square(tomo, out=tomo), size,
+                                    mode='constant')
+    del tomo
+    for axis, length in enumerate(mean.shape):
+        counts = ndimage.uniform_filter1d(np.ones(length), size,
+                                          mode='constant')
+        shape = [1] * mean.ndim
+        shape[axis] = length
+        scale = (1 / counts).astype(np.float32).reshape(shape)
+        mean *= scale
+        meanSq *= scale
+    np.square(mean, out=mean)
+    meanSq -= mean
+    del mean
+    meanSq += EPS
+    std = np.sqrt(np.maximum(meanSq, 0, out=meanSq), out=meanSq)
+    return std > np.percentile(std, 100 - percentage)
+
+
+def makeMask(tomoFile, maskFile, patchSize=4, densityPercentage=50,
+             stdPercentage=50, zCrop=None):
+    """ Write the mask of a tomogram the same way IsoNet make_mask does.
+    Params:
+        tomoFile: input tomogram (deconvolved or not).
+        maskFile: output mask (uint8 MRC with the same size).
+        patchSize: size of the box of the max and std filters.
+        densityPercentage: percentage of voxels kept by local density.
+        stdPercentage: percentage of voxels kept by local std.
+        zCrop: fraction of the top and bottom slices masked out.
+    """
+    with mrcfile.mmap(tomoFile, mode='r', permissive=True) as mrc:
+        shape = mrc.data.shape
+        voxelSize = mrc.voxel_size.copy()
+        origin = mrc.header.origin.copy()
+        bintomo = binTomogram(mrc.data)
+
+    binShape = bintomo.shape
+    gauss = ndimage.gaussian_filter(bintomo, patchSize / 2)
+    del bintomo
+    binMask = np.ones(binShape, dtype=bool)
+    # Percentages above 99.8 keep the whole volume
+    if densityPercentage <= 99.8:
+        binMask &= maxMask(gauss, patchSize, densityPercentage)
+    if stdPercentage <= 99.8:
+        binMask &= stdMask(gauss, patchSize, stdPercentage)
+    del gauss
+
+    # The slices are cropped at full size, after upsampling the mask
+    zStart, zEnd = 0, shape[0]
+    if zCrop is not None and zCrop < 1:
+        zStart, zEnd = int(zCrop * shape[0]), int((1 - zCrop) * shape[0])
+
+    with mrcfile.new_mmap(maskFile, shape=shape, mrc_mode=6, fill=0,
+                          overwrite=True) as mrc:
+        # Every binned voxel fills 2x2x2 voxels, the last slice of the odd
+        # dimensions remains 0
+        for z in range(binShape[0]):
+            plane = binMask[z].repeat(2, axis=0).repeat(2, axis=1)
+            start, end = max(2 * z, zStart), min(2 * z + 2, zEnd)
+            if start < end:
+                mrc.data[start:end, :plane.shape[0], :plane.shape[1]] = plane
+        mrc.voxel_size = voxelSize
+        mrc.header.origin = origin
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('tomo_file')
+    parser.add_argument('mask_file')
+    parser.add_argument('--patch_size', type=int, default=4)
+    parser.add_argument('--density_percentage', type=float, default=50)
+    parser.add_argument('--std_percentage', type=float, default=50)
+    parser.add_argument('--z_crop', type=float, default=None)
+    args = parser.parse_args()
+    makeMask(args.tomo_file, args.mask_file, args.patch_size,
+             args.density_percentage, args.std_percentage, args.z_crop)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+CPU version of IsoNet predict: the tomogram is split in tiles of crop_size
+every cube_size voxels (symmetric padding at the borders, as IsoNet does),
+the tiles are predicted in batches by a pool of threads and the overlapping
+regions are blended back with a smooth window into the memory mapped
+output. Only the tiles in process are loaded.
+
+The model needs tensorflow, so this engine runs within the IsoNet
+environment as a script and only imports numpy and mrcfile at module level:
+
+    python predict.py tomo.mrc model.h5 tomo_corrected.mrc --cube_size 64
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+
+import mrcfile
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Percentiles IsoNet normalizes the tomograms with
+PERCENTILES = (4.0, 96.0)
+# Voxels used to estimate the percentiles of big tomograms
+PERCENTILE_SAMPLE = 2 ** 24
+SLAB_SIZE = 32
+DEFAULT_BATCH = 4
+DEFAULT_THREADS = 4
+# Seconds between progress reports
+REPORT_INTERVAL = 30
+
+
+def loadModel(modelFile, threads=DEFAULT_THREADS):
+    """ Load a trained IsoNet model (.h5) on the CPU and return a function
+    that predicts a batch of tiles (n, size, size, size). The cores are
+    shared among the threads that run batches concurrently. A .tflite model
+    (float16 or quantized, see quantize.py) is run by a TFLite interpreter
+    per thread. """
+    os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+    import tensorflow as tf
+
+    coresPerThread = max(1, (os.cpu_count() or 1) // threads)
+    if modelFile.endswith('.tflite'):
+        return _loadTfliteModel(tf, modelFile, coresPerThread)
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(coresPerThread)
+    except RuntimeError:
+        # TF was already initialized (e.g. by a previous model), its
+        # threads can not be changed any more
+        pass
+    model = tf.keras.models.load_model(modelFile, compile=False)
+
+    def predictBatch(batch):
+        return model(batch[..., np.newaxis], training=False).numpy()[..., 0]
+
+    return predictBatch
+
+
+def _loadTfliteModel(tf, modelFile, coresPerThread):
+    """ TFLite interpreters are not thread safe, every thread gets its own
+    one, resized to the shape of its batches """
+    local = threading.local()
+
+    def predictBatch(batch):
+        batch = np.ascontiguousarray(batch[..., np.newaxis], dtype=np.float32)
+        if getattr(local, 'interpreter', None) is None:
+            local.interpreter = tf.lite.Interpreter(model_path=modelFile,
+                                                    num_threads=coresPerThread)
+            local.shape = None
+        interpreter = local.interpreter
+        inputIndex = interpreter.get_input_details()[0]['index']
+        if local.shape != batch.shape:
+            interpreter.resize_tensor_input(inputIndex, batch.shape)
+            interpreter.allocate_tensors()
+            local.shape = batch.shape
+        interpreter.set_tensor(inputIndex, batch)
+        interpreter.invoke()
+        outputIndex = interpreter.get_output_details()[0]['index']
+        return interpreter.get_tensor(outputIndex)[..., 0]
+
+    return predictBatch
+
+
+def tileWindow(cubeSize, cropSize):
+    """ Separable blending window of a tile: 1 in the center and raised
+    cosine ramps over the overlap with the neighbour tiles. The ramps never
+    reach 0 and, if the overlap is not bigger than cube_size, the ramps of
+    two neighbours add up to 1. """
+    overlap = cropSize - cubeSize
+    profile = np.ones(cropSize, dtype=np.float32)
+    if overlap > 0:
+        x = np.arange(cropSize) + 0.5
+        edge = np.minimum(x, cropSize - x) / overlap
+        profile = (np.sin(np.minimum(1, edge) * np.pi / 2) ** 2).astype(np.float32)
+    return (profile[:, None, None] * profile[None, :, None] *
+            profile[None, None, :])
+
+
+def _symmetricIndexes(start, size, length):
+    """ Indexes of the voxels start:start+size of an axis of the given
+    length padded in 'symmetric' mode """
+    idx = np.arange(start, start + size) % (2 * length)
+    return np.where(idx < length, idx, 2 * length - 1 - idx)
+
+
+def _readPadded(data, starts, size):
+    """ Read a tile of a volume padded in 'symmetric' mode, starting at the
+    given (possibly negative) position """
+    indexes = [_symmetricIndexes(start, size, length)
+               for start, length in zip(starts, data.shape)]
+    region = tuple(slice(idx.min(), idx.max() + 1) for idx in indexes)
+    block = np.asarray(data[region], dtype=np.float32)
+    local = [idx - idx.min() for idx in indexes]
+    return block[np.ix_(*local)]
+
+
+def getNormalization(data, percentile=True, invert=False,
+                     sampleSize=PERCENTILE_SAMPLE):
+    """ Offset and scale IsoNet normalizes a volume (or its inverse) with,
+    (x - offset) * scale: its percentiles to 0 and 1 or, if not percentile,
+    to mean 0 and standard deviation 1. They are estimated from a regular
+    subsample if the volume is bigger than sampleSize voxels. """
+    step = max(1, int(np.ceil((data.size / sampleSize) ** (1 / 3))))
+    sample = np.asarray(data[::step, ::step, ::step], dtype=np.float32)
+    if invert:
+        sample = -sample
+    if percentile:
+        low, high = np.percentile(sample, PERCENTILES)
+        return low, 1.0 / (high - low + 1e-20)
+    return sample.mean(), 1.0 / (sample.std() + 1e-20)
+
+
+def getTileStarts(shape, cubeSize, cropSize):
+    """ Corners of the tiles: one every cube_size voxels, shifted by half of
+    the overlap so the center of the tiles covers the volume """
+    pad = (cropSize - cubeSize) // 2
+    nTiles = [-(-length // cubeSize) for length in shape]
+    return [tuple(i * cubeSize - pad for i in index)
+            for index in product(*[range(n) for n in nTiles])]
+
+
+def predict(tomoFile, outputFile, predictor, cubeSize, cropSize,
+            batchSize=DEFAULT_BATCH, threads=DEFAULT_THREADS,
+            percentile=True, normalization=None):
+    """ Predict a tomogram in overlapping tiles as IsoNet predict does.
+    Params:
+        predictor: function predicting a batch of tiles (see loadModel).
+        cubeSize: distance between the tiles.
+        cropSize: side of the tiles, cubeSize plus the overlap.
+        batchSize: tiles predicted at once by each thread.
+        threads: batches predicted concurrently.
+        percentile: normalize the tomograms to their percentiles (as the
+            model was trained) or to their mean and standard deviation.
+        normalization: offset and scale of the inverted tomogram (see
+            getNormalization), if they were already computed.
+    """
+    if cropSize < cubeSize:
+        raise ValueError("crop_size (%d) must not be smaller than "
+                         "cube_size (%d)" % (cropSize, cubeSize))
+    window = tileWindow(cubeSize, cropSize)
+    weightsFile = outputFile + '.weights'
+
+    with mrcfile.mmap(tomoFile, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        shape = data.shape
+        pixelSize = mrc.voxel_size.copy()
+        # IsoNet predicts the inverted tomogram, normalized
+        if normalization is None:
+            normalization = getNormalization(data, percentile, invert=True)
+        offset, scale = normalization
+
+        starts = getTileStarts(shape, cubeSize, cropSize)
+        batches = [starts[i:i + batchSize]
+                   for i in range(0, len(starts), batchSize)]
+        logger.info("Predicting %s in %d tiles of %d voxels (%d batches, "
+                    "%d threads)" % (tomoFile, len(starts), cropSize,
+                                     len(batches), threads))
+
+        def predictTiles(batch):
+            tiles = np.stack([_readPadded(data, s, cropSize) for s in batch])
+            return predictor((-tiles - offset) * scale)
+
+        weights = np.memmap(weightsFile, dtype=np.float32, mode='w+',
+                            shape=shape)
+        try:
+            with mrcfile.new_mmap(outputFile, shape=shape, mrc_mode=2,
+                                  overwrite=True) as out:
+                out.data[:] = 0
+                _blendTiles(out.data, weights, window, batches, predictTiles,
+                            threads, cropSize)
+
+                # Weighted mean, normalized and inverted back as IsoNet
+                # does with the predicted tomogram
+                for z in range(0, shape[0], SLAB_SIZE):
+                    out.data[z:z + SLAB_SIZE] /= weights[z:z + SLAB_SIZE]
+                outOffset, outScale = getNormalization(out.data, percentile)
+                for z in range(0, shape[0], SLAB_SIZE):
+                    slab = out.data[z:z + SLAB_SIZE]
+                    out.data[z:z + SLAB_SIZE] = -(slab - outOffset) * outScale
+                out.voxel_size = pixelSize
+        finally:
+            del weights
+            os.remove(weightsFile)
+
+
+def _blendTiles(output, weights, window, batches, predictTiles, threads,
+                cropSize):
+    """ Accumulate the windowed tiles and the window in output and weights.
+    Batches are predicted in threads and added in order by the calling
+    thread, so overlapping tiles are never written concurrently. At most
+    2 * threads batches are waiting to be added. """
+    shape = output.shape
+    nTiles = sum(len(batch) for batch in batches)
+    done = 0
+    start = lastReport = time.time()
+
+    def addTiles(batch, tiles):
+        for corner, tile in zip(batch, tiles):
+            target = tuple(slice(max(0, c), min(c + cropSize, length))
+                           for c, length in zip(corner, shape))
+            local = tuple(slice(t.start - c, t.stop - c)
+                          for t, c in zip(target, corner))
+            output[target] += tile[local] * window[local]
+            weights[target] += window[local]
+
+    def addBatch(batch, future):
+        nonlocal done, lastReport
+        addTiles(batch, future.result())
+        done += len(batch)
+        now = time.time()
+        if now - lastReport > REPORT_INTERVAL or done == nTiles:
+            lastReport = now
+            logger.info("Predicted %d/%d tiles, %0.3g voxels/s"
+                        % (done, nTiles,
+                           done * cropSize ** 3 / max(now - start, 1e-6)))
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for batch in batches:
+            pending.append((batch, executor.submit(predictTiles, batch)))
+            if len(pending) >= 2 * threads:
+                addBatch(*pending.popleft())
+        while pending:
+            addBatch(*pending.popleft())
+
+    elapsed = time.time() - start
+    logger.info("Tomogram of %d voxels predicted in %0.1f s (%0.3g voxels/s)"
+                % (np.prod(shape), elapsed,
+                   np.prod(shape) / max(elapsed, 1e-6)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('tomo_file')
+    parser.add_argument('model')
+    parser.add_argument('output_file')
+    parser.add_argument('--cube_size', type=int, default=64)
+    parser.add_argument('--crop_size', type=int, default=None,
+                        help='Default: cube_size + 16')
+    parser.add_argument('--batch_size', type=int, default=DEFAULT_BATCH)
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS)
+    parser.add_argument('--normalize_percentile', default='True',
+                        help='True: normalize to the percentiles, False: to '
+                             'the mean and standard deviation')
+    parser.add_argument('--normalization', type=float, nargs=2, default=None,
+                        metavar=('OFFSET', 'SCALE'),
+                        help='Normalization of the inverted tomogram, '
+                             'computed if not given')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    cropSize = args.crop_size or args.cube_size + 16
+    predict(args.tomo_file, args.output_file,
+            loadModel(args.model, args.threads), args.cube_size, cropSize,
+            args.batch_size, args.threads,
+            args.normalize_percentile.lower() in ['true', '1', 'yes'],
+            args.normalization)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Export of a trained IsoNet model (.h5) to TFLite inference graphs for a
+faster prediction on the CPU with the native predict engine:
+    float16: weights stored as float16.
+    dynamic: int8 weights, activations quantized on the fly.
+    int8: int8 weights and activations, calibrated on a sample of the
+        subtomograms (the operations without int8 kernels stay in float).
+
+Every variant is run on the calibration cubes and compared voxel-wise with
+the float32 model (MSE and correlation) and the results are written to a
+json report next to the model. This engine runs within the IsoNet
+environment as a script:
+
+    python quantize.py model_iter30.h5 cubes.txt --precisions float16,int8
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+import mrcfile
+import numpy as np
+
+try:
+    from .predict import loadModel, getNormalization
+except ImportError:  # Run as a script within the IsoNet environment
+    from predict import loadModel, getNormalization
+
+logger = logging.getLogger(__name__)
+
+FLOAT32 = 'float32'
+FLOAT16 = 'float16'
+DYNAMIC = 'dynamic'
+INT8 = 'int8'
+PRECISIONS = [FLOAT16, DYNAMIC, INT8]
+TFLITE_EXT = '.tflite'
+REPORT_SUFFIX = '_quantization.json'
+BATCH_SIZE = 4
+
+
+def getQuantizedModelFile(modelFile, precision):
+    """ File of a variant of the model, the model itself for float32 """
+    if precision == FLOAT32:
+        return modelFile
+    return os.path.splitext(modelFile)[0] + '_%s%s' % (precision, TFLITE_EXT)
+
+
+def getReportFile(modelFile):
+    return os.path.splitext(modelFile)[0] + REPORT_SUFFIX
+
+
+def readReport(modelFile):
+    """ Return the quantization report of a model, None if there is none """
+    reportFile = getReportFile(modelFile)
+    if not os.path.exists(reportFile):
+        return None
+    with open(reportFile) as f:
+        return json.load(f)
+
+
+def readCube(imageName):
+    """ Read a subtomogram given as a file or as <index>@<stack> """
+    index = None
+    if '@' in imageName:
+        index, imageName = imageName.split('@', 1)
+    with mrcfile.mmap(imageName, mode='r', permissive=True) as mrc:
+        data = mrc.data if index is None else mrc.data[int(index) - 1]
+        return np.array(data, dtype=np.float32)
+
+
+def normalizeCube(cube, percentile=True):
+    """ Inverted and normalized, as the predict engine does with the
+    tomograms """
+    offset, scale = getNormalization(cube, percentile, invert=True)
+    return ((-cube - offset) * scale).astype(np.float32)
+
+
+def convertModel(modelFile, precision, cubes):
+    """ Return the TFLite graph (bytes) of the model with the given
+    precision. The cube size is fixed, the batch size can be changed. """
+    os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+    import tensorflow as tf
+
+    model = tf.keras.models.load_model(modelFile, compile=False)
+    spec = tf.TensorSpec((None,) + cubes.shape[1:] + (1,), tf.float32)
+    function = tf.function(lambda x: model(x, training=False))
+    # Without the trackable object argument, that needs TF 2.7 (IsoNet
+    # installs 2.5)
+    converter = tf.lite.TFLiteConverter.from_concrete_functions(
+        [function.get_concrete_function(spec)])
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if precision == FLOAT16:
+        converter.target_spec.supported_types = [tf.float16]
+    elif precision == INT8:
+        def representativeData():
+            for cube in cubes:
+                yield [cube[np.newaxis, ..., np.newaxis]]
+
+        converter.representative_dataset = representativeData
+        converter.target_spec.supported_ops = [
+            tf.lite.OpsSet.TFLITE_BUILTINS_INT8, tf.lite.OpsSet.TFLITE_BUILTINS]
+    return converter.convert()
+
+
+def runModel(predictor, cubes, batchSize=BATCH_SIZE):
+    """ Return the prediction of the cubes and the seconds it took """
+    start = time.time()
+    output = np.concatenate([predictor(cubes[i:i + batchSize])
+                             for i in range(0, len(cubes), batchSize)])
+    return output, time.time() - start
+
+
+def compareOutputs(reference, output):
+    """ Voxel-wise MSE and correlation of output with the reference """
+    reference = np.asarray(reference, dtype=np.float64).ravel()
+    output = np.asarray(output, dtype=np.float64).ravel()
+    return {'mse': float(np.mean((reference - output) ** 2)),
+            'correlation': float(np.corrcoef(reference, output)[0, 1])}
+
+
+def quantize(modelFile, imageNames, precisions=PRECISIONS, threads=1,
+             percentile=True):
+    """ Export the model with the given precisions and write the report,
+    a dict {precision: {file, size, seconds, mse, correlation}} """
+    cubes = np.stack([normalizeCube(readCube(name), percentile)
+                      for name in imageNames])
+    reference, seconds = runModel(loadModel(modelFile, threads), cubes)
+    report = {FLOAT32: {'file': modelFile, 'seconds': seconds,
+                        'size': os.path.getsize(modelFile)}}
+    logger.info("float32: %0.2f s for %d cubes" % (seconds, len(cubes)))
+
+    for precision in precisions:
+        quantizedFile = getQuantizedModelFile(modelFile, precision)
+        with open(quantizedFile, 'wb') as f:
+            f.write(convertModel(modelFile, precision, cubes))
+        output, seconds = runModel(loadModel(quantizedFile, threads), cubes)
+        report[precision] = dict(compareOutputs(reference, output),
+                                 file=quantizedFile, seconds=seconds,
+                                 size=os.path.getsize(quantizedFile))
+        logger.info("%s: %0.2f s, MSE %0.3g, correlation %0.4f"
+                    % (precision, seconds, report[precision]['mse'],
+                       report[precision]['correlation']))
+
+    with open(getReportFile(modelFile), 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('model')
+    parser.add_argument('cubes', help='Text file with a subtomogram per line '
+                                      '(file or index@stack)')
+    parser.add_argument('--precisions', default=','.join(PRECISIONS))
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--normalize_percentile', default='True')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    with open(args.cubes) as f:
+        imageNames = [line.strip() for line in f if line.strip()]
+    quantize(args.model, imageNames, args.precisions.split(','), args.threads,
+             args.normalize_percentile.lower() in ['true', '1', 'yes'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Resources used by the protocol steps. Every step records its wall time,
+CPU time, peak memory of the programs it launches, bytes read and written
+and throughput in a json file, e.g. to size the cluster queues or to compare
+IsoNet versions.
+
+This file is also the launcher of the monitored programs (it only uses the
+standard library, so it starts fast):
+
+    python monitor.py stats.json "isonet.py deconv tomograms.star ..."
+"""
+import fcntl
+import json
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+MONITOR_SCRIPT = os.path.abspath(__file__)
+
+# Step record fields
+STEP = 'step'
+TSID = 'tsId'
+START = 'start'
+WALL_TIME = 'wallTime'
+CPU_TIME = 'cpuTime'
+MAX_RSS = 'maxRss'
+READ_BYTES = 'readBytes'
+WRITTEN_BYTES = 'writtenBytes'
+TOMOGRAMS = 'tomograms'
+THROUGHPUT = 'throughput'
+JOBS = 'jobs'
+# File where the IsoNet worker client (see worker.py) writes the resources
+# of the forked worker that ran the command
+WORKER_STATS_VAR = 'ISONET_WORKER_STATS'
+
+
+def readIoCounters(ioFile='/proc/thread-self/io'):
+    """ Return the (read, written) bytes of the current thread (or the ones
+    of the given /proc io file), (0, 0) where not available. """
+    counters = dict()
+    try:
+        with open(ioFile) as f:
+            for line in f:
+                key, value = line.split(':')
+                counters[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters.get('rchar', 0), counters.get('wchar', 0)
+
+
+def getMonitorArgs(statsFile, program, args):
+    """ Arguments to run program through the launcher with python """
+    return '%s %s %s' % (MONITOR_SCRIPT, statsFile,
+                         shlex.quote('%s %s' % (program, args)))
+
+
+def readStats(statsFile):
+    """ Return the list of step records of a stats file """
+    if not os.path.exists(statsFile):
+        return []
+    with open(statsFile) as f:
+        return json.load(f)
+
+
+class StepMonitor:
+    """ Context manager that measures a step running in the current thread
+    and appends its record to the stats file. The programs launched from
+    the step report their resources through addJobStats. """
+    _local = threading.local()
+    _lock = threading.Lock()
+
+    def __init__(self, statsFile, tmpFolder, step, tsId=None, tomograms=1):
+        self.statsFile = statsFile
+        self.tmpFolder = tmpFolder
+        self.record = {STEP: step, TSID: tsId, TOMOGRAMS: tomograms,
+                       MAX_RSS: 0, JOBS: 0}
+        self._jobCpu = 0.
+        self._jobRead = 0
+        self._jobWritten = 0
+
+    @classmethod
+    def current(cls):
+        """ Monitor of the step running in this thread, None if any """
+        return getattr(cls._local, 'monitor', None)
+
+    def __enter__(self):
+        self._local.monitor = self
+        self._start = time.time()
+        self._cpu = time.thread_time()
+        self._io = readIoCounters()
+        return self
+
+    def __exit__(self, *exc):
+        self._local.monitor = None
+        wallTime = time.time() - self._start
+        read, written = readIoCounters()
+        self.record.update({
+            START: self._start,
+            WALL_TIME: wallTime,
+            CPU_TIME: time.thread_time() - self._cpu + self._jobCpu,
+            READ_BYTES: read - self._io[0] + self._jobRead,
+            WRITTEN_BYTES: written - self._io[1] + self._jobWritten,
+            THROUGHPUT: self.record[TOMOGRAMS] / wallTime if wallTime else 0})
+        # Steps of other processes (e.g. jobs of a queue) share the file
+        with self._lock, open(self.statsFile + '.lock', 'w') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            records = readStats(self.statsFile)
+            records.append(self.record)
+            with open(self.statsFile + '.tmp', 'w') as f:
+                json.dump(records, f, indent=1)
+            os.replace(self.statsFile + '.tmp', self.statsFile)
+        return False
+
+    def newJobStatsFile(self):
+        return os.path.abspath(os.path.join(self.tmpFolder,
+                                            'job_%s.json' % uuid.uuid4().hex))
+
+    def addJobStats(self, jobStatsFile):
+        """ Accumulate the resources reported by the launcher """
+        if not os.path.exists(jobStatsFile):
+            return
+        with open(jobStatsFile) as f:
+            stats = json.load(f)
+        os.remove(jobStatsFile)
+        self.record[JOBS] += 1
+        self.record[MAX_RSS] = max(self.record[MAX_RSS], stats[MAX_RSS])
+        self._jobCpu += stats[CPU_TIME]
+        self._jobRead += stats[READ_BYTES]
+        self._jobWritten += stats[WRITTEN_BYTES]
+
+
+def getExitCode(status):
+    """ Exit code of a wait status, minus the signal number if it was
+    killed (as os.waitstatus_to_exitcode, that needs python 3.9) """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def main():
+    """ Run a shell command and write the resources it used (including its
+    subprocesses) to a json file. Exit with the command exit code. If the
+    command is run by the IsoNet worker, the resources of the worker are
+    the ones of the command. """
+    statsFile, command = sys.argv[1:3]
+    workerStatsFile = statsFile + '.worker'
+    process = subprocess.Popen(command, shell=True,
+                               env=dict(os.environ,
+                                        **{WORKER_STATS_VAR: workerStatsFile}))
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = getExitCode(status)
+    # Reaped children I/O is added to the one of this process
+    read, written = readIoCounters('/proc/self/io')
+    stats = {CPU_TIME: usage.ru_utime + usage.ru_stime,
+             MAX_RSS: usage.ru_maxrss * 1024,
+             READ_BYTES: read,
+             WRITTEN_BYTES: written}
+    if os.path.exists(workerStatsFile):
+        with open(workerStatsFile) as f:
+            stats = json.load(f)
+        os.remove(workerStatsFile)
+    with open(statsFile, 'w') as f:
+        json.dump(stats, f)
+    sys.exit(process.returncode)
+
+
+if __name__ == '__main__':
+    main()
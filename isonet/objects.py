@@ -0,0 +1,113 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+from pwem.objects import EMFile, EMSet
+from pyworkflow.object import Integer, Float, String, Boolean
+
+# Network hyperparameters stored with the model: attribute -> refine param
+NETWORK_PARAMS = {'_unetDepth': 'unet_depth',
+                  '_filterBase': 'filter_base',
+                  '_convsPerDepth': 'convs_per_depth',
+                  '_kernel': 'kernel',
+                  '_dropOut': 'drop_out',
+                  '_learningRate': 'learning_rate',
+                  '_batchNormalization': 'batch_normalization',
+                  '_pool': 'pool',
+                  '_normalizePercentile': 'normalize_percentile'}
+
+
+class IsoNetModel(EMFile):
+    """ Neural network trained by IsoNet refine (.h5 file) together with
+    the parameters needed to use it for prediction. """
+    def __init__(self, **kwargs):
+        EMFile.__init__(self, **kwargs)
+        self._samplingRate = Float()
+        self._cubeSize = Integer()
+        self._cropSize = Integer()
+        self._iteration = Integer()
+        self._loss = Float()
+        self._unetDepth = Integer()
+        self._filterBase = Integer()
+        self._convsPerDepth = Integer()
+        self._kernel = String()
+        self._dropOut = Float()
+        self._learningRate = Float()
+        self._batchNormalization = Boolean()
+        self._pool = Boolean()
+        self._normalizePercentile = Boolean()
+
+    def getSamplingRate(self):
+        return self._samplingRate.get()
+
+    def setSamplingRate(self, samplingRate):
+        self._samplingRate.set(samplingRate)
+
+    def getCubeSize(self):
+        return self._cubeSize.get()
+
+    def setCubeSize(self, cubeSize):
+        self._cubeSize.set(cubeSize)
+
+    def getCropSize(self):
+        return self._cropSize.get()
+
+    def setCropSize(self, cropSize):
+        self._cropSize.set(cropSize)
+
+    def getIteration(self):
+        return self._iteration.get()
+
+    def setIteration(self, iteration):
+        self._iteration.set(iteration)
+
+    def getLoss(self):
+        """ Training loss of the last epoch, None if unknown """
+        return self._loss.get()
+
+    def setLoss(self, loss):
+        self._loss.set(loss)
+
+    def getNetworkParams(self):
+        """ Return a dict {refineParam: value} with the network
+        hyperparameters used to train the model """
+        return {param: getattr(self, attr).get()
+                for attr, param in NETWORK_PARAMS.items()}
+
+    def setNetworkParams(self, protocol):
+        """ Copy the network hyperparameters from the protocol that trained
+        the model """
+        for attr, param in NETWORK_PARAMS.items():
+            getattr(self, attr).set(getattr(protocol, param).get())
+
+    def __str__(self):
+        return "IsoNet model (iteration %s, cube %s, crop %s, %s A/px)" \
+               % (self.getIteration(), self.getCubeSize(),
+                  self.getCropSize(), self.getSamplingRate())
+
+
+class SetOfIsoNetModels(EMSet):
+    """ Models saved at every refine iteration """
+    ITEM_TYPE = IsoNetModel
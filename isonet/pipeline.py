@@ -0,0 +1,151 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Producer/consumer execution of the tomograms: a pool of producers (e.g. CPU
+preprocessing) feeds a bounded queue that the consumers (e.g. the GPU
+predictor) empty as the tomograms get ready, so both kinds of resources work
+at the same time and the total time approaches the longest of the two
+instead of their sum. The queue depth caps the tomograms produced and still
+waiting to be consumed.
+"""
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DEPTH = 2
+# Seconds between checks of a failure while waiting on the queue
+POLL_INTERVAL = 0.1
+# End of the items and of the queue
+_END = object()
+
+
+class PipelineStats:
+    """ Busy time of the producers and consumers and total time """
+    def __init__(self):
+        self.produceTime = 0.0
+        self.consumeTime = 0.0
+        self.makespan = 0.0
+        self.maxQueued = 0
+        self._lock = threading.Lock()
+
+    def add(self, attr, seconds):
+        with self._lock:
+            setattr(self, attr, getattr(self, attr) + seconds)
+
+    def queued(self, size):
+        with self._lock:
+            self.maxQueued = max(self.maxQueued, size)
+
+    def __str__(self):
+        return ("%0.1f s in total, %0.1f s producing, %0.1f s consuming, "
+                "at most %d waiting" % (self.makespan, self.produceTime,
+                                        self.consumeTime, self.maxQueued))
+
+
+def runPipeline(items, produce, consume, producers=1, consumers=1,
+                depth=DEFAULT_DEPTH):
+    """ Call produce(item) for every item in producers threads and
+    consume(item, result, consumerIndex) in consumers threads as soon as the
+    item is produced. Producers wait when depth items are waiting to be
+    consumed. The first exception stops the pipeline and is raised.
+    Return the PipelineStats. """
+    items = iter(list(items))
+    itemsLock = threading.Lock()
+    ready = queue.Queue(maxsize=max(1, depth))
+    failed = threading.Event()
+    errors = []
+    stats = PipelineStats()
+    start = time.time()
+
+    def put(entry):
+        """ Put in the queue unless the pipeline has failed """
+        while not failed.is_set():
+            try:
+                ready.put(entry, timeout=POLL_INTERVAL)
+                stats.queued(ready.qsize())
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fail(e):
+        errors.append(e)
+        failed.set()
+
+    def producer():
+        while not failed.is_set():
+            with itemsLock:
+                item = next(items, _END)
+            if item is _END:
+                return
+            try:
+                t = time.time()
+                result = produce(item)
+                stats.add('produceTime', time.time() - t)
+            except Exception as e:
+                return fail(e)
+            if not put((item, result)):
+                return
+
+    def consumer(index):
+        while not failed.is_set():
+            try:
+                entry = ready.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if entry is _END:
+                return
+            try:
+                t = time.time()
+                consume(entry[0], entry[1], index)
+                stats.add('consumeTime', time.time() - t)
+            except Exception as e:
+                return fail(e)
+
+    producerThreads = [threading.Thread(target=producer, daemon=True)
+                       for _ in range(max(1, producers))]
+    consumerThreads = [threading.Thread(target=consumer, args=(i,),
+                                        daemon=True)
+                       for i in range(max(1, consumers))]
+    for thread in producerThreads + consumerThreads:
+        thread.start()
+    for thread in producerThreads:
+        thread.join()
+    # One end mark per consumer, after all the items
+    for _ in consumerThreads:
+        put(_END)
+    for thread in consumerThreads:
+        thread.join()
+
+    stats.makespan = time.time() - start
+    if errors:
+        raise errors[0]
+    logger.debug("Pipeline finished: %s" % stats)
+    return stats
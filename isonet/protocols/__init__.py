@@ -1 +1,2 @@
-from .protocol_tomo_reconstruction import ProtIsoNetTomoReconstruction
\ No newline at end of file
+from .protocol_tomo_reconstruction import ProtIsoNetTomoReconstruction
+from .protocol_predict import ProtIsoNetPredict
@@ -0,0 +1,832 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     J.L. Vilas (jlvilas@cnb.csic.es),
+#                Y.C. Fonseca Reyna (cfonseca@cnb.csic.es )
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import functools
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import mrcfile
+from pwem.protocols import EMProtocol
+import pyworkflow.utils as pwutils
+from pyworkflow.object import Set
+from pyworkflow.protocol import params, STEPS_PARALLEL, STATUS_NEW
+
+from tomo.objects import Tomogram, SetOfTomograms
+from tomo.protocols import ProtTomoBase
+from ..constants import *
+from ..convert import (getTomoIndexes, splitTomoStarFile, mergeStarFiles,
+                       writeTomoStarFile, readStarRow, updateStarFile,
+                       splitInShards, selectDefocus, getMrcDimensions,
+                       readSetOfSetsColumns, matchCtfTilts)
+from .. import autotune
+from ..engines.quantize import getQuantizedModelFile
+from ..staging import stageFile
+from ..monitor import (StepMonitor, readStats, STEP, WALL_TIME, CPU_TIME,
+                       MAX_RSS, READ_BYTES, WRITTEN_BYTES, TOMOGRAMS)
+from ..objects import NETWORK_PARAMS
+from isonet import Plugin
+
+
+class ProtIsoNetBase(EMProtocol, ProtTomoBase):
+    """
+    Base class with the steps shared by the IsoNet protocols: preparation
+    of the tomograms, CTF deconvolution, prediction and output creation,
+    both for closed sets and in streaming.
+    """
+    stepsExecutionMode = STEPS_PARALLEL
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineInputParams(self, form):
+        """ Define the input tomograms and the CTF deconvolution params """
+        form.addParam('inputTomograms', params.PointerParam, pointerClass='SetOfTomograms',
+                      label="Tomograms", important=True,
+                      help='Select the input tomogram for restoring the missing wedge. '
+                           'If the set is still open (streaming), the tomograms are '
+                           'predicted as they arrive.')
+
+        form.addParam('inputSetOfCtfTomoSeries', params.PointerParam,
+                      allowsNull=True,
+                      label="CTF tomo series",
+                      pointerClass='SetOfCTFTomoSeries',
+                      help='Select the CTF estimation for the set '
+                           'of tilt-series.')
+
+        form.addParam('snrfalloff', params.FloatParam, default=1.0,
+                      condition='inputSetOfCtfTomoSeries is not None',
+                      label="SNR fall rate",
+                      help='SNR fall rate with the frequency. High values means losing more high frequency.'
+                           'If this value is not set, the program will look for the parameter in the star file.'
+                           'If this value is not set and not found in star file, the default value 1.0 will be used.')
+
+        form.addParam('deconvstrength', params.FloatParam, default=1.0,
+                      condition='inputSetOfCtfTomoSeries is not None',
+                      label="Strength of the deconvolution",
+                      help='SNR fall rate with the frequency. High values means losing more high frequency.'
+                           'If this value is not set, the program will look for the parameter in the star file.'
+                           'If this value is not set and not found in star file, the default value 1.0 will be used.')
+
+        form.addParam('highpassnyquist', params.FloatParam, default=0.02,
+                      condition='inputSetOfCtfTomoSeries is not None',
+                      label="Highpass filter",
+                      help='Highpass filter for at very low frequency. We suggest to keep this default value.')
+
+        form.addParam('chunk_size', params.FloatParam, default=None,
+                      condition='inputSetOfCtfTomoSeries is not None',
+                      allowsNull=True,
+                      label="The overlapping rate",
+                      help='The overlapping rate for adjecent chunks.')
+
+        form.addParam('overlap_rate', params.FloatParam, default=None,
+                      condition='inputSetOfCtfTomoSeries is not None',
+                      allowsNull=True,
+                      label="Highpass filter",
+                      help='Highpass filter for at very low frequency. We suggest to keep this default value.')
+
+        form.addParam('defocusMode', params.EnumParam,
+                      choices=DEFOCUS_MODES,
+                      default=DEFOCUS_NEAREST_ZERO,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      condition='inputSetOfCtfTomoSeries is not None',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Defocus of the tomograms",
+                      help='Nearest to 0: defocus of the tilt closest to 0 '
+                           'degrees of every tilt series.\n'
+                           'Dose weighted: average of the defocus of all the '
+                           'tilts, weighted by exp(-accumulated dose / 30), '
+                           'so the first acquired tilts weight more.')
+
+        form.addParam('deconvEngine', params.EnumParam,
+                      choices=ENGINES,
+                      default=ENGINE_ISONET,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      condition='inputSetOfCtfTomoSeries is not None',
+                      label="Deconvolution backend",
+                      help='IsoNet: run IsoNet deconv.\n'
+                           'Native: deconvolve within the plugin, reading the '
+                           'chunks from the tomogram on disk and processing '
+                           'them in threads with a bounded memory use. If the '
+                           'chunk size is not set, the largest one that fits '
+                           'in memory is used.')
+        form.addParam('deconvMemory', params.FloatParam, default=8,
+                      condition='inputSetOfCtfTomoSeries is not None and '
+                                'deconvEngine==%d' % ENGINE_NATIVE,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Deconvolution memory (GB)",
+                      help='Maximum memory used by the chunks being '
+                           'deconvolved of every tomogram. Bigger chunks '
+                           'are reduced to fit.')
+
+        form.addParam('useCache', params.BooleanParam, default=True,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Reuse deconvolved tomograms and masks?",
+                      help='Deconvolved tomograms and masks are stored in a cache '
+                           'shared by all the runs (see ISONET_CACHE_DIR and '
+                           'ISONET_CACHE_SIZE variables), so they are not computed '
+                           'again when the same tomograms are processed with the '
+                           'same deconvolution and mask parameters.')
+
+    def _defineParallelParams(self, form):
+        form.addParallelSection(threads=4, mpi=1)
+        form.addParam(params.GPU_LIST, params.StringParam, default='0',
+                       label='Choose GPU IDs:', validators=[params.NonEmpty],
+                       help='This argument is necessary. By default, the '
+                            'protocol will attempt to launch on GPU 0. You can '
+                            'override the default allocation by providing a '
+                            'list of which GPUs (0,1,2,3, etc) to use. '
+                            'GPU are separated by ",". For example: "0,1,5"')
+        form.addParam('predictEngine', params.EnumParam,
+                      choices=ENGINES,
+                      default=ENGINE_ISONET,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label="Prediction backend",
+                      help='IsoNet: run IsoNet predict on the GPUs.\n'
+                           'Native: predict on the CPU, splitting every '
+                           'tomogram in overlapping tiles that are predicted '
+                           'in batches by the given threads and blended back '
+                           'with a smooth window. Useful for small tomograms '
+                           'on nodes without GPUs.')
+        form.addParam('modelPrecision', params.EnumParam,
+                      choices=MODEL_PRECISIONS,
+                      default=PRECISION_FLOAT32,
+                      condition='predictEngine==%d' % ENGINE_NATIVE,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Model precision",
+                      help='Variant of the model used by the Native backend: '
+                           'the float32 model or the float16, dynamic or int8 '
+                           'quantized ones exported after the training '
+                           '("Export quantized models?"), faster on the CPU '
+                           'at the cost of some accuracy (see the summary of '
+                           'the training run).')
+        form.addParam('predictShards', params.IntParam, default=None,
+                      allowsNull=True,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Prediction shards",
+                      help='The tomograms are split in this number of groups '
+                           'with a similar size, predicted by independent '
+                           'steps. The GPUs are shared out among the groups. '
+                           'If not set, there is a group per GPU (IsoNet '
+                           'backend) or a single one (Native backend). '
+                           'Groups run concurrently up to the number of '
+                           'threads and, if the jobs are sent to a queue, '
+                           'every group is a job that can run in its own '
+                           'node.')
+        form.addParam('deviceMemory', params.FloatParam, default=8,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Memory per device (GB)",
+                      help='Memory of every GPU (or the host memory of the '
+                           'Native prediction backend) used to choose the '
+                           'batch size when it is not set: the largest batch '
+                           'whose estimated UNet memory fits is used.')
+
+    # --------------------------- STEPS functions ------------------------------
+    def _insertFunctionStep(self, func, *funcArgs, **kwargs):
+        """ Every step is run through the step monitor, that records the
+        resources it uses """
+        if isinstance(func, str):
+            func = getattr(self, func)
+        return EMProtocol._insertFunctionStep(self, self._monitorStep(func),
+                                              *funcArgs, **kwargs)
+
+    def _monitorStep(self, func):
+        @functools.wraps(func)
+        def monitoredStep(*args):
+            # Steps of a single tomogram receive its tsId first and the
+            # ones of a shard its list of tsIds
+            tsId = args[0] if args and isinstance(args[0], str) else None
+            if args and isinstance(args[0], list):
+                tomograms = len(args[0])
+            else:
+                tomograms = 1 if tsId else len(self.getTomoIndexes())
+            with StepMonitor(self.getStatsFile(), self._getTmpPath(),
+                             func.__name__, tsId, tomograms):
+                return func(*args)
+        return monitoredStep
+
+    def _insertPredictSteps(self, deps):
+        """ Insert a prediction step per shard of tomograms (see
+        getPredictShards) and return their ids """
+        return [self._insertFunctionStep(self.predictShardStep, tsIds, gpuIds,
+                                         prerequisites=deps)
+                for tsIds, gpuIds in self.getPredictShards()]
+
+    def _insertStreamingSteps(self):
+        """ Insert the steps of the tomograms available so far. The rest are
+        inserted by _checkNewInput as they arrive """
+        self.insertedTsIds = []
+        newTomos, self.streamClosed = self._loadInputTomograms()
+        stepIds = self._insertNewTomoSteps(newTomos)
+        self._insertFunctionStep(self.createOutputStep,
+                                 prerequisites=stepIds, wait=True)
+
+    def _insertTomoPreprocessSteps(self, tsId, deps):
+        """ Insert the steps a tomogram needs to be predicted (its
+        deconvolution, if there are CTFs) and return the ids of the steps
+        that must finish before the next one """
+        if self.inputSetOfCtfTomoSeries.get() is not None:
+            deps = [self._insertFunctionStep(self.ctfDeconvolveStep, tsId,
+                                             prerequisites=deps)]
+        return deps
+
+    def _preprocessTomo(self, tsId):
+        """ Deconvolve a tomogram within the calling step, as the steps of
+        _insertTomoPreprocessSteps do. With the Native backend, return the
+        normalization of the tomogram to be predicted, so it is computed
+        here and not by the predictor. IsoNet predict always normalizes the
+        tomograms itself. """
+        if self.inputSetOfCtfTomoSeries.get() is not None:
+            self.ctfDeconvolveStep(tsId)
+        if self.predictEngine.get() == ENGINE_NATIVE:
+            from ..engines.predict import getNormalization
+            with mrcfile.mmap(self._getPredictInputFile(tsId), mode='r',
+                              permissive=True) as mrc:
+                return getNormalization(mrc.data,
+                                        self.getNormalizePercentile(),
+                                        invert=True)
+
+    def _insertNewTomoSteps(self, newTomos):
+        stepIds = []
+        for tsId, tomoFile in newTomos:
+            self.insertedTsIds.append(tsId)
+            deps = [self._insertFunctionStep(self.prepareTomoStep, tsId,
+                                             tomoFile, len(self.insertedTsIds),
+                                             prerequisites=[])]
+            deps = self._insertTomoPreprocessSteps(tsId, deps)
+            stepIds.append(self._insertFunctionStep(self.predictStep, tsId,
+                                                    prerequisites=deps))
+        return stepIds
+
+    def _stepsCheck(self):
+        # In streaming we need to detect:
+        #   1) new tomograms ready to be processed
+        #   2) predicted tomograms that have to be added to the output set
+        if getattr(self, 'streamingModeOn', False):
+            self._checkNewInput()
+            self._checkNewOutput()
+
+    def _checkNewInput(self):
+        tomoFile = self.inputTomograms.get().getFileName()
+        now = datetime.now()
+        self.lastCheck = getattr(self, 'lastCheck', now)
+        mTime = datetime.fromtimestamp(os.path.getmtime(tomoFile))
+        # If the input tomograms.sqlite have not changed since our last check,
+        # it does not make sense to check for new input data
+        if self.lastCheck > mTime:
+            return None
+        self.lastCheck = now
+
+        newTomos, self.streamClosed = self._loadInputTomograms()
+
+        if newTomos:
+            fDeps = self._insertNewTomoSteps(newTomos)
+            outputStep = self._getFirstJoinStep()
+            if outputStep is not None:
+                outputStep.addPrerequisites(*fDeps)
+            self.updateSteps()
+
+    def _checkNewOutput(self):
+        if getattr(self, 'finished', False):
+            return
+
+        doneFiles = pwutils.glob(self._getTmpPath('*' + PREDICTED_DONE_SUFFIX))
+        # Tomograms whose prediction was not found count as processed, so
+        # the set is closed
+        self.missingTsIds = getattr(self, 'missingTsIds', [])
+        outputSize = len(doneFiles) + len(self.missingTsIds)
+        if self.hasAttribute('outputTomograms'):
+            outputSize += self.outputTomograms.getSize()
+
+        self.finished = self.streamClosed and \
+                        outputSize == len(self.insertedTsIds)
+        streamMode = Set.STREAM_CLOSED if self.finished else Set.STREAM_OPEN
+
+        lastToClose = self.finished and self.hasAttribute('outputTomograms')
+        if doneFiles or lastToClose:
+            tomoSet = self._loadOutputSet()
+            self.missingTsIds += self._appendOutputTomograms(
+                tomoSet, [os.path.basename(f)[:-len(PREDICTED_DONE_SUFFIX)]
+                          for f in doneFiles])
+            for doneFile in doneFiles:
+                pwutils.cleanPath(doneFile)
+            self._updateOutputSet('outputTomograms', tomoSet, state=streamMode)
+
+        if self.finished and self.missingTsIds:
+            self.warning("The output set was closed without the tomograms "
+                         "whose prediction was not found: %s"
+                         % ', '.join(self.missingTsIds))
+        if self.finished:  # Unlock createOutputStep if finished all jobs
+            outputStep = self._getFirstJoinStep()
+            if outputStep and outputStep.isWaiting():
+                outputStep.setStatus(STATUS_NEW)
+
+    def _loadInputTomograms(self):
+        """ Return the (tsId, fileName) of the input tomograms that have not
+        been inserted yet and whether the input set is closed """
+        tomoSet = SetOfTomograms(filename=self.inputTomograms.get().getFileName())
+        tomoSet.loadAllProperties()
+        newTomos = [(tomo.getTsId(), os.path.abspath(tomo.getFileName()))
+                    for tomo in tomoSet
+                    if tomo.getTsId() not in self.insertedTsIds]
+        streamClosed = tomoSet.isStreamClosed()
+        tomoSet.close()
+        return newTomos, streamClosed
+
+    def _loadOutputSet(self):
+        setFile = self._getPath('tomograms.sqlite')
+        if os.path.exists(setFile):
+            outputSet = SetOfTomograms(filename=setFile)
+            outputSet.loadAllProperties()
+            outputSet.enableAppend()
+        else:
+            outputSet = self._createSetOfTomograms()
+            outputSet.copyInfo(self.inputTomograms.get())
+            outputSet.setStreamState(outputSet.STREAM_OPEN)
+            self._store(outputSet)
+            self._defineSourceRelation(self.inputTomograms, outputSet)
+        return outputSet
+
+    def _getFirstJoinStep(self):
+        for s in self._steps:
+            if s.funcName == 'createOutputStep':
+                return s
+        return None
+
+    def _initialize(self):
+        self.tomoPath = os.path.abspath(self._getExtraPath(TOMOGRAMFOLDER))
+        self.tomoStarFileName = os.path.join(self.tomoPath, OUTPUT_TOMO_STAR_FILE)
+        self.tomoStarFolder = os.path.join(self.tomoPath, TOMOSTARFOLDER)
+        self.featuresFolder = os.path.join(self.tomoPath, FEATURESFOLDER)
+        self.maskPath = os.path.abspath(os.path.join(self.tomoPath, MASKFOLDER))
+        self.deconvFolder = os.path.abspath(os.path.join(self.tomoPath, DECONVFOLDER))
+        self.subtomoPath = os.path.abspath(os.path.join(self.tomoPath, SUBTOMOGRAMFOLDER))
+        self.subtomoStarFile = os.path.abspath(os.path.join(self.tomoPath, OUTPUT_SUBTOMO_STAR_FILE))
+        self.resultsFolder = os.path.join(self.tomoPath, RESULTFOLDER)
+        self.predictFolder = os.path.join(self.tomoPath, PREDICTEDFOLDER)
+
+    def prepareProjectStep(self):
+        """
+        Generates a subtomo star file from a set of subtomogram (.mrc)
+        and split it in one star file per tomogram
+        """
+        if not os.path.exists(self.tomoPath):
+            os.mkdir(self.tomoPath)
+        for tomo in self.inputTomograms.get():
+            tomofn = os.path.abspath(tomo.getFileName())
+            tomoName = tomo.getTsId()
+            stageFile(tomofn, os.path.join(self.tomoPath, tomoName + '.mrc'))
+
+        pixel_size = self.inputTomograms.get().getSamplingRate()
+
+        args = '%s --output_star %s --pixel_size %f --defocus %f --number_subtomos %d' \
+               %(self.tomoPath, self.tomoStarFileName, pixel_size, 0.0,
+                 self.getNumberSubtomos())
+
+        Plugin.runIsoNet(self, Plugin.getProgram(PROGRAM_PREPARE_STAR), args=args)
+
+        if not os.path.exists(self.tomoStarFolder):
+            os.mkdir(self.tomoStarFolder)
+        defocusValues = None
+        if self.inputSetOfCtfTomoSeries.get() is not None:
+            defocusValues = self.getDefocusValues()
+        splitTomoStarFile(self.tomoStarFileName, self.tomoStarFolder,
+                          self.getTomoIndexes(), defocusValues)
+
+    def prepareTomoStep(self, tsId, tomoFile, index):
+        """
+        Link a tomogram arrived in streaming and write its star file
+        """
+        os.makedirs(self.tomoStarFolder, exist_ok=True)
+        tomoLnName = self.getTomoFile(tsId)
+        stageFile(tomoFile, tomoLnName)
+
+        defocus = 0.0
+        if self.inputSetOfCtfTomoSeries.get() is not None:
+            defocus = self.getDefocusValues()[tsId]
+
+        writeTomoStarFile(self.getTomoStarFile(tsId), index, tomoLnName,
+                          self.inputTomograms.get().getSamplingRate(),
+                          defocus, self.getNumberSubtomos())
+
+    def ctfDeconvolveStep(self, tsId):
+        """
+        CTF deconvolution for the tomograms.
+
+        isonet.py deconv star_file [--deconv_folder] [--snrfalloff] [--deconvstrength] [--highpassnyquist] [--overlap_rate] [--ncpu] [--tomo_idx]
+        This step is recommanded because it enhances low resolution information for a better contrast. No need to do deconvolution for phase plate data.
+        """
+        if not os.path.exists(self.deconvFolder):
+            os.makedirs(self.deconvFolder, exist_ok=True)
+
+        if self.useCache.get():
+            cacheKey = self._getDeconvCacheKey(tsId)
+            if Plugin.getCache().fetch(cacheKey, self.getDeconvFile(tsId)):
+                updateStarFile(self.getTomoStarFile(tsId),
+                               rlnSnrFalloff=self.snrfalloff.get(),
+                               rlnDeconvStrength=self.deconvstrength.get(),
+                               rlnDeconvTomoName=self.getDeconvFile(tsId))
+                return
+
+        if self.deconvEngine.get() == ENGINE_NATIVE:
+            self._nativeDeconvolve(tsId)
+        else:
+            args = '%s --deconv_folder %s --snrfalloff %f --deconvstrength %f --highpassnyquist %f --ncpu %d ' \
+                   % (self.getTomoStarFile(tsId),
+                      self.deconvFolder,
+                      self.snrfalloff.get(),
+                      self.deconvstrength.get(),
+                      self.highpassnyquist.get(),
+                      self.numberOfMpi.get())
+
+            chunk_size = self.chunk_size.get()
+            if chunk_size is not None:
+                args += '--chunk_size %d ' % chunk_size
+
+            overlap_rate = self.overlap_rate.get()
+            if overlap_rate is not None:
+                args += '--overlap_rate %f ' % overlap_rate
+
+            Plugin.runIsoNet(self, Plugin.getProgram(PROGRAM_CTF_DECONV), args=args)
+
+        if self.useCache.get():
+            Plugin.getCache().store(cacheKey, self.getDeconvFile(tsId))
+
+    def _nativeDeconvolve(self, tsId):
+        """ Deconvolve a tomogram with the native engine and register it in
+        the tomogram star file, as deconv does """
+        tomoRow = readStarRow(self.getTomoStarFile(tsId))
+        args = '%s %s --pixel_size %f --defocus %f --snrfalloff %f ' \
+               '--deconvstrength %f --highpassnyquist %f --memory %f ' \
+               '--threads %d ' \
+               % (self.getTomoFile(tsId), self.getDeconvFile(tsId),
+                  tomoRow.get('rlnPixelSize'),
+                  tomoRow.get('rlnDefocus'),
+                  self.snrfalloff.get(),
+                  self.deconvstrength.get(),
+                  self.highpassnyquist.get(),
+                  self.deconvMemory.get(),
+                  self.numberOfThreads.get())
+
+        if self.chunk_size.get() is not None:
+            args += '--chunk_size %d ' % self.chunk_size.get()
+        if self.overlap_rate.get() is not None:
+            args += '--overlap_rate %f ' % self.overlap_rate.get()
+
+        Plugin.runEngine(self, ENGINE_DECONV, args)
+        updateStarFile(self.getTomoStarFile(tsId),
+                       rlnSnrFalloff=self.snrfalloff.get(),
+                       rlnDeconvStrength=self.deconvstrength.get(),
+                       rlnDeconvTomoName=self.getDeconvFile(tsId))
+
+    def getDefocusValues(self):
+        """ Return a dict {tsId: defocus} with the defocus of every tilt
+        series (see selectDefocus). It is computed once and kept by the
+        protocol, all the steps share it. """
+        with self._getDefocusLock():
+            if getattr(self, '_defocusValues', None) is None:
+                doseWeighted = self.defocusMode.get() == DEFOCUS_DOSE_WEIGHTED
+                self._defocusValues = {
+                    tsId: selectDefocus(tilts, doseWeighted)
+                    for tsId, tilts in self._getCtfTiltIndex().items()}
+        return self._defocusValues
+
+    def _getDefocusLock(self):
+        # Created on first use, the protocol is built from its database
+        return self.__dict__.setdefault('_defocusLock', threading.Lock())
+
+    def _getCtfTiltIndex(self):
+        """ Return a dict {tsId: [(tiltAngle, defocus, accumDose)]} matching
+        the CTF of every tilt with the tilt image of its own series (see
+        matchCtfTilts). Only the needed columns of the tilt series and CTF
+        sets are read, with a few queries for all the series. """
+        setOfCtfTomoSeries = self.inputSetOfCtfTomoSeries.get()
+        tilts = readSetOfSetsColumns(
+            setOfCtfTomoSeries.getSetOfTiltSeries().getFileName(), '_tsId',
+            ['_tiltAngle', '_acquisition._accumDose', '_acqOrder', '_index'])
+        ctfs = readSetOfSetsColumns(setOfCtfTomoSeries.getFileName(), '_tsId',
+                                    ['_defocusU', '_acqOrder', '_index'])
+        return {tsId: matchCtfTilts(tilts.get(tsId, []), seriesCtfs)
+                for tsId, seriesCtfs in ctfs.items()}
+
+    def mergeStarFilesStep(self):
+        """
+        Join the star files of every tomogram in the tomograms star file
+        """
+        mergeStarFiles([self.getTomoStarFile(tsId)
+                        for tsId in self.getTomoIndexes().values()],
+                       self.tomoStarFileName)
+
+    def predictStep(self, tsId):
+        """
+        Predict a tomogram arrived in streaming with the pretrained model
+        isonet.py predict star_file model [--gpuID] [--output_dir] [--cube_size] [--crop_size] [--batch_size]
+        """
+        os.makedirs(self.predictFolder, exist_ok=True)
+        if self.predictEngine.get() == ENGINE_NATIVE:
+            self._nativePredict(tsId)
+        else:
+            self._isoNetPredict(self.getTomoStarFile(tsId), self.getGpuList())
+
+        if not os.path.exists(self.getPredictedFile(tsId)):
+            raise Exception("The predicted tomogram of %s was not written"
+                            % tsId)
+        # Let _checkNewOutput know this tomogram is ready
+        open(self._getTmpPath(tsId + PREDICTED_DONE_SUFFIX), 'w').close()
+
+    def predictShardStep(self, tsIds, gpuIds):
+        """
+        Predict a shard of the tomograms on the given GPUs (comma separated)
+        """
+        os.makedirs(self.predictFolder, exist_ok=True)
+        if self.predictEngine.get() == ENGINE_NATIVE:
+            for tsId in tsIds:
+                self._nativePredict(tsId)
+            return
+
+        shardStarFile = self._getTmpPath('predict_%s.star' % tsIds[0])
+        mergeStarFiles([self.getTomoStarFile(tsId) for tsId in tsIds],
+                       shardStarFile)
+        self._isoNetPredict(shardStarFile,
+                            [int(gpu) for gpu in gpuIds.split(',')])
+
+    def _isoNetPredict(self, starFile, gpuList):
+        """ Predict the tomograms of a star file with isonet.py predict """
+        batch_size = self.getBatchSize(self.getCropSize(), len(gpuList))
+
+        args = '%s %s --gpuID %s --batch_size %d --output_dir %s ' \
+               % (starFile,
+                  self.getModelPath(),
+                  ','.join(str(gpu) for gpu in gpuList),
+                  batch_size,
+                  self.predictFolder)
+
+        args += '--cube_size %d ' % self.getCubeSize()
+        args += '--crop_size %d ' % self.getCropSize()
+
+        if not self.getNormalizePercentile():
+            args += '--normalize_percentile False '
+
+        if self.inputSetOfCtfTomoSeries.get() is not None:
+            args += '--use_deconv_tomo True'
+
+        Plugin.runIsoNet(self, Plugin.getProgram(PROGRAM_PREDICT),
+                         args=args)
+
+    def _nativePredict(self, tsId, normalization=None):
+        """ Predict a tomogram on the CPU with the native engine, that runs
+        within the IsoNet environment to load the model. The normalization
+        (offset, scale) of the tomogram is computed by the engine if it is
+        not given. """
+        tomoFile = self._getPredictInputFile(tsId)
+        threads = self.numberOfThreads.get()
+        # Every thread predicts its own batch in the host memory
+        batch_size = self.getBatchSize(self.getCropSize(), 1,
+                                       memory=self.deviceMemory.get() / threads)
+        args = '%s %s %s --cube_size %d --crop_size %d --batch_size %d ' \
+               '--threads %d --normalize_percentile %s ' \
+               % (tomoFile, self.getPredictModelPath(),
+                  self.getPredictedFile(tsId),
+                  self.getCubeSize(), self.getCropSize(), batch_size, threads,
+                  self.getNormalizePercentile())
+        if normalization is not None:
+            args += '--normalization %r %r ' % tuple(float(value) for value
+                                                     in normalization)
+
+        Plugin.runIsoNet(self, Plugin.getEngineProgram(ENGINE_PREDICT), args)
+
+    def createOutputStep(self):
+        if self.streamingModeOn:
+            # The output set is filled in _checkNewOutput
+            return
+        tomoSet = self._createSetOfTomograms()
+        tomoSet.copyInfo(self.inputTomograms.get())
+        self._appendOutputTomograms(tomoSet, self.getTomoIndexes().values())
+
+        self._defineOutputs(outputTomograms=tomoSet)
+        self._defineSourceRelation(self.inputTomograms, tomoSet)
+
+    def _appendOutputTomograms(self, tomoSet, tsIds):
+        """ Add the predicted tomograms of the given tsIds to the output set,
+        with the metadata of their input tomograms. The dimensions of the
+        set are read from the header of the first one. Return the tsIds
+        whose predicted tomogram was not found. """
+        tsIds = list(tsIds)
+        inputTomos = self._getInputTomograms(tsIds)
+        missingTsIds = []
+        for tsId in tsIds:
+            location = self.getPredictedFile(tsId)
+            if tsId not in inputTomos or not os.path.exists(location):
+                self.warning("The predicted tomogram of %s was not found"
+                             % tsId)
+                missingTsIds.append(tsId)
+                continue
+            if tomoSet.getSize() == 0:
+                tomoSet.setDim(getMrcDimensions(location))
+            tomoSet.append(self._createOutputTomogram(inputTomos[tsId],
+                                                      location))
+        return missingTsIds
+
+    # --------------------------- UTILS functions ----------------------------
+    def getTomoIndexes(self):
+        """ Return a dict {rlnIndex: tsId} with the tomograms to process """
+        tsIds = [tomo.getTsId() for tomo in self.inputTomograms.get()]
+        return getTomoIndexes(tsIds, self.tomo_idx.get())
+
+    def getPredictShards(self):
+        """ Return the (tsIds, gpuIds) of every prediction shard: the
+        tomograms are balanced by file size and the GPUs are dealt out among
+        the shards (shared if there are more shards than GPUs) """
+        gpuList = self.getGpuList()
+        numberOfShards = self.predictShards.get()
+        if numberOfShards is None:
+            native = self.predictEngine.get() == ENGINE_NATIVE
+            numberOfShards = 1 if native else len(gpuList)
+        fileNames = {tomo.getTsId(): tomo.getFileName()
+                     for tomo in self.inputTomograms.get()}
+        sizes = OrderedDict((tsId, os.path.getsize(fileNames[tsId]))
+                            for tsId in self.getTomoIndexes().values())
+        shards = splitInShards(sizes, numberOfShards)
+        predictShards = []
+        for i, tsIds in enumerate(shards):
+            gpus = gpuList[i::len(shards)] or [gpuList[i % len(gpuList)]]
+            predictShards.append((tsIds, ','.join(str(gpu) for gpu in gpus)))
+        return predictShards
+
+    def getPredictModelPath(self):
+        """ Model used by the native prediction: the model or its variant
+        with the chosen precision """
+        precision = MODEL_PRECISIONS[self.modelPrecision.get()]
+        return getQuantizedModelFile(self.getModelPath(), precision)
+
+    def getNetworkParams(self):
+        """ Return the hyperparameters of the network used, as a dict
+        {refineParam: value} """
+        return {param: getattr(self, param).get()
+                for param in NETWORK_PARAMS.values() if hasattr(self, param)}
+
+    def getNormalizePercentile(self):
+        """ Whether the tomograms are normalized to their percentiles, as
+        the network was trained (True if unknown) """
+        return self.getNetworkParams().get('normalize_percentile') is not False
+
+    def getBatchSize(self, size, devices, training=False, memory=None):
+        """ Return the batch size given by the user or, if it is not set,
+        the largest one that fits in the memory (GB) of every device """
+        batchSize = self.batch_size.get()
+        if batchSize is not None:
+            return batchSize
+        memory = self.deviceMemory.get() if memory is None else memory
+        batchSize = autotune.getBatchSize(memory * 1024 ** 3, size,
+                                          self.getNetworkParams(), training,
+                                          devices)
+        self.info("Batch size set to %d for %s cubes of %d voxels on %d "
+                  "device(s) with %0.1f GB each"
+                  % (batchSize, 'training' if training else 'predicting',
+                     size, devices, memory))
+        return batchSize
+
+    def getStatsFile(self):
+        return self._getExtraPath(STEP_STATS_FILE)
+
+    def _statsSummary(self):
+        """ Summarize the time and resources used by every kind of step """
+        steps = OrderedDict()
+        for record in readStats(self.getStatsFile()):
+            steps.setdefault(record[STEP], []).append(record)
+
+        summary = []
+        for step, records in steps.items():
+            wallTime = sum(r[WALL_TIME] for r in records)
+            tomograms = sum(r[TOMOGRAMS] for r in records)
+            line = "%s: %d run(s), %0.1f s wall, %0.1f s CPU, peak %0.2f GB, " \
+                   "%0.2f GB read, %0.2f GB written" \
+                   % (step, len(records), wallTime,
+                      sum(r[CPU_TIME] for r in records),
+                      max(r[MAX_RSS] for r in records) / 1024 ** 3,
+                      sum(r[READ_BYTES] for r in records) / 1024 ** 3,
+                      sum(r[WRITTEN_BYTES] for r in records) / 1024 ** 3)
+            if tomograms:
+                line += ", %0.1f s/tomogram" % (wallTime / tomograms)
+            summary.append(line)
+        return summary
+
+    def getPredictedFile(self, tsId):
+        return os.path.join(self.predictFolder, tsId + PREDICTED_SUFFIX + '.mrc')
+
+    def _getInputTomograms(self, tsIds):
+        """ Return a dict {tsId: Tomogram} with the input tomograms of the
+        given tsIds, read in a single pass over the input set (reloaded, it
+        can be in streaming) """
+        tsIds = set(tsIds)
+        tomoSet = SetOfTomograms(filename=self.inputTomograms.get().getFileName())
+        inputTomos = {tomo.getTsId(): tomo.clone() for tomo in tomoSet
+                      if tomo.getTsId() in tsIds}
+        tomoSet.close()
+        return inputTomos
+
+    def _createOutputTomogram(self, inputTomo, location):
+        """ The predicted tomogram keeps the tsId, origin, acquisition and
+        the rest of the metadata of its input tomogram """
+        tomo = Tomogram()
+        tomo.copy(inputTomo, copyId=False)
+        tomo.setLocation(location)
+        return tomo
+
+    def getTomoFile(self, tsId):
+        return os.path.join(self.tomoPath, tsId + '.mrc')
+
+    def getDeconvFile(self, tsId):
+        return os.path.join(self.deconvFolder, tsId + '.mrc')
+
+    def _getPredictInputFile(self, tsId):
+        """ Tomogram predicted: the deconvolved one if there are CTFs """
+        if self.inputSetOfCtfTomoSeries.get() is not None:
+            return self.getDeconvFile(tsId)
+        return self.getTomoFile(tsId)
+
+    def _getDeconvCacheKey(self, tsId):
+        """ Only the parameters that change the deconvolved tomogram are
+        part of the key. The memory of the native engine only matters
+        through the chunk size it chooses; the engine stays, the two
+        implementations do not give identical volumes. """
+        cache = Plugin.getCache()
+        tomoRow = readStarRow(self.getTomoStarFile(tsId))
+        chunkSize = self.chunk_size.get()
+        if self.deconvEngine.get() == ENGINE_NATIVE:
+            from ..engines.deconv import getChunkSize, DEFAULT_OVERLAP
+            overlap = self.overlap_rate.get()
+            chunkSize, _ = getChunkSize(
+                chunkSize and int(chunkSize),
+                DEFAULT_OVERLAP if overlap is None else overlap,
+                int(self.deconvMemory.get() * 1024 ** 3), 1)
+        return cache.getKey(cache.checksum(self.getTomoFile(tsId)),
+                            PROGRAM_CTF_DECONV,
+                            ENGINES[self.deconvEngine.get()],
+                            tomoRow.get('rlnPixelSize'),
+                            tomoRow.get('rlnDefocus'),
+                            self.snrfalloff.get(),
+                            self.deconvstrength.get(),
+                            self.highpassnyquist.get(),
+                            chunkSize,
+                            self.overlap_rate.get())
+
+    def getTomoStarFile(self, tsId):
+        return os.path.join(self.tomoStarFolder, tsId + '.star')
+
+    def getNumberSubtomos(self):
+        """ Number of subtomograms to extract per tomogram (rlnNumberSubtomo) """
+        return 0
+
+    def getModelPath(self):
+        """ Return the model used to predict the tomograms """
+        raise NotImplementedError
+
+    def getCubeSize(self):
+        cube_size = self.cube_size.get()
+        if cube_size is None:
+            cube_size = 8
+            logging.info("Setting cube_size parameter to %d" % cube_size)
+        return cube_size
+
+    def getCropSize(self):
+        crop_size = self.crop_size.get()
+        if crop_size is None:
+            crop_size = self.getCubeSize() + 16
+            logging.info("Setting crop_size parameter to %d" % crop_size)
+        return crop_size
+
+    def _validate(self):
+        msg = []
+        cube_size = self.cube_size.get()
+        if cube_size is not None and cube_size % 8 != 0:
+            msg.append("The size of cubes parameter must be a multiple of 8")
+        if self.predictEngine.get() != ENGINE_NATIVE and \
+                self.modelPrecision.get() != PRECISION_FLOAT32:
+            msg.append("Only the Native prediction backend can use the "
+                       "quantized models")
+        return msg
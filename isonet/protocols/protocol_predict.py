@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     J.L. Vilas (jlvilas@cnb.csic.es),
+#                Y.C. Fonseca Reyna (cfonseca@cnb.csic.es )
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+
+from pyworkflow.constants import BETA
+from pyworkflow.protocol import params
+
+from ..constants import ENGINE_NATIVE, MODEL_PRECISIONS, PRECISION_FLOAT32
+from ..pipeline import runPipeline
+from .protocol_base import ProtIsoNetBase
+
+
+class ProtIsoNetPredict(ProtIsoNetBase):
+    """
+     Restore the missing wedge of a set of tomograms with an already trained
+     IsoNet model, without extracting subtomograms nor training.
+    """
+    _label = 'predict'
+    _devStatus = BETA
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+
+        self._defineInputParams(form)
+
+        form.addParam('tomo_idx', params.StringParam, default=None,
+                      label="Tomo index",
+                      help=' If this value is set, process only the tomograms listed in this index. e.g. 1,2,4 or 5-10,15,16')
+
+        form.addSection("Model")
+        form.addParam('inputModel', params.PointerParam,
+                      pointerClass='IsoNetModel',
+                      allowsNull=True,
+                      label="Trained model",
+                      help='Model trained by an IsoNet tomo reconstruction run '
+                           'that will be used to predict the tomograms.')
+        form.addParam('modelFile', params.PathParam,
+                      condition='inputModel is None',
+                      label="Model path",
+                      help='A trained neural network model in ".h5" format.')
+
+        form.addParam('cube_size', params.IntParam, default=None,
+                      allowsNull=True,
+                      label="Size of cubes",
+                      help='Size of the cubes the tomograms are split in to be '
+                           'predicted, should be divisible by 8. If not set, the '
+                           'one used to train the model is used (or 8 if the '
+                           'model is given by path).')
+        form.addParam('crop_size', params.IntParam, default=None,
+                      allowsNull=True,
+                      label="Crop size",
+                      help='The size of the cubes plus the overlapping region. '
+                           'If not set, the one used to train the model is used '
+                           '(or cube_size + 16 if the model is given by path).')
+        form.addParam('batch_size', params.IntParam, default=None,
+                      label='Batch size',
+                      allowsNull=True,
+                      help='Size of the minibatch. If None, the largest one '
+                           'whose estimated memory fits in the memory per '
+                           'device (Computation tab) is used. batch_size '
+                           'should be divisible by the number of gpu.')
+
+        self._defineParallelParams(form)
+        form.addParam('usePipeline', params.BooleanParam, default=False,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Pipeline preprocessing and prediction?",
+                      help='Deconvolve the tomograms in a pool of CPU workers '
+                           '(and, with the Native backend, compute their '
+                           'normalization) and predict every one as soon as '
+                           'it is ready '
+                           '(one predictor per GPU, or a single one with the '
+                           'Native backend), instead of predicting after all '
+                           'the tomograms are deconvolved. The GPUs and CPUs '
+                           'work at the same time. Not used in streaming.')
+        form.addParam('pipelineDepth', params.IntParam, default=2,
+                      condition='usePipeline',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Pipeline queue depth",
+                      help='Maximum number of deconvolved tomograms waiting '
+                           'to be predicted. The workers wait when the queue '
+                           'is full, which caps the memory and scratch '
+                           'space used.')
+        form.addParam('pipelineWorkers', params.IntParam, default=2,
+                      condition='usePipeline',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Preprocessing workers",
+                      help='Tomograms deconvolved at the same time.')
+
+    # --------------------------- STEPS functions ------------------------------
+    def _insertAllSteps(self):
+        self._initialize()
+        self.streamingModeOn = self.inputTomograms.get().isStreamOpen()
+
+        if self.streamingModeOn:
+            self._insertStreamingSteps()
+            return
+
+        prepareId = self._insertFunctionStep(self.prepareProjectStep)
+        if self.usePipeline.get():
+            pipelineId = self._insertFunctionStep(
+                self.pipelineStep, list(self.getTomoIndexes().values()),
+                prerequisites=[prepareId])
+            self._insertFunctionStep(self.createOutputStep,
+                                     prerequisites=[pipelineId])
+            return
+
+        tomoStepIds = []
+        for tsId in self.getTomoIndexes().values():
+            # Without preprocessing, the steps of a tomogram are the prepare
+            # step, shared by all of them
+            for stepId in self._insertTomoPreprocessSteps(tsId, [prepareId]):
+                if stepId not in tomoStepIds:
+                    tomoStepIds.append(stepId)
+
+        mergeId = self._insertFunctionStep(self.mergeStarFilesStep,
+                                           prerequisites=tomoStepIds)
+        predictIds = self._insertPredictSteps([mergeId])
+        self._insertFunctionStep(self.createOutputStep,
+                                 prerequisites=predictIds)
+
+    def pipelineStep(self, tsIds):
+        """
+        Preprocess (deconvolve and, with the Native backend, normalize) the
+        tomograms in a pool of workers and predict each one as soon as it is
+        ready, on its own GPU if there are several
+        """
+        os.makedirs(self.predictFolder, exist_ok=True)
+        native = self.predictEngine.get() == ENGINE_NATIVE
+        gpuList = self.getGpuList()
+
+        def predictTomo(tsId, result, predictorIndex):
+            if native:
+                self._nativePredict(tsId, normalization=result)
+            else:
+                self._isoNetPredict(self.getTomoStarFile(tsId),
+                                    [gpuList[predictorIndex]])
+
+        stats = runPipeline(tsIds, self._preprocessTomo, predictTomo,
+                            producers=self.pipelineWorkers.get(),
+                            consumers=1 if native else len(gpuList),
+                            depth=self.pipelineDepth.get())
+        self.info("Pipeline: %s" % stats)
+
+    # --------------------------- UTILS functions ----------------------------
+    def getModelPath(self):
+        if self.inputModel.get() is not None:
+            return self.inputModel.get().getFileName()
+        return self.modelFile.get()
+
+    def getNetworkParams(self):
+        if self.inputModel.get() is not None:
+            return self.inputModel.get().getNetworkParams()
+        return {}
+
+    def getCubeSize(self):
+        if self.cube_size.get() is None and self.inputModel.get() is not None:
+            return self.inputModel.get().getCubeSize()
+        return ProtIsoNetBase.getCubeSize(self)
+
+    def getCropSize(self):
+        if self.crop_size.get() is None and self.inputModel.get() is not None:
+            return self.inputModel.get().getCropSize()
+        return ProtIsoNetBase.getCropSize(self)
+
+    def _validate(self):
+        msg = ProtIsoNetBase._validate(self)
+        if self.inputModel.get() is None and not self.modelFile.get():
+            msg.append("A trained model or the path of a model file is needed")
+        elif self.predictEngine.get() == ENGINE_NATIVE and \
+                not os.path.exists(self.getPredictModelPath()):
+            if self.modelPrecision.get() == PRECISION_FLOAT32:
+                msg.append("The model %s was not found"
+                           % self.getPredictModelPath())
+            else:
+                msg.append("The %s model %s was not found, the quantized "
+                           "models are exported by the training run"
+                           % (MODEL_PRECISIONS[self.modelPrecision.get()],
+                              self.getPredictModelPath()))
+        return msg
+
+    # --------------------------- INFO functions -----------------------------------
+    def _summary(self):
+        summary = []
+        if self.hasAttribute('outputTomograms'):
+            summary.append("Predicted tomograms: %d"
+                           % self.outputTomograms.getSize())
+        summary.extend(self._statsSummary())
+        return summary
+
+    def _methods(self):
+        methods = []
+        return methods
@@ -25,23 +25,27 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
-import logging
 import os
-from collections import OrderedDict
 
-import emtable
-from pwem.protocols import EMProtocol
+import numpy as np
 from pyworkflow.constants import BETA
 from pyworkflow.protocol import params
-from pyworkflow.utils import removeBaseExt
 
-from tomo.objects import Tomogram
-from tomo.protocols import ProtTomoBase
 from ..constants import *
+from ..convert import (mergeStarFiles, updateStarFile, parseTrainingLoss,
+                       findLastCheckpoint, findCheckpoints,
+                       getResumedNoiseSchedule, countStarRows, readStarRow)
+from ..autotune import getStepsPerEpoch
+from ..engines.quantize import readReport
+from ..star import StarTable
+from ..objects import IsoNetModel, SetOfIsoNetModels
+from ..sampling import (getSamplingStats, planSubtomograms, getTomoFeatures,
+                        selectRepresentative)
+from .protocol_base import ProtIsoNetBase
 from isonet import Plugin
 
 
-class ProtIsoNetTomoReconstruction(EMProtocol, ProtTomoBase):
+class ProtIsoNetTomoReconstruction(ProtIsoNetBase):
     """
      Isotropic Reconstruction of Electron Tomograms with Deep Learning
     """
@@ -52,53 +56,23 @@ class ProtIsoNetTomoReconstruction(EMProtocol, ProtTomoBase):
     def _defineParams(self, form):
         form.addSection(label='Input')
 
-        form.addParam('inputTomograms', params.PointerParam, pointerClass='SetOfTomograms',
-                      label="Tomograms", important=True,
-                      help='Select the input tomogram for restoring the missing wedge.')
-
-        form.addParam('inputSetOfCtfTomoSeries', params.PointerParam,
-                      allowsNull=True,
-                      label="CTF tomo series",
-                      pointerClass='SetOfCTFTomoSeries',
-                      help='Select the CTF estimation for the set '
-                           'of tilt-series.')
-
-        form.addParam('snrfalloff', params.FloatParam, default=1.0,
-                      condition='inputSetOfCtfTomoSeries is not None',
-                      label="SNR fall rate",
-                      help='SNR fall rate with the frequency. High values means losing more high frequency.'
-                           'If this value is not set, the program will look for the parameter in the star file.'
-                           'If this value is not set and not found in star file, the default value 1.0 will be used.')
-
-        form.addParam('deconvstrength', params.FloatParam, default=1.0,
-                      condition='inputSetOfCtfTomoSeries is not None',
-                      label="Strength of the deconvolution",
-                      help='SNR fall rate with the frequency. High values means losing more high frequency.'
-                           'If this value is not set, the program will look for the parameter in the star file.'
-                           'If this value is not set and not found in star file, the default value 1.0 will be used.')
-
-        form.addParam('highpassnyquist', params.FloatParam, default=0.02,
-                      condition='inputSetOfCtfTomoSeries is not None',
-                      label="Highpass filter",
-                      help='Highpass filter for at very low frequency. We suggest to keep this default value.')
-
-        form.addParam('chunk_size', params.FloatParam, default=None,
-                      condition='inputSetOfCtfTomoSeries is not None',
-                      allowsNull=True,
-                      label="The overlapping rate",
-                      help='The overlapping rate for adjecent chunks.')
-
-        form.addParam('overlap_rate', params.FloatParam, default=None,
-                      condition='inputSetOfCtfTomoSeries is not None',
-                      allowsNull=True,
-                      label="Highpass filter",
-                      help='Highpass filter for at very low frequency. We suggest to keep this default value.')
+        self._defineInputParams(form)
 
         form.addParam('generateMask', params.BooleanParam, default=True,
                       label="Generate mask?",
                       help='Generate a mask that include sample area and exclude "empty" area of the tomogram. '
                            'The masks do not need to be precise. In general, the number of '
                            'subtomograms (a value in star file) should be lesser if you masked out larger area.')
+        form.addParam('maskEngine', params.EnumParam,
+                      choices=ENGINES,
+                      default=ENGINE_ISONET,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      condition="generateMask==%d" % True,
+                      label="Mask backend",
+                      help='IsoNet: run IsoNet make_mask.\n'
+                           'Native: compute the same mask within the plugin '
+                           '(numpy/scipy), without starting the IsoNet '
+                           'environment. Much faster for small tomograms.')
 
         form.addParam('patch_size', params.IntParam, default=4,
                       condition="generateMask==%d" % True,
@@ -129,9 +103,53 @@ class ProtIsoNetTomoReconstruction(EMProtocol, ProtTomoBase):
                       help=' If this value is set, process only the tomograms listed in this index. e.g. 1,2,4 or 5-10,15,16')
 
         form.addSection("Extract subtomograms")
+        form.addParam('trainingTomograms', params.IntParam, default=None,
+                      allowsNull=True,
+                      label="Number of tomograms to train on",
+                      help='If set, only this number of representative '
+                           'tomograms are masked, extracted and used for '
+                           'the training; all of them are predicted. They '
+                           'are chosen to cover the range of defocus, '
+                           'thickness and coverage (fraction of the '
+                           'tomogram with structure) of the whole set, so '
+                           'the cost of the training does not grow with '
+                           'the number of tomograms. By default all the '
+                           'tomograms are used.')
         form.addParam('number_subtomos', params.IntParam, default=100,
                       label="Number of subtomograms to be extracted per tomogram",
-                      help='Number of subtomograms to be extracted')
+                      help='Number of subtomograms to be extracted. With '
+                           'the planned sampling, this is the average number '
+                           'per tomogram.')
+        form.addParam('adaptiveSampling', params.BooleanParam, default=False,
+                      label="Plan the subtomograms from the masks?",
+                      help='Share out the subtomograms (number per tomogram '
+                           'times the number of tomograms) in proportion to '
+                           'the masked volume of every tomogram and its '
+                           'contrast inside the mask, instead of the same '
+                           'number for all of them. Large and dense '
+                           'tomograms get more subtomograms and thin ones do '
+                           'not yield many nearly empty cubes. Without mask, '
+                           'the whole tomograms are used.')
+        form.addParam('subtomoSpacing', params.IntParam, default=None,
+                      allowsNull=True,
+                      condition='adaptiveSampling',
+                      label="Minimum distance between subtomograms (voxels)",
+                      help='A tomogram gets no more subtomograms than the '
+                           'ones that fit in its mask this far from each '
+                           'other. The Native extraction backend also keeps '
+                           'the centers this far apart. By default the crop '
+                           'size, so the subtomograms do not overlap.')
+        form.addParam('extractEngine', params.EnumParam,
+                      choices=ENGINES,
+                      default=ENGINE_ISONET,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label="Extraction backend",
+                      help='IsoNet: run IsoNet extract.\n'
+                           'Native: sample the centers inside the mask and '
+                           'gather all the subtomograms of a tomogram in one '
+                           'read of the memory mapped tomogram. Both write '
+                           'every subtomogram to its own file, the only '
+                           'input IsoNet refine can read.')
         form.addParam('cube_size', params.IntParam, default=8,
                       allowsNull=True,
                       label="Size of cubes",
@@ -151,10 +169,16 @@ class ProtIsoNetTomoReconstruction(EMProtocol, ProtTomoBase):
 
         form.addParam('pretrained_model', params.PathParam,
                       label="Training model path",
-                      help='A trained neural network model in ".h5" format to start with.')
+                      help='A trained neural network model in ".h5" format to start with. '
+                           'In streaming, this model is used to predict the '
+                           'tomograms as they arrive.')
         form.addParam('iterations', params.IntParam, default=30,
                       label='Number of training iterations',
                       help='Number of training iterations')
+        form.addParam('saveIntermediateModels', params.BooleanParam, default=False,
+                      label='Register intermediate models?',
+                      help='Besides the final model, register as output the '
+                           'models saved at every training iteration.')
 
         form.addParam('epochs', params.IntParam, default=10,
                       label='Number of epoch',
@@ -162,14 +186,33 @@ class ProtIsoNetTomoReconstruction(EMProtocol, ProtTomoBase):
         form.addParam('batch_size', params.IntParam, default=None,
                        label='Batch size',
                        allowsNull=True,
-                       help='Size of the minibatch.If None, batch_size will be '
-                            'the max(2 * number_of_gpu,4). batch_size should be '
-                            'divisible by the number of gpu.')
+                       help='Size of the minibatch. If None, the largest one '
+                            'whose estimated memory fits in the memory per '
+                            'device (Computation tab) is used. batch_size '
+                            'should be divisible by the number of gpu.')
         form.addParam('steps_per_epoch', params.IntParam, default=None,
                        label='Steps per epoch',
                        allowsNull=True,
                        help='Step per epoch. If not defined, the default'
-                            ' value will be min(num_of_subtomograms * 6 / batch_size , 200')
+                            ' value will be min(num_of_subtomograms * 6 / batch_size , 200)'
+                            ' with the number of subtomograms extracted from all'
+                            ' the tomograms.')
+        form.addParam('quantizeModel', params.BooleanParam, default=False,
+                      label='Export quantized models?',
+                      help='After the training, export the model to TFLite '
+                           'graphs with float16 weights and with dynamic and '
+                           'int8 quantization, that the Native prediction '
+                           'backend can use ("Model precision") to predict '
+                           'faster on the CPU. Their accuracy (MSE and '
+                           'correlation with the float32 output) and speed '
+                           'are shown in the summary.')
+        form.addParam('calibrationCubes', params.IntParam, default=32,
+                      condition='quantizeModel',
+                      label='Calibration subtomograms',
+                      help='Number of subtomograms, sampled at random among '
+                           'the extracted ones, used to calibrate the int8 '
+                           'quantization and to measure the accuracy of the '
+                           'exported models.')
 
         form.addSection("Denoise settings")
         form.addParam('noise_level', params.StringParam, default='0.05,0.1,0.15,0.2',
@@ -230,127 +273,135 @@ class ProtIsoNetTomoReconstruction(EMProtocol, ProtTomoBase):
                             'to False, normalize the input to 0 mean and 1 '
                             'standard deviation.')
 
-
-        form.addParallelSection(threads=0, mpi=1)
-        form.addParam(params.GPU_LIST, params.StringParam, default='0',
-                       label='Choose GPU IDs:', validators=[params.NonEmpty],
-                       help='This argument is necessary. By default, the '
-                            'protocol will attempt to launch on GPU 0. You can '
-                            'override the default allocation by providing a '
-                            'list of which GPUs (0,1,2,3, etc) to use. '
-                            'GPU are separated by ",". For example: "0,1,5"')
+        self._defineParallelParams(form)
 
     # --------------------------- STEPS functions ------------------------------
     def _insertAllSteps(self):
-        self.tomoPath = os.path.abspath(self._getExtraPath(TOMOGRAMFOLDER))
-        self.tomoStarFileName = os.path.join(self.tomoPath, OUTPUT_TOMO_STAR_FILE)
-        self.maskPath = os.path.abspath(os.path.join(self.tomoPath, MASKFOLDER))
-        self.deconvFolder = os.path.abspath(os.path.join(self.tomoPath, DECONVFOLDER))
-        self.subtomoPath = os.path.abspath(os.path.join(self.tomoPath, SUBTOMOGRAMFOLDER))
-        self.subtomoStarFile = os.path.abspath(os.path.join(self.tomoPath, OUTPUT_SUBTOMO_STAR_FILE))
-        self.resultsFolder = os.path.join(self.tomoPath, RESULTFOLDER)
-        self.predictFolder = os.path.join(self.tomoPath, PREDICTEDFOLDER)
-
-        self._insertFunctionStep(self.prepareProjectStep)
-        if self.inputSetOfCtfTomoSeries.get() is not None:
-            self._insertFunctionStep(self.ctfDeconvolveStep)
-        if self.generateMask.get():
-            self._insertFunctionStep(self.generateMaskStep)
-        self._insertFunctionStep(self.extractSubtomogramsStep)
-        self._insertFunctionStep(self.refineStep)
-        self._insertFunctionStep(self.predictStep)
-        self._insertFunctionStep(self.createOutputStep)
-
-    def prepareProjectStep(self):
+        self._initialize()
+        self.streamingModeOn = self.inputTomograms.get().isStreamOpen()
+
+        if self.streamingModeOn:
+            # Tomograms are predicted with the pretrained model as soon as
+            # they arrive, so there is no extraction nor training
+            self._insertStreamingSteps()
+            return
+
+        prepareId = self._insertFunctionStep(self.prepareProjectStep)
+        tsIds = list(self.getTomoIndexes().values())
+        selecting = self.selectsTrainingTomograms()
+        tomoStepIds = []
+        predictDeps = []
+        if selecting:
+            # The training tomograms are chosen once the features of all of
+            # them are computed. The steps below are inserted for every
+            # tomogram and the ones of the rest are skipped.
+            featureIds = [self._insertFunctionStep(self.computeFeaturesStep,
+                                                   tsId,
+                                                   prerequisites=[prepareId])
+                          for tsId in tsIds]
+            selectId = self._insertFunctionStep(
+                self.selectTrainingTomogramsStep, tsIds,
+                self.trainingTomograms.get(), self._getDefocusModeName(),
+                prerequisites=featureIds)
+            if self.inputSetOfCtfTomoSeries.get() is not None:
+                # The rest of the tomograms are only deconvolved to be
+                # predicted, along with the training
+                predictDeps = [
+                    self._insertFunctionStep(self.deconvolvePredictTomoStep,
+                                             tsId, prerequisites=[selectId])
+                    for tsId in tsIds]
+        # Every training tomogram is deconvolved, masked and extracted in
+        # its own chain of steps, so the chains can run concurrently
+        tomoDeps = {}
+        for tsId in tsIds:
+            if selecting:
+                deps = [selectId]
+                if self.inputSetOfCtfTomoSeries.get() is not None:
+                    deps = [self._insertFunctionStep(
+                        self.deconvolveTrainingTomoStep, tsId,
+                        prerequisites=deps)]
+            else:
+                deps = self._insertTomoPreprocessSteps(tsId, [prepareId])
+            if self.useMask():
+                deps = [self._insertFunctionStep(self.generateMaskStep, tsId,
+                                                 prerequisites=deps)]
+            tomoDeps[tsId] = deps
+        if self.adaptiveSampling.get():
+            # The number of subtomograms of every tomogram depends on all
+            # the masks
+            planId = self._insertFunctionStep(
+                self.planSubtomogramsStep,
+                prerequisites=sum(tomoDeps.values(), []))
+            tomoDeps = {tsId: [planId] for tsId in tomoDeps}
+        for tsId, deps in tomoDeps.items():
+            tomoStepIds.append(self._insertFunctionStep(self.extractSubtomogramsStep,
+                                                        tsId, prerequisites=deps))
+
+        mergeId = self._insertFunctionStep(self.mergeStarFilesStep,
+                                           prerequisites=tomoStepIds)
+        refineId = self._insertFunctionStep(self.refineStep,
+                                            prerequisites=[mergeId])
+        if self.quantizeModel.get():
+            refineId = self._insertFunctionStep(self.quantizeStep,
+                                                prerequisites=[refineId])
+        modelId = self._insertFunctionStep(self.createModelOutputStep,
+                                           prerequisites=[refineId])
+        predictIds = self._insertPredictSteps([modelId] + predictDeps)
+        self._insertFunctionStep(self.createOutputStep,
+                                 prerequisites=predictIds)
+
+    def computeFeaturesStep(self, tsId):
         """
-        Generates a subtomo star file from a set of subtomogram (.mrc)
+        Compute the features of a tomogram used to choose the training
+        tomograms (see getTomoFeatures)
         """
-        if not os.path.exists(self.tomoPath):
-            os.mkdir(self.tomoPath)
-        for tomo in self.inputTomograms.get():
-            tomofn = os.path.abspath(tomo.getFileName())
-            tomoName = tomo.getTsId()
-            tomoLnName = os.path.join(self.tomoPath, tomoName + '.mrc')
-            if not os.path.exists(tomoLnName):
-                os.link(tomofn, tomoLnName)
-
-        pixel_size = self.inputTomograms.get().getSamplingRate()
-
-        args = '%s --output_star %s --pixel_size %f --defocus %f --number_subtomos %d' \
-               %(self.tomoPath, self.tomoStarFileName, pixel_size, 0.0,
-                 self.number_subtomos.get())
-
-        Plugin.runIsoNet(self, Plugin.getProgram(PROGRAM_PREPARE_STAR), args=args)
+        os.makedirs(self.featuresFolder, exist_ok=True)
+        thickness, coverage = getTomoFeatures(self.getTomoFile(tsId))
+        StarTable(dict(rlnTomoName=[tsId], rlnTomoThickness=[thickness],
+                       rlnTomoCoverage=[coverage])).write(
+            self.getFeaturesFile(tsId))
 
-    def ctfDeconvolveStep(self):
+    def selectTrainingTomogramsStep(self, tsIds, number, defocusMode):
+        """
+        Choose the representative tomograms the network is trained on (see
+        selectRepresentative) and write them with the features of all the
+        tomograms. The candidates and the parameters the choice depends on
+        are the arguments of the step, so it is run again if they change.
+        """
+        features = {}
+        for tsId in tsIds:
+            row = readStarRow(self.getFeaturesFile(tsId))
+            features[tsId] = (row['rlnTomoThickness'], row['rlnTomoCoverage'])
+        columns = dict(rlnIndex=list(self.getTomoIndexes()), rlnTomoName=tsIds)
+        if defocusMode is not None:
+            defocusValues = self.getDefocusValues()
+            features = {tsId: (defocusValues[tsId],) + features[tsId]
+                        for tsId in tsIds}
+            columns['rlnDefocus'] = [defocusValues[tsId] for tsId in tsIds]
+        selected = selectRepresentative(features, number)
+        columns['rlnTomoThickness'] = [features[tsId][-2] for tsId in tsIds]
+        columns['rlnTomoCoverage'] = [features[tsId][-1] for tsId in tsIds]
+        columns['rlnTrainingTomo'] = [int(tsId in selected) for tsId in tsIds]
+        StarTable(columns).write(self.getTrainingTomoStarFile())
+        self.info("Training on %d of %d tomograms: %s"
+                  % (len(selected), len(tsIds), ', '.join(selected)))
+
+    def deconvolveTrainingTomoStep(self, tsId):
+        """
+        Deconvolve a tomogram if it is a training one
         """
-        CTF deconvolution for the tomograms.
+        if self.isTrainingTomo(tsId):
+            self.ctfDeconvolveStep(tsId)
 
-        isonet.py deconv star_file [--deconv_folder] [--snrfalloff] [--deconvstrength] [--highpassnyquist] [--overlap_rate] [--ncpu] [--tomo_idx]
-        This step is recommanded because it enhances low resolution information for a better contrast. No need to do deconvolution for phase plate data.
+    def deconvolvePredictTomoStep(self, tsId):
         """
-        if not os.path.exists(self.deconvFolder):
-            os.mkdir(self.deconvFolder)
-        mdFile = emtable.Table(fileName=self.tomoStarFileName, tableName=None)
-        tomoRow = OrderedDict()
-        newStarFile = os.path.abspath(os.path.join(self.tomoPath, OUTPUT_TOMO_DECONV_STAR_FILE))
-        defocusValues = self.getDefocusValues()
-        with open(newStarFile, 'w') as f:
-            # Write particles table
-            f.write("# Star file generated with Scipion\n")
-            f.write("# version 30001\n")
-            # Write header first
-            partsWriter = emtable.Table.Writer(f)
-            partsWriter.writeTableName('particles')
-            partsWriter.writeHeader(mdFile.getColumns())
-            # Write all rows
-            for index, row in enumerate(mdFile.iterRows(fileName=self.tomoStarFileName)):
-                tomoRow['rlnIndex'] = row.get('rlnIndex')
-                tomoRow['rlnMicrographName'] = row.get('rlnMicrographName')
-                tomoRow['rlnPixelSize'] = row.get('rlnPixelSize')
-                tomoName = removeBaseExt(tomoRow['rlnMicrographName'])
-                tomoRow['rlnDefocus'] = defocusValues[tomoName]
-                tomoRow['rlnNumberSubtomo'] = row.get('rlnNumberSubtomo')
-                tomoRow['rlnMaskBoundary'] = row.get('rlnMaskBoundary')
-                partsWriter.writeRowValues(tomoRow.values())
-
-        mdFile.write(self.tomoStarFileName)
-        os.system(f'mv {newStarFile} {self.tomoStarFileName}')
-
-        args = '%s --deconv_folder %s --snrfalloff %f --deconvstrength %d --highpassnyquist %f --ncpu %d ' \
-               % (self.tomoStarFileName,
-                  self.deconvFolder,
-                  self.snrfalloff.get(),
-                  self.deconvstrength.get(),
-                  self.highpassnyquist.get(),
-                  self.numberOfMpi.get())
-
-        chunk_size = self.chunk_size.get()
-        if chunk_size is not None:
-            args += '--chunk_size %d ' % chunk_size
-
-        overlap_rate = self.overlap_rate.get()
-        if overlap_rate is not None:
-            args += '--overlap_rate %d ' % overlap_rate
-
-        if self.tomo_idx.get() is not None:
-            args += ' --tomo_idx %s' % self.tomo_idx.get()
-
-        Plugin.runIsoNet(self, Plugin.getProgram(PROGRAM_CTF_DECONV), args=args)
-
-    def getDefocusValues(self):
-        defocusValues = dict()
-        setOfCtfTomoSeries = self.inputSetOfCtfTomoSeries.get()
-        half = 0
-        for tiltSerie in setOfCtfTomoSeries.getSetOfTiltSeries().getFirstItem():
-            half += 1
-            if tiltSerie.getTiltAngle() == 0:
-                break
-        for ctfTomoSerie in setOfCtfTomoSeries.iterItems():
-                defocusValues[ctfTomoSerie.getTsId()] = ctfTomoSerie[half].getDefocusU()
-        return defocusValues
-
-    def generateMaskStep(self):
+        Deconvolve a tomogram that is only predicted (the training ones are
+        deconvolved before the training)
+        """
+        if not self.isTrainingTomo(tsId):
+            self.ctfDeconvolveStep(tsId)
+
+    def generateMaskStep(self, tsId):
         """
         Generate a mask that include sample area and exclude empty area of
         the tomogram. The masks do not need to be precise. In general,
@@ -359,80 +410,186 @@ class ProtIsoNetTomoReconstruction(EMProtocol, ProtTomoBase):
         "make_mask star_file [--mask_folder] [--patch_size] [--density_percentage] [--std_percentage] [--use_deconv_tomo] [--tomo_idx]"
         """
 
+        if not self.isTrainingTomo(tsId):
+            return
+
         if not os.path.exists(self.maskPath):
-            os.mkdir(self.maskPath)
-        args = '%s --mask_folder %s --patch_size %d --density_percentage %d --std_percentage %d --z_crop %f' \
-               % (self.tomoStarFileName, self.maskPath,
+            os.makedirs(self.maskPath, exist_ok=True)
+
+        if self.useCache.get():
+            cacheKey = self._getMaskCacheKey(tsId)
+            if Plugin.getCache().fetch(cacheKey, self.getMaskFile(tsId)):
+                updateStarFile(self.getTomoStarFile(tsId),
+                               rlnMaskName=self.getMaskFile(tsId))
+                return
+
+        if self.maskEngine.get() == ENGINE_NATIVE:
+            self._generateNativeMask(tsId)
+        else:
+            args = '%s --mask_folder %s --patch_size %d --density_percentage %d --std_percentage %d --z_crop %f' \
+                   % (self.getTomoStarFile(tsId), self.maskPath,
+                      self.patch_size.get(),
+                      self.density_percentage.get(),
+                      self.std_percentage.get(),
+                      self.z_crop.get())
+
+            if self.inputSetOfCtfTomoSeries.get() is not None:
+                args += ' --use_deconv_tomo True'
+
+            Plugin.runIsoNet(self, Plugin.getProgram(PROGRAM_GENERATE_MASK),
+                             args=args)
+
+        if self.useCache.get():
+            Plugin.getCache().store(cacheKey, self.getMaskFile(tsId))
+
+    def _generateNativeMask(self, tsId):
+        """ Compute the mask with the native engine and register it in the
+        tomogram star file, as make_mask does """
+        if self.inputSetOfCtfTomoSeries.get() is not None:
+            tomoFile = self.getDeconvFile(tsId)
+        else:
+            tomoFile = self.getTomoFile(tsId)
+
+        args = '%s %s --patch_size %d --density_percentage %d ' \
+               '--std_percentage %d --z_crop %f' \
+               % (tomoFile, self.getMaskFile(tsId),
                   self.patch_size.get(),
                   self.density_percentage.get(),
                   self.std_percentage.get(),
                   self.z_crop.get())
+        Plugin.runEngine(self, ENGINE_MASK, args)
+        updateStarFile(self.getTomoStarFile(tsId),
+                       rlnMaskName=self.getMaskFile(tsId))
 
-        if self.inputSetOfCtfTomoSeries.get() is not None:
-            args += ' --use_deconv_tomo True'
-
-        if self.tomo_idx.get() is not None:
-            args += ' --tomo_idx %s' % self.tomo_idx.get()
-
-        Plugin.runIsoNet(self, Plugin.getProgram(PROGRAM_GENERATE_MASK),
-                         args=args)
-
-    def extractSubtomogramsStep(self):
+    def planSubtomogramsStep(self):
+        """
+        Set the number of subtomograms of every tomogram (rlnNumberSubtomo
+        of its star file) from the statistics of its mask
+        """
+        tsIds = self.getTrainingTsIds()
+        stats = {tsId: getSamplingStats(self._getExtractTomoFile(tsId),
+                                        self.getMaskFile(tsId)
+                                        if self.useMask() else None)
+                 for tsId in tsIds}
+        counts = planSubtomograms(stats, self.getNumberSubtomos() * len(tsIds),
+                                  self.getSubtomoSpacing())
+        for tsId in tsIds:
+            updateStarFile(self.getTomoStarFile(tsId),
+                           rlnNumberSubtomo=counts[tsId])
+            self.info("%s: %d subtomograms (%d masked voxels, contrast %0.2f)"
+                      % (tsId, counts[tsId], stats[tsId][0], stats[tsId][1]))
+
+    def extractSubtomogramsStep(self, tsId):
         """
         Extract subtomograms
         extract star_file [--subtomo_folder] [--subtomo_star] [--cube_size] [--use_deconv_tomo] [--crop_size] [--tomo_idx]
         """
+        if not self.isTrainingTomo(tsId):
+            return
+
         if not os.path.exists(self.subtomoPath):
-            os.mkdir(self.subtomoPath)
-        args = '%s --subtomo_folder %s --subtomo_star %s ' \
-               % (self.tomoStarFileName, self.subtomoPath, self.subtomoStarFile)
+            os.makedirs(self.subtomoPath, exist_ok=True)
 
-        cube_size = self.cube_size.get()
-        if cube_size is None:
-            cube_size = 8
-            logging.info("Setting cube_size parameter to %d" % cube_size)
-        args += '--cube_size %d ' % cube_size
+        if self.extractEngine.get() == ENGINE_NATIVE:
+            self._nativeExtract(tsId)
+            return
 
+        # IsoNet removes the subtomo folder before extracting, so every
+        # tomogram needs its own one
+        args = '%s --subtomo_folder %s --subtomo_star %s ' \
+               % (self.getTomoStarFile(tsId),
+                  self.getSubtomoFolder(tsId),
+                  self.getSubtomoStarFile(tsId))
 
-        crop_size = self.crop_size.get()
-        if crop_size is None:
-            crop_size = cube_size + 16
-            logging.info("Setting crop_size parameter to %d" % crop_size)
-        args += '--crop_size %d ' % crop_size
+        args += '--cube_size %d ' % self.getCubeSize()
+        args += '--crop_size %d ' % self.getCropSize()
 
 
         if self.inputSetOfCtfTomoSeries.get() is not None:
             args += ' --use_deconv_tomo True '
 
-        if self.tomo_idx.get() is not None:
-            args += ' --tomo_idx %s' % self.tomo_idx.get()
-
         Plugin.runIsoNet(self, Plugin.getProgram(PROGRAM_EXTRACT_SUBTOMOGRAMS),
                          args=args)
 
+    def _nativeExtract(self, tsId):
+        """ Extract the subtomograms of a tomogram with the native engine,
+        a file per subtomogram as IsoNet refine reads them """
+        # The number of the tomogram star file, it can be planned
+        tomoRow = readStarRow(self.getTomoStarFile(tsId))
+        numberSubtomos = tomoRow['rlnNumberSubtomo']
+        args = '%s %s %s --number_subtomos %d --cube_size %d --crop_size %d ' \
+               '--pixel_size %f ' \
+               % (self._getExtractTomoFile(tsId), self.getSubtomoFolder(tsId),
+                  self.getSubtomoStarFile(tsId),
+                  numberSubtomos,
+                  self.getCubeSize(),
+                  self.getCropSize(),
+                  self.inputTomograms.get().getSamplingRate())
+        if self.useMask():
+            args += '--mask_file %s ' % self.getMaskFile(tsId)
+        if self.adaptiveSampling.get():
+            args += '--min_distance %d ' % self.getSubtomoSpacing()
+
+        Plugin.runEngine(self, ENGINE_EXTRACT, args)
+
+    def mergeStarFilesStep(self):
+        """
+        Join the tomogram and subtomogram star files generated for every
+        tomogram, so refine and predict see the whole set
+        """
+        ProtIsoNetBase.mergeStarFilesStep(self)
+        subtomoStarFiles = [self.getSubtomoStarFile(tsId)
+                            for tsId in self.getTrainingTsIds()]
+        mergeStarFiles(subtomoStarFiles, self.subtomoStarFile)
+
     def refineStep(self):
         """
         Train neural network to correct missing wedge
 
         isonet.py refine subtomo_star [--iterations] [--gpuID] [--preprocessing_ncpus] [--batch_size] [--steps_per_epoch] [--noise_start_iter] [--noise_level]...
+
+        If the step is run again after failing, the refinement is resumed
+        from the last complete iteration: its model is the pretrained model
+        of the remaining iterations, that are written to a resume folder
         """
+        iterations = self.iterations.get()
+        noiseLevel = self.noise_level.get()
+        noiseStartIter = self.noise_start_iter.get()
+        pretrained_model = self.pretrained_model.get()
+        resultDir = self.resultsFolder
+
+        doneIterations, lastModel = findLastCheckpoint(self.resultsFolder)
+        if doneIterations >= iterations:
+            self.info("All the %d iterations are already done" % iterations)
+            self._gatherCheckpoints()
+            return
+        if doneIterations:
+            self.info("Resuming the refinement from iteration %d (%s)"
+                      % (doneIterations, lastModel))
+            iterations -= doneIterations
+            noiseLevel, noiseStartIter = getResumedNoiseSchedule(
+                noiseLevel, noiseStartIter, doneIterations)
+            pretrained_model = lastModel
+            resultDir = os.path.join(self.resultsFolder,
+                                     RESUMEFOLDER % doneIterations)
+
         args = '%s --iterations %d --epochs %d --gpuID %s --preprocessing_ncpus %d --noise_level %s ' \
                '--noise_start_iter %s --drop_out %f --learning_rate %f ' \
                '--convs_per_depth %d --unet_depth %d --filter_base %d --kernel %s --result_dir %s ' \
                % (self.subtomoStarFile,
-                  self.iterations.get(),
+                  iterations,
                   self.epochs.get(),
                   str(self.getGpuList())[1:-1].replace(' ', ''),
                   self.numberOfMpi.get(),
-                  self.noise_level.get(),
-                  self.noise_start_iter.get(),
+                  noiseLevel,
+                  noiseStartIter,
                   self.drop_out.get(),
                   self.learning_rate.get(),
                   self.convs_per_depth.get(),
                   self.unet_depth.get(),
                   self.filter_base.get(),
                   self.kernel.get(),
-                  self.resultsFolder)
+                  resultDir)
 
         if self.pool.get() is True:
             args += '--pool True '
@@ -447,95 +604,210 @@ class ProtIsoNetTomoReconstruction(EMProtocol, ProtTomoBase):
         if noise_mode != 2:
             args += '--noise_mode %s ' % NOISE_MODE[noise_mode]
 
-        pretrained_model = self.pretrained_model.get()
         if pretrained_model is not None:
             args += '--pretrained_model %s ' % pretrained_model
 
-        batch_size = self.batch_size.get()
-        if batch_size is None:
-            batch_size = max(2*len(self.getGpuList()), 4)
+        batch_size = self.getBatchSize(self.getCubeSize(),
+                                       len(self.getGpuList()), training=True)
         steps_per_epoch = self.steps_per_epoch.get()
 
         if steps_per_epoch is None:
-            steps_per_epoch = min(self.number_subtomos.get() * 6 / batch_size, 200)
+            numberOfSubtomos = countStarRows(self.subtomoStarFile)
+            steps_per_epoch = getStepsPerEpoch(numberOfSubtomos, batch_size)
+            self.info("Steps per epoch set to %d for %d subtomograms"
+                      % (steps_per_epoch, numberOfSubtomos))
 
         args += ' --batch_size %d --steps_per_epoch %d' % (batch_size, steps_per_epoch)
         Plugin.runIsoNet(self, Plugin.getProgram(PROGRAM_REFINE),
                          args=args)
+        self._gatherCheckpoints()
 
-    def predictStep(self):
+    def quantizeStep(self):
         """
-         Predict tomograms using trained model
-        isonet.py predict star_file model [--gpuID] [--output_dir] [--cube_size] [--crop_size] [--batch_size] [--tomo_idx]
+        Export the trained model with float16 weights and dynamic and int8
+        quantization, calibrated on a sample of the subtomograms
         """
-        if not os.path.exists(self.predictFolder):
-            os.mkdir(self.predictFolder)
-        modelName = getTrinedModelName(self.iterations.get())
-        modelPath = os.path.join(self.resultsFolder, modelName)
-        batch_size = self.batch_size.get()
-        if batch_size is None:
-            batch_size = max(2 * len(self.getGpuList()), 4)
-
-        args = '%s %s --gpuID %s --batch_size %d --output_dir %s ' \
-               % (self.tomoStarFileName,
-                  modelPath,
-                  str(self.getGpuList())[1:-1].replace(' ', ''),
-                  batch_size,
-                  self.predictFolder)
-
-        cube_size = self.cube_size.get()
-        if cube_size is None:
-            cube_size = 8
-            logging.info("Setting cube_size parameter to %d" % cube_size)
-        args += '--cube_size %d ' % cube_size
-
-        crop_size = self.crop_size.get()
-        if crop_size is None:
-            crop_size = cube_size + 16
-            logging.info("Setting crop_size parameter to %d" % crop_size)
-        args += '--crop_size %d ' % crop_size
-
-        tomo_idx = self.tomo_idx.get()
-        if tomo_idx is not None:
-            args += '--tomo_idx %s ' % tomo_idx
-
+        imageNames = StarTable.read(self.subtomoStarFile)['rlnImageName']
+        rng = np.random.default_rng(0)
+        sample = rng.choice(len(imageNames),
+                            min(len(imageNames), self.calibrationCubes.get()),
+                            replace=False)
+        cubesFile = self._getExtraPath('calibration_subtomograms.txt')
+        with open(cubesFile, 'w') as f:
+            f.write('\n'.join(imageNames[np.sort(sample)]) + '\n')
+
+        args = '%s %s --threads %d --normalize_percentile %s' \
+               % (self.getTrainedModelFile(), cubesFile,
+                  self.numberOfThreads.get(), self.getNormalizePercentile())
+        Plugin.runIsoNet(self, Plugin.getEngineProgram(ENGINE_QUANTIZE), args)
+
+    def _gatherCheckpoints(self):
+        """ Move the models of the resumed refinements to the results folder
+        with the number of their iteration in the whole refinement """
+        for iteration, modelFile in findCheckpoints(self.resultsFolder).items():
+            targetFile = self.getTrainedModelFile(iteration)
+            if os.path.abspath(modelFile) != targetFile:
+                os.replace(modelFile, targetFile)
+
+    def createModelOutputStep(self):
+        """
+        Register the trained model (and optionally the intermediate ones) as
+        output, so other runs can use it without retraining
+        """
+        loss = parseTrainingLoss(self.getLogPaths()[0])
+        self._defineOutputs(outputModel=self._createModel(self.iterations.get(),
+                                                          loss))
+
+        if self.saveIntermediateModels.get():
+            modelSet = self._createSet(SetOfIsoNetModels, 'models%s.sqlite', '')
+            for iteration in range(1, self.iterations.get() + 1):
+                model = self._createModel(iteration)
+                if os.path.exists(model.getFileName()):
+                    modelSet.append(model)
+            self._defineOutputs(outputModels=modelSet)
+
+    # --------------------------- UTILS functions ----------------------------
+    def getNumberSubtomos(self):
+        return self.number_subtomos.get()
+
+    def useMask(self):
+        return self.generateMask.get()
+
+    def getModelPath(self):
+        """ Return the model used to predict: the trained one or, in
+        streaming, the pretrained one """
+        if self.streamingModeOn:
+            return self.pretrained_model.get()
+        return self.getTrainedModelFile()
+
+    def getTrainedModelFile(self, iteration=None):
+        """ Return the model of the given (by default the last) refine
+        iteration """
+        if iteration is None:
+            iteration = self.iterations.get()
+        return os.path.abspath(self._getExtraPath(TOMOGRAMFOLDER, RESULTFOLDER,
+                                                  getTrinedModelName(iteration)))
+
+    def _createModel(self, iteration, loss=None):
+        model = IsoNetModel(filename=self.getTrainedModelFile(iteration))
+        model.setSamplingRate(self.inputTomograms.get().getSamplingRate())
+        model.setCubeSize(self.getCubeSize())
+        model.setCropSize(self.getCropSize())
+        model.setIteration(iteration)
+        model.setLoss(loss)
+        model.setNetworkParams(self)
+        return model
+
+    def selectsTrainingTomograms(self):
+        """ Whether the network is trained on some representative
+        tomograms instead of all of them """
+        number = self.trainingTomograms.get()
+        return number is not None and number < len(self.getTomoIndexes())
+
+    def getTrainingTsIds(self):
+        """ Return the tomograms the network is trained on: all of them or
+        the representative ones, once selectTrainingTomogramsStep has chosen
+        them """
+        tomoIndexes = self.getTomoIndexes()
+        if not self.selectsTrainingTomograms():
+            return list(tomoIndexes.values())
+        table = StarTable.read(self.getTrainingTomoStarFile())
+        selected = table['rlnIndex'][table['rlnTrainingTomo'] == 1]
+        return [tsId for index, tsId in tomoIndexes.items()
+                if index in selected]
+
+    def isTrainingTomo(self, tsId):
+        return tsId in self.getTrainingTsIds()
+
+    def _getDefocusModeName(self):
+        """ Defocus mode of the CTFs, None without them """
+        if self.inputSetOfCtfTomoSeries.get() is None:
+            return None
+        return DEFOCUS_MODES[self.defocusMode.get()]
+
+    def getTrainingTomoStarFile(self):
+        return os.path.abspath(self._getExtraPath(TRAINING_TOMO_STAR_FILE))
+
+    def getFeaturesFile(self, tsId):
+        return os.path.join(self.featuresFolder, tsId + '.star')
+
+    def getMaskFile(self, tsId):
+        return os.path.join(self.maskPath, tsId + '_mask.mrc')
+
+    def _getMaskCacheKey(self, tsId):
+        """ The mask depends on the volume it is computed from: the
+        deconvolved tomogram (identified by its own key) or the input one """
+        cache = Plugin.getCache()
         if self.inputSetOfCtfTomoSeries.get() is not None:
-            args += '--use_deconv_tomo True'
+            sourceKey = self._getDeconvCacheKey(tsId)
+        else:
+            sourceKey = cache.checksum(self.getTomoFile(tsId))
+        return cache.getKey(sourceKey, PROGRAM_GENERATE_MASK,
+                            ENGINES[self.maskEngine.get()],
+                            self.patch_size.get(),
+                            self.density_percentage.get(),
+                            self.std_percentage.get(),
+                            self.z_crop.get())
+
+    def _getExtractTomoFile(self, tsId):
+        """ Tomogram the subtomograms are extracted from """
+        if self.inputSetOfCtfTomoSeries.get() is not None:
+            return self.getDeconvFile(tsId)
+        return self.getTomoFile(tsId)
 
-        Plugin.runIsoNet(self, Plugin.getProgram(PROGRAM_PREDICT),
-                         args=args)
+    def getSubtomoSpacing(self):
+        if self.subtomoSpacing.get() is None:
+            return self.getCropSize()
+        return self.subtomoSpacing.get()
+
+    def getSubtomoStarFile(self, tsId):
+        return os.path.join(self.subtomoPath, tsId + '.star')
 
-    def createOutputStep(self):
-        samplingRate = self.inputTomograms.get().getSamplingRate()
-        tomoSet = self._createSetOfTomograms()
-        tomoSet.setSamplingRate(samplingRate)
-        tomograms = os.listdir(self.predictFolder)
-
-        for fileName in tomograms:
-            tomo = Tomogram()
-            tomo.setSamplingRate(samplingRate)
-            tomoId = fileName
-            tomo.cleanObjId()
-            tomo.setTsId(tomoId)
-            location = os.path.join(self.predictFolder, fileName)
-            tomo.setLocation(location)
-            tomo.setOrigin()
-            tomoSet.append(tomo)
-
-        self._defineOutputs(outputTomograms=tomoSet)
+    def getSubtomoFolder(self, tsId):
+        return os.path.join(self.subtomoPath, tsId)
 
     def _validate(self):
-        msg =[]
-        cube_size = self.cube_size.get()
-        if cube_size is not None and cube_size % 8 != 0:
-            msg.append("The size of cubes parameter(Extract subtomogram tab) "
-                       "must be a multiple of 8")
+        msg = ProtIsoNetBase._validate(self)
+        if self.modelPrecision.get() != PRECISION_FLOAT32 and \
+                not self.quantizeModel.get() and \
+                not self.inputTomograms.get().isStreamOpen():
+            msg.append("The quantized models have to be exported (Training "
+                       "settings tab) to predict with the %s one"
+                       % MODEL_PRECISIONS[self.modelPrecision.get()])
+        if self.trainingTomograms.get() is not None and \
+                self.trainingTomograms.get() < 1:
+            msg.append("At least one tomogram is needed for the training")
+        if self.inputTomograms.get().isStreamOpen() and \
+                not self.pretrained_model.get():
+            msg.append("The input tomograms are in streaming, a pretrained "
+                       "model (Training settings tab) is needed to predict "
+                       "them as they arrive")
         return msg
 
     # --------------------------- INFO functions -----------------------------------
     def _summary(self):
         """ Summarize what the protocol has done"""
         summary = []
+        report = None
+        if self.hasAttribute('outputModel'):
+            report = readReport(self.getTrainedModelFile())
+        for precision, result in (report or {}).items():
+            if precision != MODEL_PRECISIONS[PRECISION_FLOAT32]:
+                summary.append("%s model: MSE %0.3g, correlation %0.4f, "
+                               "%0.1fx the float32 speed"
+                               % (precision, result['mse'],
+                                  result['correlation'],
+                                  report['float32']['seconds'] /
+                                  max(result['seconds'], 1e-6)))
+        trainingFile = self.getTrainingTomoStarFile()
+        if os.path.exists(trainingFile):
+            table = StarTable.read(trainingFile)
+            selected = table.select(table['rlnTrainingTomo'] == 1)
+            summary.append("Trained on %d of %d tomograms: %s"
+                           % (len(selected), len(table),
+                              ', '.join(str(name) for name in
+                                        selected['rlnTomoName'])))
+        summary.extend(self._statsSummary())
         return summary
 
     def _methods(self):
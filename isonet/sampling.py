@@ -0,0 +1,178 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Number of subtomograms extracted from every tomogram, planned from its mask
+instead of a fixed number per tomogram. The total (number_subtomos per
+tomogram on average) is shared out in proportion to the masked volume of
+every tomogram times its contrast (local variance of the masked region
+relative to the whole tomogram, so empty regions weigh less), and capped by
+the cubes that fit in the mask without getting closer than the minimum
+spacing.
+
+The training can also be restricted to a few representative tomograms,
+chosen to cover the range of their defocus, thickness and coverage (the
+fraction with structure, as the mask would keep) so the cost of the
+training does not grow with the dataset.
+"""
+import mrcfile
+import numpy as np
+
+# Voxels of the binned volumes the statistics are computed on
+MAX_BINNED_VOXELS = 2 ** 21
+SLAB_BLOCKS = 8
+# Planes with a std of the local means this times the one of the flattest
+# plane (taken as the noise level) are inside the sample
+SAMPLE_CONTRAST = 1.5
+# Local means this many noise levels away from the median have structure
+STRUCTURE_SIGMAS = 3
+
+
+def _binnedSlabs(data, factor, binary=False):
+    """ Yield the volume binned by factor (block averages), computed on
+    slabs so only one of them is loaded. A binary volume is binned as 0 and
+    1 (e.g. the fraction of every block inside a mask). """
+    nz, ny, nx = [length // factor for length in data.shape]
+    for z in range(0, nz, SLAB_BLOCKS):
+        blocks = min(SLAB_BLOCKS, nz - z)
+        slab = np.asarray(data[z * factor:(z + blocks) * factor,
+                               :ny * factor, :nx * factor])
+        slab = (slab != 0 if binary else slab).astype(np.float32)
+        yield slab.reshape(blocks, factor, ny, factor, nx,
+                           factor).mean(axis=(1, 3, 5))
+
+
+def getBinFactor(shape, maxVoxels=MAX_BINNED_VOXELS):
+    return max(2, int(np.ceil((np.prod(shape) / maxVoxels) ** (1 / 3))))
+
+
+def getSamplingStats(tomoFile, maskFile=None):
+    """ Return the (masked voxels, contrast) of a tomogram. The contrast is
+    the std of the local means (binned tomogram) inside the mask relative to
+    the one of the whole tomogram. Without mask the whole tomogram is
+    used. """
+    with mrcfile.mmap(tomoFile, mode='r', permissive=True) as mrc:
+        factor = getBinFactor(mrc.data.shape)
+        tomo = np.concatenate(list(_binnedSlabs(mrc.data, factor)))
+    if maskFile is None:
+        return tomo.size * factor ** 3, 1.0
+
+    with mrcfile.mmap(maskFile, mode='r', permissive=True) as mrc:
+        coverage = np.concatenate(list(_binnedSlabs(mrc.data, factor,
+                                                   binary=True)))
+    maskedVoxels = float(coverage.sum()) * factor ** 3
+    inside = coverage > 0.5
+    if inside.sum() < 2:
+        return maskedVoxels, 0.0
+    return maskedVoxels, float(tomo[inside].std() / (tomo.std() + 1e-20))
+
+
+def getCapacity(maskedVoxels, spacing):
+    """ Cubes that fit in the masked volume at the given spacing, at least
+    one if something is masked """
+    if maskedVoxels <= 0:
+        return 0
+    return max(1, int(maskedVoxels // spacing ** 3))
+
+
+def planSubtomograms(stats, total, spacing, minimum=1):
+    """ Share out total subtomograms among the tomograms of a dict {tsId:
+    (masked voxels, contrast)} in proportion to their weight (masked voxels
+    times contrast), with at least minimum per tomogram and at most its
+    capacity. Return a dict {tsId: number}. """
+    capacity = {tsId: getCapacity(voxels, spacing)
+                for tsId, (voxels, _) in stats.items()}
+    weights = {tsId: voxels * contrast
+               for tsId, (voxels, contrast) in stats.items()}
+    counts = {tsId: min(minimum, capacity[tsId]) for tsId in stats}
+    budget = total - sum(counts.values())
+
+    active = [tsId for tsId in stats
+              if counts[tsId] < capacity[tsId] and weights[tsId] > 0]
+    while budget > 0 and active:
+        weightSum = sum(weights[tsId] for tsId in active)
+        shares = {tsId: budget * weights[tsId] / weightSum for tsId in active}
+        full = [tsId for tsId in active
+                if counts[tsId] + shares[tsId] >= capacity[tsId]]
+        if full:
+            # Fill the tomograms that reach their capacity and share the
+            # rest among the others
+            for tsId in full:
+                budget -= capacity[tsId] - counts[tsId]
+                counts[tsId] = capacity[tsId]
+            active = [tsId for tsId in active if tsId not in full]
+            continue
+        # Largest remainder rounding
+        floors = {tsId: int(shares[tsId]) for tsId in active}
+        left = budget - sum(floors.values())
+        for tsId in sorted(active, key=lambda t: floors[t] - shares[t])[:left]:
+            floors[tsId] += 1
+        for tsId in active:
+            counts[tsId] += floors[tsId]
+        budget = 0
+    return counts
+
+
+def getTomoFeatures(tomoFile):
+    """ Return the (thickness, coverage) of a tomogram from its binned
+    volume: the voxels along z of the planes with structure and the
+    fraction of the volume whose local means stand out of the noise. The
+    flattest plane gives the noise level. """
+    with mrcfile.mmap(tomoFile, mode='r', permissive=True) as mrc:
+        factor = getBinFactor(mrc.data.shape)
+        tomo = np.concatenate(list(_binnedSlabs(mrc.data, factor)))
+    planeStd = tomo.std(axis=(1, 2))
+    noise = planeStd.min()
+    thickness = np.count_nonzero(planeStd > SAMPLE_CONTRAST * noise) * factor
+    structure = np.abs(tomo - np.median(tomo)) > STRUCTURE_SIGMAS * noise
+    return float(thickness), float(structure.mean())
+
+
+def selectRepresentative(features, number):
+    """ Choose number tomograms of a dict {tsId: (feature values)} that
+    cover the range of every feature: the most typical one (nearest to the
+    median) first and then, one at a time, the farthest one from the
+    chosen ones. The features are standardized so all of them weigh the
+    same. Return the chosen tsIds in the input order. """
+    tsIds = list(features)
+    if number >= len(tsIds):
+        return tsIds
+    values = np.array([features[tsId] for tsId in tsIds],
+                      dtype=float).reshape(len(tsIds), -1)
+    std = values.std(axis=0)
+    values = (values - values.mean(axis=0)) / np.where(std > 0, std, 1)
+
+    def distancesTo(point):
+        return np.linalg.norm(values - point, axis=1)
+
+    chosen = [int(np.argmin(distancesTo(np.median(values, axis=0))))]
+    distances = distancesTo(values[chosen[0]])
+    while len(chosen) < number:
+        distances[chosen] = -1
+        farthest = int(np.argmax(distances))
+        chosen.append(farthest)
+        distances = np.minimum(distances, distancesTo(values[farthest]))
+    return [tsIds[i] for i in sorted(chosen)]
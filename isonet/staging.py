@@ -0,0 +1,122 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Staging of the volumes (input tomograms and cached deconvolved tomograms
+and masks) into the project without writing them again when possible. The
+methods are tried in order: hard link, reflink (copy on write clone, e.g.
+btrfs or xfs), symbolic link and, as a last resort, a copy. Hard links and
+reflinks only work within the same file system.
+"""
+import fcntl
+import logging
+import os
+import shutil
+import threading
+
+logger = logging.getLogger(__name__)
+
+HARDLINK = 'hardlink'
+REFLINK = 'reflink'
+SYMLINK = 'symlink'
+COPY = 'copy'
+# Returned when the target was already staged from the same source
+STAGED = 'staged'
+
+STAGING_METHODS = (HARDLINK, REFLINK, SYMLINK, COPY)
+# Without sharing the file (links), for sources that can be removed (e.g.
+# cache entries that can be evicted) or that must not change when the
+# target is rewritten in place (e.g. by mrcfile.new_mmap)
+DETACHED_METHODS = (REFLINK, COPY)
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+TMP_SUFFIX = '.staging'
+
+
+def reflink(source, target):
+    """ Clone source into target sharing its blocks (copy on write). Raise
+    OSError if the file system does not support it. """
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(target)
+            raise
+
+
+def copy(source, target):
+    """ Copy the content and the times of source, so the copy is recognized
+    as staged (see isStaged) """
+    shutil.copyfile(source, target)
+    shutil.copystat(source, target)
+
+
+_STAGERS = {HARDLINK: os.link,
+            REFLINK: reflink,
+            SYMLINK: lambda source, target: os.symlink(os.path.realpath(source),
+                                                       target),
+            COPY: copy}
+
+
+def isStaged(source, target):
+    """ Whether target is source (same file through a link) or a copy of it
+    that has not changed since (same size and mtime) """
+    if not os.path.exists(target):
+        return False
+    if os.path.samefile(source, target):
+        return True
+    sourceStat, targetStat = os.stat(source), os.stat(target)
+    return (sourceStat.st_size == targetStat.st_size and
+            sourceStat.st_mtime_ns == targetStat.st_mtime_ns)
+
+
+def stageFile(source, target, methods=STAGING_METHODS):
+    """ Make source available at target with the first of the given methods
+    that works. The target is replaced atomically and it is not touched if
+    it is already staged. Return the method used. """
+    if isStaged(source, target):
+        logger.debug("%s is already staged" % target)
+        return STAGED
+
+    # Unique per thread, concurrent stagings of the same target do not
+    # write on each other
+    tmpTarget = '%s.%d.%d%s' % (target, os.getpid(), threading.get_ident(),
+                                TMP_SUFFIX)
+    for method in methods:
+        if os.path.lexists(tmpTarget):
+            os.remove(tmpTarget)
+        try:
+            _STAGERS[method](source, tmpTarget)
+        except OSError as e:
+            if method == methods[-1]:
+                raise
+            logger.debug("Could not %s %s: %s" % (method, source, e))
+            continue
+        os.replace(tmpTarget, target)
+        logger.info("Staged %s as %s (%s)" % (source, target, method))
+        return method
@@ -0,0 +1,227 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Star files of the tomograms and subtomograms kept by columns in numpy
+arrays, so a column can be updated for all the rows at once. Files are read
+in one go and written atomically (temporary file and os.replace), so a
+concurrent reader never sees a partial file. The format is the one of
+emtable: the type of every column is guessed (int, float or str) and floats
+are written with 6 decimals.
+"""
+import os
+import shlex
+import tempfile
+
+import numpy as np
+
+HEADER = "# Star file generated with Scipion\n# version 30001\n"
+
+
+class StarTable:
+    """ Table (loop) of a star file with a numpy array per column """
+    def __init__(self, columns=None, **values):
+        """ Create a table with the given column names (and no rows) or
+        with the values of a dict {column: values}. Keyword arguments are
+        added as columns too. """
+        self._columns = dict()
+        if isinstance(columns, dict):
+            values = dict(columns, **values)
+        else:
+            for name in columns or []:
+                self._columns[name] = np.empty(0, dtype=object)
+        for name, columnValues in values.items():
+            self[name] = columnValues
+
+    @classmethod
+    def read(cls, fileName, tableName=None):
+        """ Read the given data block (the first one by default) """
+        with open(fileName) as f:
+            lines = f.read().splitlines()
+
+        dataStr = 'data_%s' % (tableName or '')
+        start = next((i for i, line in enumerate(lines)
+                      if line.startswith(dataStr)), None)
+        if start is None:
+            raise Exception("'%s' block was not found in %s"
+                            % (dataStr, fileName))
+
+        names, rows, loop = [], [], False
+        for line in lines[start + 1:]:
+            line = line.strip()
+            if line.startswith('data_'):
+                break
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('loop_'):
+                loop = True
+            elif line.startswith('_') and not (loop and rows):
+                parts = _split(line)
+                names.append(parts[0][1:])
+                if not loop:
+                    # Single row block: label value
+                    rows.append(parts[1] if len(parts) > 1 else '')
+            elif loop:
+                rows.append(line)
+
+        if not loop:
+            return cls({name: _parseColumn([value])
+                        for name, value in zip(names, rows)})
+        return cls({name: _parseColumn(values)
+                    for name, values in zip(names, _splitRows(rows,
+                                                              len(names)))})
+
+    def getColumnNames(self):
+        return list(self._columns)
+
+    def hasColumn(self, name):
+        return name in self._columns
+
+    def __len__(self):
+        return len(next(iter(self._columns.values()), []))
+
+    def __getitem__(self, name):
+        return self._columns[name]
+
+    def __setitem__(self, name, values):
+        """ Set (or add) a column. A single value is set in all the rows. """
+        if np.ndim(values) == 0:
+            values = np.full(len(self), values,
+                             dtype=object if isinstance(values, str) else None)
+        elif len(values) and all(isinstance(v, str) for v in values):
+            values = np.array(values, dtype=object)
+        else:
+            values = np.asarray(values)
+        others = [other for other in self._columns if other != name]
+        if others and len(values) != len(self._columns[others[0]]):
+            raise ValueError("Column %s has %d values, the table has %d rows"
+                             % (name, len(values),
+                                len(self._columns[others[0]])))
+        self._columns[name] = values
+
+    def update(self, **values):
+        """ Set several columns at once (see __setitem__) """
+        for name, columnValues in values.items():
+            self[name] = columnValues
+
+    def getRow(self, index):
+        """ Return a dict {column: value} with the values of a row """
+        return {name: _toPython(values[index])
+                for name, values in self._columns.items()}
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.getRow(index)
+
+    def select(self, rows):
+        """ Return a table with the given rows (indexes or boolean mask) """
+        return StarTable({name: values[rows]
+                          for name, values in self._columns.items()})
+
+    @classmethod
+    def concatenate(cls, tables):
+        """ Join the rows of several tables, with the columns of the first
+        one """
+        tables = list(tables)
+        if not tables:
+            return cls()
+        columns = tables[0].getColumnNames()
+        return cls({name: np.concatenate([t[name] for t in tables])
+                    for name in columns})
+
+    def write(self, fileName, tableName=None):
+        """ Write the table to a temporary file in the same folder and move
+        it to fileName """
+        folder = os.path.dirname(os.path.abspath(fileName))
+        fd, tmpFile = tempfile.mkstemp(dir=folder, suffix='.tmp',
+                                       prefix='.' + os.path.basename(fileName))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                self.writeStar(f, tableName)
+            # mkstemp creates the file only readable by the owner
+            mode = os.stat(fileName).st_mode if os.path.exists(fileName) else 0o644
+            os.chmod(tmpFile, mode & 0o777)
+            os.replace(tmpFile, fileName)
+        except BaseException:
+            if os.path.exists(tmpFile):
+                os.remove(tmpFile)
+            raise
+
+    def writeStar(self, f, tableName=None):
+        """ Write the table to an open file """
+        f.write(HEADER)
+        f.write("\ndata_%s\n\nloop_\n" % (tableName or ''))
+        for name in self._columns:
+            f.write("_%s \n" % name)
+        columns = [_formatColumn(values) for values in self._columns.values()]
+        columns = [np.char.rjust(values, max(map(len, values), default=0) + 1)
+                   for values in columns]
+        for row in zip(*columns):
+            f.write('  '.join(row) + ' \n')
+        f.write('\n')
+
+
+def _split(line):
+    """ Split a line in values, quoted values can have spaces """
+    return shlex.split(line) if '"' in line or "'" in line else line.split()
+
+
+def _splitRows(rows, numberOfColumns):
+    """ Return the values of every column of the given row lines """
+    if not any('"' in row or "'" in row for row in rows):
+        values = ' '.join(rows).split()
+        if len(values) == len(rows) * numberOfColumns:
+            return np.array(values, dtype=object).reshape(
+                len(rows), numberOfColumns).T
+    values = [_split(row) for row in rows]
+    return [[row[i] for row in values] for i in range(numberOfColumns)]
+
+
+def _parseColumn(values):
+    """ Convert the values of a column to int, float or (if they are not
+    numbers) str """
+    values = np.asarray(values, dtype=object)
+    strValues = values.astype(str)
+    for dtype in (np.int64, np.float64):
+        try:
+            return strValues.astype(dtype)
+        except (ValueError, OverflowError):
+            pass
+    return values
+
+
+def _formatColumn(values):
+    kind = values.dtype.kind
+    if kind == 'f':
+        return np.char.mod('%0.6f', values)
+    if kind in 'iub':
+        return np.char.mod('%d', values.astype(np.int64))
+    return np.array(['"%s"' % v if not str(v) or any(c.isspace() for c in str(v))
+                     else str(v) for v in values], dtype=str)
+
+
+def _toPython(value):
+    return value.item() if isinstance(value, np.generic) else value
@@ -0,0 +1,71 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+from pyworkflow.tests import BaseTest
+
+from .. import autotune
+
+GB = 1024 ** 3
+
+
+class TestAutotune(BaseTest):
+    def test_batchFitsMemory(self):
+        for size in [32, 48, 64]:
+            for training in [True, False]:
+                batch = autotune.getBatchSize(12 * GB, size, training=training)
+                sample, fixed = autotune.estimateMemory(size,
+                                                        training=training)
+                self.assertLessEqual(fixed + batch * sample, 12 * GB)
+                # One more sample would not fit
+                if batch < autotune.MAX_BATCH:
+                    self.assertGreater(fixed + (batch + 1) * sample,
+                                       12 * GB * (1 - autotune.RESERVED_FRACTION))
+
+    def test_networkParams(self):
+        small = autotune.getBatchSize(12 * GB, 64, {'filter_base': 32})
+        default = autotune.getBatchSize(12 * GB, 64, {'filter_base': None})
+        deep = autotune.getBatchSize(12 * GB, 64, {'filter_base': 64,
+                                                   'unet_depth': 4})
+        self.assertGreater(small, default)
+        self.assertGreaterEqual(default, deep)
+        self.assertEqual(default, autotune.getBatchSize(12 * GB, 64))
+        # Prediction does not keep the maps for the backward pass
+        self.assertGreater(autotune.getBatchSize(12 * GB, 64, training=False),
+                           default)
+
+    def test_devices(self):
+        self.assertEqual(autotune.getBatchSize(12 * GB, 64, devices=3) % 3, 0)
+        self.assertEqual(autotune.getBatchSize(12 * GB, 64, devices=3),
+                         3 * autotune.getBatchSize(12 * GB, 64))
+        # At least one sample per device, even if it does not fit
+        self.assertEqual(autotune.getBatchSize(GB, 128, devices=2), 2)
+
+    def test_stepsPerEpoch(self):
+        self.assertEqual(autotune.getStepsPerEpoch(100, 4), 150)
+        self.assertEqual(autotune.getStepsPerEpoch(1000, 4), 200)
+        self.assertEqual(autotune.getStepsPerEpoch(1, 8), 1)
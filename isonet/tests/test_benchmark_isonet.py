@@ -0,0 +1,85 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+import json
+import os
+
+import mrcfile
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from ..benchmark import (Benchmark, runBenchmark, findRegressions,
+                         writeSyntheticTomogram)
+
+# Baseline to compare with, e.g. written by python -m isonet.benchmark
+BASELINE_VAR = 'ISONET_BENCHMARK_BASELINE'
+
+
+class TestBenchmark(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_syntheticTomogram(self):
+        fileName = self.getOutputPath('synthetic.mrc')
+        writeSyntheticTomogram(fileName, (40, 32, 24))
+        with mrcfile.open(fileName, permissive=True) as mrc:
+            self.assertEqual(mrc.data.shape, (40, 32, 24))
+            self.assertLess(mrc.data.mean(), 0)  # Some dense particles
+
+    def test_regressions(self):
+        baseline = {'size': [64, 64, 64], 'tomograms': 2,
+                    'stages': {'mask': 1.0, 'star': 0.01}}
+        results = {'size': [64, 64, 64], 'tomograms': 2,
+                   'stages': {'mask': 1.5, 'star': 0.03, 'output': 1.0}}
+        # The star files are 3 times slower but only by 20 ms
+        self.assertEqual(findRegressions(results, baseline, 0.25),
+                         [('mask', 1.0, 1.5)])
+        self.assertEqual(findRegressions(results, baseline, 0.6), [])
+        with self.assertRaises(ValueError):
+            findRegressions(dict(results, tomograms=3), baseline)
+
+    def test_run(self):
+        """ All the stages on small tomograms, compared with the baseline
+        given in ISONET_BENCHMARK_BASELINE (if any) """
+        baselineFile = os.environ.get(BASELINE_VAR)
+        baseline = None
+        size, tomograms = [48, 64, 64], 2
+        if baselineFile:
+            with open(baselineFile) as f:
+                baseline = json.load(f)
+            size, tomograms = baseline['size'], baseline['tomograms']
+
+        results = runBenchmark(self.getOutputPath('benchmark'), size,
+                               tomograms, repeats=1)
+        self.assertEqual(list(results['stages']), Benchmark.STAGES)
+        self.assertFalse(os.path.exists(self.getOutputPath('benchmark',
+                                                           'run00')))
+        if baseline is not None:
+            self.assertEqual(findRegressions(results, baseline), [])
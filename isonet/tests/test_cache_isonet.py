@@ -0,0 +1,106 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import sys
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from ..cache import PreprocessCache, ActivationCache
+
+
+class TestPreprocessCache(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _writeFile(self, name, size):
+        fileName = self.getOutputPath(name)
+        with open(fileName, 'wb') as f:
+            f.write(os.urandom(size))
+        return fileName
+
+    def test_fetchStoreEvict(self):
+        cache = PreprocessCache(self.getOutputPath('preprocess'), 2500)
+        source = self._writeFile('tomo.mrc', 1000)
+        key = cache.getKey(cache.checksum(source), 'deconv', 1.0)
+        target = self.getOutputPath('deconv.mrc')
+        self.assertFalse(cache.fetch(key, target))
+
+        cache.store(key, source)
+        self.assertTrue(cache.fetch(key, target))
+        with open(source, 'rb') as f1, open(target, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+        # Two more entries do not fit, the least recently used is evicted
+        os.utime(os.path.join(cache.path, key + '.mrc'), (0, 0))
+        for i in range(2):
+            other = self._writeFile('other%d.mrc' % i, 1000)
+            cache.store(cache.getKey(cache.checksum(other)), other)
+        self.assertFalse(cache.fetch(key, target))
+
+    def test_rewriteInPlace(self):
+        """ Rewriting a fetched or stored file in place (as mrcfile.new_mmap
+        does) does not change the cache entry """
+        cache = PreprocessCache(self.getOutputPath('rewrite'), 10000)
+        source = self._writeFile('rewrite_tomo.mrc', 1000)
+        with open(source, 'rb') as f:
+            content = f.read()
+        key = cache.getKey(cache.checksum(source), 'mask')
+        cache.store(key, source)
+        target = self.getOutputPath('rewrite_mask.mrc')
+        self.assertTrue(cache.fetch(key, target))
+        for fileName in [source, target]:
+            with open(fileName, 'r+b') as f:
+                f.truncate(0)
+                f.write(b'0' * 1000)
+        with open(os.path.join(cache.path, key + '.mrc'), 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+
+class TestActivationCache(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_resolveOnce(self):
+        cache = ActivationCache(self.getOutputPath('activation'))
+        counter = self.getOutputPath('activations.txt')
+        environ = dict(os.environ, PATH=os.path.dirname(sys.executable) +
+                       os.pathsep + os.environ.get('PATH', ''))
+        activationCmd = 'echo 1 >> %s && export ISONET_TEST_VAR=1' % counter
+
+        for _ in range(3):
+            variables, python = cache.get('testEnv', activationCmd, environ)
+            self.assertEqual(variables, {'ISONET_TEST_VAR': '1'})
+            self.assertTrue(os.path.exists(python))
+        with open(counter) as f:
+            self.assertEqual(len(f.readlines()), 1)
+
+        # Failed activations are not cached
+        self.assertIsNone(cache.get('badEnv', 'false', environ))
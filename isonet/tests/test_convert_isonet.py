@@ -0,0 +1,237 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import sqlite3
+import struct
+
+import mrcfile
+import numpy as np
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from ..constants import RESUMEFOLDER, getTrinedModelName
+from ..convert import (isCompleteModel, findCheckpoints, findLastCheckpoint,
+                       getResumedNoiseSchedule, selectDefocus,
+                       readSetOfSetsColumns, matchCtfTilts,
+                       getMrcDimensions, getTomoIndexes)
+
+
+def _writeModel(fileName, size=1000, truncate=0):
+    """ Fake keras model: HDF5 superblock v0 with the end of file address
+    followed by padding. Truncated models miss their last bytes. """
+    header = b'\x89HDF\r\n\x1a\n' + bytes([0, 0, 0, 0, 0, 8, 8, 0])
+    header += struct.pack('<HHI', 4, 16, 0)
+    header += struct.pack('<QQQQ', 0, 2 ** 64 - 1, size, 2 ** 64 - 1)
+    with open(fileName, 'wb') as f:
+        f.write(header + bytes(size - len(header) - truncate))
+
+
+class TestRefineCheckpoints(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _resultsFolder(self, name, iterations, resumes=None):
+        """ Results of a refinement with the given iterations and, in the
+        resume folders, the iterations of the resumed ones """
+        folder = self.getOutputPath(name)
+        os.makedirs(folder)
+        for iteration in iterations:
+            _writeModel(os.path.join(folder, getTrinedModelName(iteration)))
+        for doneIterations, resumed in (resumes or {}).items():
+            resumeFolder = os.path.join(folder, RESUMEFOLDER % doneIterations)
+            os.makedirs(resumeFolder)
+            for iteration in resumed:
+                _writeModel(os.path.join(resumeFolder,
+                                         getTrinedModelName(iteration)))
+        return folder
+
+    def test_completeModel(self):
+        modelFile = self.getOutputPath('model.h5')
+        _writeModel(modelFile)
+        self.assertTrue(isCompleteModel(modelFile))
+        _writeModel(modelFile, truncate=10)
+        self.assertFalse(isCompleteModel(modelFile))
+        with open(modelFile, 'wb') as f:
+            f.write(b'not a model')
+        self.assertFalse(isCompleteModel(modelFile))
+        self.assertFalse(isCompleteModel(self.getOutputPath('missing.h5')))
+
+    def test_lastCheckpoint(self):
+        folder = self._resultsFolder('empty', [])
+        self.assertEqual(findLastCheckpoint(folder), (0, None))
+        self.assertEqual(findLastCheckpoint(self.getOutputPath('none')),
+                         (0, None))
+
+        folder = self._resultsFolder('died27', range(1, 28))
+        self.assertEqual(findLastCheckpoint(folder),
+                         (27, os.path.join(folder, 'model_iter27.h5')))
+
+        # The model being saved when the job died is not complete
+        folder = self._resultsFolder('truncated', range(1, 28))
+        _writeModel(os.path.join(folder, 'model_iter28.h5'), truncate=100)
+        self.assertEqual(findLastCheckpoint(folder)[0], 27)
+
+        # Iterations after a gap are not used
+        folder = self._resultsFolder('gap', [1, 2, 3, 5])
+        self.assertEqual(findLastCheckpoint(folder)[0], 3)
+
+        # A refinement resumed after 20 that died again after 5 more
+        folder = self._resultsFolder('resumed', range(1, 21),
+                                     {20: range(1, 6)})
+        self.assertEqual(findLastCheckpoint(folder),
+                         (25, os.path.join(folder, RESUMEFOLDER % 20,
+                                           'model_iter05.h5')))
+        self.assertEqual(sorted(findCheckpoints(folder)), list(range(1, 26)))
+
+    def test_noiseSchedule(self):
+        levels, starts = '0.05,0.1,0.15,0.2', '11,16,21,26'
+        self.assertEqual(getResumedNoiseSchedule(levels, starts, 0),
+                         (levels, starts))
+        self.assertEqual(getResumedNoiseSchedule(levels, starts, 5),
+                         (levels, '6,11,16,21'))
+        # Iteration 28 goes on with the last level
+        self.assertEqual(getResumedNoiseSchedule(levels, starts, 27),
+                         ('0.2', '1'))
+        # Iteration 18 goes on with 0.1 and then the rest of the levels
+        self.assertEqual(getResumedNoiseSchedule(levels, starts, 17),
+                         ('0.1,0.15,0.2', '1,4,9'))
+
+
+class TestTomoIndexes(BaseTest):
+    def test_fileNameOrder(self):
+        # prepare_star sorts the file names: '-' goes before '.'
+        tsIds = ['a', 'b', 'a-1']
+        self.assertEqual(getTomoIndexes(tsIds), {1: 'a-1', 2: 'a', 3: 'b'})
+        self.assertEqual(getTomoIndexes(tsIds, '2-3'), {2: 'a', 3: 'b'})
+
+
+class TestDefocus(BaseTest):
+    def test_nearestZero(self):
+        # Dose symmetric scheme: 0, 3, -3, 6, -6...
+        tilts = [(0.0, 30000.0, 0), (3.0, 30100.0, 3), (-3.0, 29900.0, 6),
+                 (6.0, 30200.0, 9), (-6.0, 29800.0, 12)]
+        self.assertEqual(selectDefocus(tilts), 30000.0)
+        # Bidirectional scheme without a 0 degrees tilt, stored from -60
+        tilts = [(-60.0 + 3 * i, 25000.0 + i, i) for i in range(41)
+                 if i != 20]
+        self.assertEqual(selectDefocus(tilts), 25019.0)
+
+    def test_doseWeighted(self):
+        tilts = [(0.0, 30000.0, 0), (3.0, 32000.0, 30)]
+        weight = np.exp(-1)
+        self.assertAlmostEqual(selectDefocus(tilts, doseWeighted=True),
+                               (30000.0 + 32000.0 * weight) / (1 + weight))
+        # Without dose information it is the plain average
+        tilts = [(0.0, 30000.0, None), (3.0, 32000.0, None)]
+        self.assertAlmostEqual(selectDefocus(tilts, doseWeighted=True), 31000.0)
+        with self.assertRaises(ValueError):
+            selectDefocus([])
+
+
+def _writeSetOfSets(fileName, sets, labels):
+    """ Write a set of sets as the pyworkflow sqlite mapper does: the sets
+    in Objects and the items of every one in id<setId>_Objects, with the
+    columns of every attribute in the Classes tables. sets is a dict
+    {tsId: [item values]}. """
+    with sqlite3.connect(fileName) as conn:
+        conn.execute("CREATE TABLE Classes (id INTEGER PRIMARY KEY, "
+                     "label_property TEXT, column_name TEXT, class_name TEXT)")
+        conn.execute("INSERT INTO Classes VALUES (1, '_tsId', 'c01', 'String')")
+        conn.execute("CREATE TABLE Objects (id INTEGER PRIMARY KEY, "
+                     "enabled INTEGER, label TEXT, comment TEXT, "
+                     "creation DATE, c01 TEXT)")
+        for setId, (tsId, items) in enumerate(sets.items(), start=1):
+            conn.execute("INSERT INTO Objects VALUES (?, 1, '', '', '', ?)",
+                         (setId, tsId))
+            prefix = 'id%d_' % setId
+            # The columns of the attributes are in a different order in
+            # every set
+            names = ['c%02d' % (i + 1) for i in range(len(labels))]
+            if setId % 2 == 0:
+                names = names[::-1]
+            conn.execute("CREATE TABLE %sClasses (id INTEGER PRIMARY KEY, "
+                         "label_property TEXT, column_name TEXT, "
+                         "class_name TEXT)" % prefix)
+            conn.executemany("INSERT INTO %sClasses (label_property, "
+                             "column_name) VALUES (?, ?)" % prefix,
+                             zip(labels, names))
+            conn.execute("CREATE TABLE %sObjects (id INTEGER PRIMARY KEY, "
+                         "enabled INTEGER, %s)" % (prefix, ', '.join(names)))
+            for itemId, values in enumerate(items, start=1):
+                conn.execute("INSERT INTO %sObjects (id, enabled, %s) "
+                             "VALUES (?, 1, %s)"
+                             % (prefix, ', '.join(names),
+                                ', '.join('?' * len(names))),
+                             (itemId,) + tuple(values))
+
+
+class TestCtfTiltIndex(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_readColumns(self):
+        fileName = self.getOutputPath('tiltseries.sqlite')
+        if os.path.exists(fileName):
+            os.remove(fileName)
+        labels = ['_tiltAngle', '_acquisition._accumDose', '_acqOrder']
+        sets = {'TS_01': [(0.0, 0.0, 1), (3.0, 3.0, 2), (-3.0, 6.0, 3)],
+                'TS_02': [(-3.0, 3.0, 2), (0.0, 0.0, 1)]}
+        _writeSetOfSets(fileName, sets, labels)
+        items = readSetOfSetsColumns(fileName, '_tsId',
+                                     ['_acqOrder', '_tiltAngle', '_index'])
+        self.assertEqual(items['TS_01'], [(1, 0.0, None), (2, 3.0, None),
+                                          (3, -3.0, None)])
+        self.assertEqual(items['TS_02'], [(2, -3.0, None), (1, 0.0, None)])
+
+    def test_match(self):
+        # (tiltAngle, accumDose, acquisitionOrder, index)
+        tilts = [(-3.0, 6.0, 3, 1), (0.0, 0.0, 1, 2), (3.0, 3.0, 2, 3)]
+        # (defocus, acquisitionOrder, index), stored in acquisition order
+        ctfs = [(30000.0, 1, 2), (30100.0, 2, 3), (29900.0, 3, 1)]
+        self.assertEqual(matchCtfTilts(tilts, ctfs),
+                         [(0.0, 30000.0, 0.0), (3.0, 30100.0, 3.0),
+                          (-3.0, 29900.0, 6.0)])
+        # Without acquisition order, by tilt index
+        ctfs = [(30000.0, None, 2), (29900.0, None, 1)]
+        self.assertEqual(matchCtfTilts(tilts, ctfs),
+                         [(0.0, 30000.0, 0.0), (-3.0, 29900.0, 6.0)])
+
+
+class TestMrcHeader(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_dimensions(self):
+        fileName = self.getOutputPath('dims.mrc')
+        with mrcfile.new(fileName, overwrite=True) as mrc:
+            mrc.set_data(np.zeros((30, 20, 10), dtype=np.float32))
+        self.assertEqual(getMrcDimensions(fileName), (10, 20, 30))
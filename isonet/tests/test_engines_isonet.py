@@ -0,0 +1,553 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import emtable
+import mrcfile
+import numpy as np
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from ..convert import splitInShards
+from ..engines import mask, deconv, extract, predict, quantize
+
+try:
+    # Only in the IsoNet environment
+    import tensorflow
+except ImportError:
+    tensorflow = None
+
+
+def _referenceMask(tomoFile, maskFile, side, densityPercentage,
+                   stdPercentage, surface):
+    """ IsoNet make_mask (IsoNet/util/filter.py). skimage resize with
+    anti_aliasing is spelled out with scipy: a gaussian of sigma
+    (factor - 1) / 2 and a linear zoom sampling the voxel centers. """
+    from scipy.ndimage import gaussian_filter, maximum_filter, zoom
+    from scipy.signal import convolve
+
+    with mrcfile.open(tomoFile, permissive=True) as n:
+        tomo = n.data.astype(np.float32)
+    sp = np.array(tomo.shape)
+    sp2 = sp // 2
+    bintomo = zoom(gaussian_filter(tomo, (sp / sp2 - 1) / 2, mode='mirror'),
+                   sp2 / sp, order=1, mode='mirror', grid_mode=True)
+    gauss = gaussian_filter(bintomo, side / 2)
+
+    filtered = np.zeros(gauss.shape).astype(np.float32)
+    maximum_filter(-gauss.astype(np.float32), 2 * side + 1, output=filtered,
+                   mode='reflect')
+    mask1 = filtered > np.percentile(filtered, 100 - densityPercentage)
+
+    eps = 0.001
+    kernel = np.ones((2 * side + 1,) * 3)
+    s = convolve(gauss, kernel, mode="same")
+    s2 = convolve(gauss ** 2, kernel, mode="same")
+    ns = convolve(np.ones(gauss.shape), kernel, mode="same") + eps
+    std = np.sqrt((s2 - s ** 2 / ns) / ns + eps)
+    mask2 = std > np.percentile(std, 100 - stdPercentage)
+
+    outMaskBin = np.multiply(mask1, mask2)
+    outMask = np.zeros(sp)
+    for z in (slice(0, -1, 2), slice(1, None, 2)):
+        for y in (slice(0, -1, 2), slice(1, None, 2)):
+            for x in (slice(0, -1, 2), slice(1, None, 2)):
+                outMask[z, y, x] = outMaskBin
+    outMask = (outMask > 0.5).astype(np.uint8)
+    for i in range(int(surface * sp[0])):
+        outMask[i] = 0
+    for i in range(int((1 - surface) * sp[0]), sp[0]):
+        outMask[i] = 0
+    with mrcfile.new(maskFile, overwrite=True) as n:
+        n.set_data(outMask)
+
+
+class TestMaskEngine(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _writeTomogram(self, shape, seed):
+        """ Noise plus some dark blobs (the sample) in a slab """
+        rng = np.random.default_rng(seed)
+        tomo = rng.normal(size=shape).astype(np.float32)
+        zz, yy, xx = np.indices(shape)
+        for _ in range(20):
+            center = rng.uniform((shape[0] * 0.3, 0, 0),
+                                 (shape[0] * 0.7, shape[1], shape[2]))
+            dist2 = ((zz - center[0]) ** 2 + (yy - center[1]) ** 2 +
+                     (xx - center[2]) ** 2)
+            tomo -= 3 * np.exp(-dist2 / 20.)
+        tomoFile = self.getOutputPath('tomo_%d.mrc' % seed)
+        with mrcfile.new(tomoFile, overwrite=True) as mrc:
+            mrc.set_data(tomo)
+            mrc.voxel_size = 10.
+        return tomoFile
+
+    def _checkMask(self, shape, seed, **kwargs):
+        params = dict(patchSize=4, densityPercentage=50, stdPercentage=50,
+                      zCrop=0.2)
+        params.update(kwargs)
+        tomoFile = self._writeTomogram(shape, seed)
+        maskFile = self.getOutputPath('mask_%d.mrc' % seed)
+        refFile = self.getOutputPath('ref_%d.mrc' % seed)
+        mask.makeMask(tomoFile, maskFile, **params)
+        _referenceMask(tomoFile, refFile, params['patchSize'],
+                       params['densityPercentage'], params['stdPercentage'],
+                       params['zCrop'])
+
+        with mrcfile.open(maskFile) as mrc, mrcfile.open(refFile) as ref:
+            self.assertEqual(mrc.data.shape, ref.data.shape)
+            self.assertEqual(float(mrc.voxel_size.x), 10.)
+            # Both only differ in the voxels right at the percentile
+            # thresholds due to rounding
+            agreement = np.mean(mrc.data == ref.data)
+            self.assertGreater(agreement, 0.999, "Mask differs from IsoNet "
+                                                 "make_mask in %f of the voxels"
+                               % (1 - agreement))
+            self.assertTrue(0 < mrc.data.mean() < 1)
+
+    def test_evenShape(self):
+        self._checkMask((40, 64, 64), 1)
+
+    def test_oddShape(self):
+        self._checkMask((41, 63, 66), 2, patchSize=3, densityPercentage=70,
+                        stdPercentage=40, zCrop=0.1)
+
+    def test_zCrop(self):
+        """ The slices are cropped at full size: int(0.33 * 41) = 13
+        slices, not the 12 of int(0.33 * 20) binned ones """
+        self._checkMask((41, 32, 32), 3, zCrop=0.33)
+
+    def test_stdMask(self):
+        """ Local std with the box cropped at the borders """
+        rng = np.random.default_rng(4)
+        tomo = rng.normal(size=(9, 10, 11)).astype(np.float32)
+        side = 2
+        std = np.empty(tomo.shape)
+        for z, y, x in np.ndindex(tomo.shape):
+            box = tomo[max(0, z - side):z + side + 1,
+                       max(0, y - side):y + side + 1,
+                       max(0, x - side):x + side + 1]
+            std[z, y, x] = np.sqrt(box.var() + mask.EPS)
+        expected = std > np.percentile(std, 70)
+        self.assertGreater(np.mean(mask.stdMask(tomo, side, 30) == expected),
+                           0.999)
+
+    def test_slabs(self):
+        """ Binning in slabs gives the same result as in one go """
+        tomoFile = self._writeTomogram((37, 30, 30), 3)
+        with mrcfile.open(tomoFile) as mrc:
+            np.testing.assert_allclose(mask.binTomogram(mrc.data, slabSize=5),
+                                       mask.binTomogram(mrc.data, slabSize=64),
+                                       rtol=1e-5, atol=1e-6)
+
+
+def _referenceWiener1d(angpix, voltage, cs, defocus, snrfalloff,
+                       deconvstrength, highpassnyquist):
+    """ IsoNet wiener1d and tom_ctf1d (IsoNet/util/deconvolution.py) """
+    data = np.arange(0, 1 + 1 / 2047., 1 / 2047.)
+    highpass = np.minimum(np.ones(data.shape[0]), data / highpassnyquist) * np.pi
+    highpass = 1 - np.cos(highpass)
+    eps = 1e-6
+    snr = np.exp(-data * snrfalloff * 100 / angpix) * \
+        (10 ** (3 * deconvstrength)) * highpass + eps
+
+    length, pixelsize, amplitude = 2048, angpix * 1e-10, 0.07
+    voltage, cs, defocus = voltage * 1e3, cs * 1e-3, -defocus * 1e-6
+    ny = 1 / pixelsize
+    lambda1 = 12.2643247 / np.sqrt(voltage * (1.0 + voltage * 0.978466e-6)) * 1e-10
+    lambda2 = lambda1 * 2
+    points = np.arange(0, length).astype(np.float64) / (2 * length) * ny
+    k2 = points ** 2
+    term1 = lambda1 ** 3 * cs * k2 ** 2
+    w = np.pi / 2 * (term1 + lambda2 * defocus * k2)
+    acurve = np.cos(w) * amplitude
+    pcurve = -np.sqrt(1 - amplitude ** 2) * np.sin(w)
+    ctf = pcurve + acurve
+
+    wiener = ctf / (ctf * ctf + 1 / snr)
+    return data, wiener
+
+
+def _referenceDeconv(vol, angpix, defocus, snrfalloff, deconvstrength,
+                     highpassnyquist, chunkSize, overlap):
+    """ IsoNet deconv with chunks (IsoNet/util/deconvolution.py) """
+    import scipy.fft
+
+    def deconvTomo(vol):
+        data, wiener = _referenceWiener1d(angpix, 300.0, 2.7, defocus,
+                                          snrfalloff, deconvstrength,
+                                          highpassnyquist)
+        s1 = -int(np.shape(vol)[1] / 2)
+        f1 = s1 + np.shape(vol)[1] - 1
+        m1 = np.arange(s1, f1 + 1)
+        s2 = -int(np.shape(vol)[0] / 2)
+        f2 = s2 + np.shape(vol)[0] - 1
+        m2 = np.arange(s2, f2 + 1)
+        s3 = -int(np.shape(vol)[2] / 2)
+        f3 = s3 + np.shape(vol)[2] - 1
+        m3 = np.arange(s3, f3 + 1)
+        x, y, z = np.meshgrid(m1, m2, m3)
+        x = x.astype(np.float32) / np.abs(s1)
+        y = y.astype(np.float32) / np.abs(s2)
+        z = z.astype(np.float32) / np.maximum(1, np.abs(s3))
+        r = np.fft.ifftshift(np.minimum(1, np.sqrt(x ** 2 + y ** 2 + z ** 2)))
+        ramp = np.interp(r, data, wiener).astype(np.float32)
+        result = np.real(scipy.fft.ifftn(scipy.fft.fftn(vol) * ramp))
+        result = result.astype(np.float32)
+        return result / np.std(result) * np.std(vol) + np.average(vol)
+
+    cropSize = int(chunkSize * (1 + overlap))
+    sp = np.array(vol.shape)
+    sideLen = sp // chunkSize + 1
+    padi = int((cropSize - chunkSize) / 2)
+    padSize = (sideLen * chunkSize + padi - sp).astype(int)
+    data = np.pad(vol, ((padi, padSize[0]), (padi, padSize[1]),
+                        (padi, padSize[2])), 'symmetric')
+    new = np.zeros(sideLen * chunkSize, dtype=np.float32)
+    for i in range(sideLen[0]):
+        for j in range(sideLen[1]):
+            for k in range(sideLen[2]):
+                cube = data[i * chunkSize:i * chunkSize + cropSize,
+                            j * chunkSize:j * chunkSize + cropSize,
+                            k * chunkSize:k * chunkSize + cropSize]
+                cube = deconvTomo(cube)
+                new[i * chunkSize:(i + 1) * chunkSize,
+                    j * chunkSize:(j + 1) * chunkSize,
+                    k * chunkSize:(k + 1) * chunkSize] = \
+                    cube[padi:padi + chunkSize, padi:padi + chunkSize,
+                         padi:padi + chunkSize]
+    return new[:sp[0], :sp[1], :sp[2]]
+
+
+class TestDeconvEngine(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_chunks(self):
+        rng = np.random.default_rng(4)
+        vol = rng.normal(size=(30, 52, 47)).astype(np.float32)
+        tomoFile = self.getOutputPath('tomo.mrc')
+        with mrcfile.new(tomoFile, overwrite=True) as mrc:
+            mrc.set_data(vol)
+        outputFile = self.getOutputPath('tomo_deconv.mrc')
+
+        deconv.deconvolve(tomoFile, outputFile, pixelSize=10.0, defocus=3.0,
+                          snrfalloff=1.0, deconvstrength=1.0,
+                          highpassnyquist=0.02, chunkSize=16, overlap=0.25,
+                          threads=3)
+        expected = _referenceDeconv(vol, 10.0, 3.0, 1.0, 1.0, 0.02, 16, 0.25)
+
+        with mrcfile.open(outputFile) as mrc:
+            self.assertEqual(float(mrc.voxel_size.x), 10.)
+            np.testing.assert_allclose(mrc.data, expected, rtol=1e-5,
+                                       atol=1e-5)
+
+    def test_wiener(self):
+        frequencies, wiener = deconv.wiener1d(10.0, 300.0, 2.7, 3.0, 1.0,
+                                              1.0, 0.02)
+        expected = _referenceWiener1d(10.0, 300.0, 2.7, 3.0, 1.0, 1.0, 0.02)
+        np.testing.assert_allclose(frequencies, expected[0])
+        np.testing.assert_allclose(wiener, expected[1], rtol=1e-10)
+        # Underfocus: the filter keeps the contrast of the low frequencies
+        # (dark particles stay dark)
+        self.assertGreater(wiener[1:20].min(), 0)
+
+    def test_memoryBudget(self):
+        memory = 256 * 1024 ** 2
+        chunkSize, threads = deconv.getChunkSize(None, 0.25, memory, 4)
+        cropBytes = int(chunkSize * 1.25) ** 3 * deconv.BYTES_PER_VOXEL
+        self.assertLessEqual(cropBytes * threads, memory)
+        self.assertEqual(threads, 4)
+        # A chunk too big for the budget is reduced
+        chunkSize, threads = deconv.getChunkSize(1000, 0.25, memory, 4)
+        self.assertLess(chunkSize, 1000)
+        self.assertLessEqual(int(chunkSize * 1.25) ** 3 *
+                             deconv.BYTES_PER_VOXEL * threads, memory)
+
+
+class TestExtractEngine(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_extract(self):
+        rng = np.random.default_rng(5)
+        vol = rng.normal(size=(30, 40, 50)).astype(np.float32)
+        maskData = np.zeros(vol.shape, dtype=np.uint8)
+        maskData[10:20, 5:30, 20:45] = 1
+        tomoFile = self.getOutputPath('tomo.mrc')
+        maskFile = self.getOutputPath('mask.mrc')
+        with mrcfile.new(tomoFile, overwrite=True) as mrc:
+            mrc.set_data(vol)
+        with mrcfile.new(maskFile, overwrite=True) as mrc:
+            mrc.set_data(maskData)
+        stackFile = self.getOutputPath('tomo.mrcs')
+        starFile = self.getOutputPath('tomo.star')
+
+        extract.extractSubtomograms(tomoFile, stackFile, starFile, 50, 8, 16,
+                                    5.0, maskFile, seed=1)
+
+        table = emtable.Table(fileName=starFile, tableName=None)
+        self.assertEqual(len(table), 50)
+        with mrcfile.open(stackFile) as stack:
+            self.assertTrue(stack.is_volume_stack())
+            self.assertEqual(stack.data.shape, (50, 16, 16, 16))
+            cubes = stack.data.copy()
+        # Every cube is centered at a position inside the mask
+        seeds = extract.sampleSeeds(vol.shape, 50, 16, maskData,
+                                    np.random.default_rng(1))
+        for row, (z, y, x) in zip(table, seeds):
+            index, fileName = extract.parseImageName(row.get('rlnImageName'))
+            self.assertEqual(fileName, stackFile)
+            self.assertTrue(maskData[z, y, x])
+            np.testing.assert_array_equal(
+                cubes[index], vol[z - 8:z + 8, y - 8:y + 8, x - 8:x + 8])
+
+        # A file per subtomogram, as IsoNet refine reads them
+        folder = self.getOutputPath('TS_01')
+        filesStar = self.getOutputPath('files.star')
+        extract.extractSubtomograms(tomoFile, folder, filesStar, 50, 8, 16,
+                                    5.0, maskFile, seed=1)
+        files = emtable.Table(fileName=filesStar, tableName=None)
+        self.assertEqual(files.getColumnNames(), extract.SUBTOMO_COLUMNS)
+        for i, (row, cube) in enumerate(zip(files, cubes), start=1):
+            fileName = row.get('rlnImageName')
+            self.assertEqual(fileName,
+                             os.path.join(folder, 'TS_01_%06d.mrc' % i))
+            with mrcfile.open(fileName) as mrc:
+                np.testing.assert_array_equal(mrc.data, cube)
+                self.assertEqual(float(mrc.voxel_size.x), 5.)
+
+    def test_seedsWithoutMask(self):
+        seeds = extract.sampleSeeds((20, 30, 40), 500, 10,
+                                    rng=np.random.default_rng(0))
+        self.assertEqual(seeds.shape, (500, 3))
+        self.assertTrue(np.all(seeds >= 5))
+        self.assertTrue(np.all(seeds <= np.array([20, 30, 40]) - 5))
+
+
+class TestPredictEngine(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _predict(self, vol, predictor, cubeSize, cropSize, **kwargs):
+        tomoFile = self.getOutputPath('tomo.mrc')
+        with mrcfile.new(tomoFile, overwrite=True) as mrc:
+            mrc.set_data(vol)
+            mrc.voxel_size = 5.
+        outputFile = self.getOutputPath('tomo_corrected.mrc')
+        predict.predict(tomoFile, outputFile, predictor, cubeSize, cropSize,
+                        **kwargs)
+        self.assertFalse(os.path.exists(outputFile + '.weights'))
+        with mrcfile.open(outputFile) as mrc:
+            self.assertEqual(float(mrc.voxel_size.x), 5.)
+            return mrc.data.copy()
+
+    def test_voxelwisePredictor(self):
+        """ Blending the tiles of a voxelwise model gives the same as
+        predicting the whole tomogram at once """
+        def normalize(x):
+            low, high = np.percentile(x, predict.PERCENTILES)
+            return (x - low) / (high - low + 1e-20)
+
+        rng = np.random.default_rng(6)
+        vol = rng.normal(size=(21, 35, 30)).astype(np.float32)
+        expected = -normalize(np.tanh(normalize(-vol)))
+        for cubeSize, cropSize in [(8, 16), (8, 24), (16, 16)]:
+            result = self._predict(vol, np.tanh, cubeSize, cropSize,
+                                   batchSize=3, threads=2)
+            np.testing.assert_allclose(result, expected, rtol=1e-4,
+                                       atol=1e-4)
+
+    def test_meanStdNormalization(self):
+        """ Without percentile the tomogram and the prediction are
+        normalized to their mean and standard deviation """
+        def normalize(x):
+            return (x - x.mean()) / x.std()
+
+        rng = np.random.default_rng(7)
+        vol = rng.normal(2, 3, size=(21, 35, 30)).astype(np.float32)
+        expected = -normalize(np.tanh(normalize(-vol)))
+        result = self._predict(vol, np.tanh, 8, 16, percentile=False)
+        np.testing.assert_allclose(result, expected, rtol=1e-4, atol=1e-4)
+
+    def test_givenNormalization(self):
+        """ The normalization computed by the pipeline producers is the one
+        the engine would compute """
+        rng = np.random.default_rng(8)
+        vol = rng.normal(size=(21, 35, 30)).astype(np.float32)
+        expected = self._predict(vol, np.tanh, 8, 16)
+        normalization = predict.getNormalization(vol, invert=True)
+        result = self._predict(vol, np.tanh, 8, 16,
+                               normalization=normalization)
+        np.testing.assert_array_equal(result, expected)
+
+    def test_tiles(self):
+        """ Every voxel is predicted by the tiles around it """
+        batches = []
+
+        def predictor(tiles):
+            batches.append(tiles.shape)
+            return tiles
+
+        self._predict(np.ones((20, 20, 20), dtype=np.float32), predictor,
+                      8, 12, batchSize=4, threads=3)
+        self.assertEqual(sum(b[0] for b in batches), 27)
+        self.assertTrue(all(b[1:] == (12, 12, 12) for b in batches))
+        self.assertEqual(predict.getTileStarts((20, 20, 20), 8, 12)[0],
+                         (-2, -2, -2))
+
+        # The ramps of neighbour tiles add up to 1
+        profile = predict.tileWindow(8, 12)[0, 0]
+        profile = profile / profile.max()
+        np.testing.assert_allclose(profile[8:] + profile[:4], 1, rtol=1e-5)
+
+    def test_shards(self):
+        """ Tomograms split in shards predicted concurrently give the same
+        results as predicted one by one """
+        rng = np.random.default_rng(7)
+        tomoFiles = dict()
+        for i, depth in enumerate([10, 30, 12, 25, 8]):
+            tomoFiles['TS_%d' % i] = self.getOutputPath('TS_%d.mrc' % i)
+            with mrcfile.new(tomoFiles['TS_%d' % i], overwrite=True) as mrc:
+                mrc.set_data(rng.normal(size=(depth, 24, 24)).astype(np.float32))
+
+        sizes = {tsId: os.path.getsize(f) for tsId, f in tomoFiles.items()}
+        shards = splitInShards(sizes, 2)
+        self.assertEqual(sorted(sum(shards, [])), sorted(tomoFiles))
+        self.assertEqual(shards, [['TS_0', 'TS_1'], ['TS_2', 'TS_3', 'TS_4']])
+        self.assertEqual(len(splitInShards(sizes, 10)), 5)
+
+        def predictShard(tsIds, folder):
+            for tsId in tsIds:
+                predict.predict(tomoFiles[tsId],
+                                os.path.join(folder, tsId + '_corrected.mrc'),
+                                np.tanh, 8, 16, threads=1)
+
+        shardFolder = self.getOutputPath('shards')
+        serialFolder = self.getOutputPath('serial')
+        os.makedirs(shardFolder, exist_ok=True)
+        os.makedirs(serialFolder, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            list(executor.map(predictShard, shards, [shardFolder] * 2))
+        predictShard(list(tomoFiles), serialFolder)
+
+        self.assertEqual(sorted(os.listdir(shardFolder)),
+                         sorted(os.listdir(serialFolder)))
+        for fileName in os.listdir(serialFolder):
+            with mrcfile.open(os.path.join(shardFolder, fileName)) as shard, \
+                    mrcfile.open(os.path.join(serialFolder, fileName)) as serial:
+                np.testing.assert_array_equal(shard.data, serial.data)
+
+
+class TestQuantizeEngine(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_modelFiles(self):
+        self.assertEqual(quantize.getQuantizedModelFile('/r/model_iter30.h5',
+                                                        'int8'),
+                         '/r/model_iter30_int8.tflite')
+        self.assertEqual(quantize.getQuantizedModelFile('/r/model_iter30.h5',
+                                                        'float32'),
+                         '/r/model_iter30.h5')
+        self.assertIsNone(quantize.readReport(self.getOutputPath('none.h5')))
+
+    def test_calibrationCubes(self):
+        rng = np.random.default_rng(2)
+        cubes = rng.normal(size=(3, 8, 8, 8)).astype(np.float32)
+        stackFile = self.getOutputPath('cubes.mrcs')
+        with mrcfile.new(stackFile, overwrite=True) as mrc:
+            mrc.set_data(cubes)
+        np.testing.assert_array_equal(quantize.readCube('2@' + stackFile),
+                                      cubes[1])
+
+        normalized = quantize.normalizeCube(cubes[0])
+        low, high = np.percentile(normalized, predict.PERCENTILES)
+        self.assertAlmostEqual(low, 0, places=5)
+        self.assertAlmostEqual(high, 1, places=5)
+
+        normalized = quantize.normalizeCube(cubes[0], percentile=False)
+        self.assertAlmostEqual(normalized.mean(), 0, places=5)
+        self.assertAlmostEqual(normalized.std(), 1, places=5)
+
+    def test_compare(self):
+        rng = np.random.default_rng(3)
+        reference = rng.normal(size=(2, 8, 8, 8))
+        same = quantize.compareOutputs(reference, reference)
+        self.assertEqual(same['mse'], 0)
+        self.assertAlmostEqual(same['correlation'], 1)
+        noisy = quantize.compareOutputs(reference, reference +
+                                        rng.normal(0, 0.1, reference.shape))
+        self.assertAlmostEqual(noisy['mse'], 0.01, places=2)
+        self.assertGreater(noisy['correlation'], 0.99)
+
+
+    @unittest.skipIf(tensorflow is None, "tensorflow is not installed")
+    def test_quantize(self):
+        """ Export a tiny UNet-like model with every precision and predict
+        with the exported models """
+        inputs = tensorflow.keras.Input((None, None, None, 1))
+        x = tensorflow.keras.layers.Conv3D(4, 3, padding='same',
+                                           activation='relu')(inputs)
+        outputs = tensorflow.keras.layers.Conv3D(1, 3, padding='same')(x)
+        modelFile = self.getOutputPath('tiny_model.h5')
+        tensorflow.keras.Model(inputs, outputs).save(modelFile)
+
+        rng = np.random.default_rng(3)
+        stackFile = self.getOutputPath('tiny_cubes.mrcs')
+        with mrcfile.new(stackFile, overwrite=True) as mrc:
+            mrc.set_data(rng.normal(size=(4, 8, 8, 8)).astype(np.float32))
+        report = quantize.quantize(modelFile, ['%d@%s' % (i, stackFile)
+                                               for i in range(1, 5)])
+        for precision in quantize.PRECISIONS:
+            self.assertTrue(os.path.exists(report[precision]['file']))
+            self.assertGreater(report[precision]['correlation'], 0.9)
+        self.assertEqual(quantize.readReport(modelFile), report)
+
+
+class TestSpacedSeeds(BaseTest):
+    def test_spacing(self):
+        rng = np.random.default_rng(4)
+        candidates = rng.permutation(
+            extract.sampleSeeds((40, 40, 40), 400, 8, rng=rng))
+        seeds = extract.spaceSeeds(candidates, 30, 8)
+        self.assertLessEqual(len(seeds), 30)
+        self.assertGreater(len(seeds), 5)
+        self.assertTrue(np.all(np.diff(seeds[:, 0]) >= 0))
+        distances = np.abs(seeds[:, None] - seeds[None]).max(axis=2)
+        np.fill_diagonal(distances, 8)
+        self.assertTrue(np.all(distances >= 8))
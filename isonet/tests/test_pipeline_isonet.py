@@ -0,0 +1,87 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+import threading
+import time
+
+from pyworkflow.tests import BaseTest
+
+from ..pipeline import runPipeline
+
+
+class TestPipeline(BaseTest):
+    def test_overlap(self):
+        """ CPU and GPU stand-ins of 50 ms per tomogram: the pipeline takes
+        about the time of one kind of stage, not of both """
+        tsIds = ['TS_%02d' % i for i in range(8)]
+        consumed = []
+        stats = runPipeline(tsIds,
+                            lambda tsId: time.sleep(0.05) or tsId + '_deconv',
+                            lambda tsId, result, gpu:
+                            time.sleep(0.05) or consumed.append(result),
+                            producers=1, consumers=1, depth=2)
+        self.assertEqual(consumed, [tsId + '_deconv' for tsId in tsIds])
+        self.assertLess(stats.makespan, 0.75 * 8 * 0.1)
+        self.assertLessEqual(stats.maxQueued, 2)
+
+    def test_depth(self):
+        """ Fast producers never get more than depth tomograms ahead of
+        the consumer """
+        lock = threading.Lock()
+        pending, maxPending = [0], [0]
+
+        def produce(tsId):
+            with lock:
+                pending[0] += 1
+                maxPending[0] = max(maxPending[0], pending[0])
+
+        def consume(tsId, result, gpu):
+            time.sleep(0.01)
+            with lock:
+                pending[0] -= 1
+
+        runPipeline(range(1, 21), produce, consume, producers=4, depth=3)
+        # The queue plus the item being consumed and one per producer
+        # waiting to be queued
+        self.assertLessEqual(maxPending[0], 3 + 1 + 4)
+
+    def test_consumers(self):
+        gpus = set()
+        runPipeline(range(1, 9), lambda i: i,
+                    lambda i, result, gpu: time.sleep(0.02) or gpus.add(gpu),
+                    producers=2, consumers=2)
+        self.assertEqual(gpus, {0, 1})
+
+    def test_failure(self):
+        def consume(tsId, result, gpu):
+            if tsId == 3:
+                raise RuntimeError("Prediction failed")
+
+        with self.assertRaises(RuntimeError):
+            runPipeline(range(1, 11), lambda i: i, consume, depth=1)
@@ -0,0 +1,112 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+import mrcfile
+import numpy as np
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from ..sampling import (getSamplingStats, getCapacity, planSubtomograms,
+                        getTomoFeatures, selectRepresentative)
+
+
+class TestSamplingPlan(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _writeVolume(self, name, data):
+        fileName = self.getOutputPath(name)
+        with mrcfile.new(fileName, overwrite=True) as mrc:
+            mrc.set_data(data)
+        return fileName
+
+    def test_stats(self):
+        rng = np.random.default_rng(0)
+        tomo = rng.normal(size=(32, 64, 64)).astype(np.float32)
+        # Structure (big local variance) in the masked half
+        structure = rng.normal(0, 3, (8, 8, 16))
+        tomo[:, :32] += structure.repeat(4, 0).repeat(4, 1).repeat(4, 2)
+        mask = np.zeros(tomo.shape, dtype=np.int8)
+        mask[:, :32] = 1
+        tomoFile = self._writeVolume('stats_tomo.mrc', tomo)
+        maskFile = self._writeVolume('stats_mask.mrc', mask)
+
+        voxels, contrast = getSamplingStats(tomoFile, maskFile)
+        self.assertEqual(voxels, mask.sum())
+        self.assertGreater(contrast, 1)
+        self.assertEqual(getSamplingStats(tomoFile), (tomo.size, 1.0))
+
+    def test_plan(self):
+        # tsId: (masked voxels, contrast)
+        stats = {'big': (64000, 1.0), 'dense': (16000, 2.0),
+                 'thin': (2000, 1.0), 'empty': (0, 0.0)}
+        counts = planSubtomograms(stats, 40, spacing=10)
+        # Capacities: 64, 16, 2 and 0
+        self.assertEqual(getCapacity(2000, 10), 2)
+        self.assertEqual(counts['empty'], 0)
+        self.assertEqual(counts['thin'], 2)
+        self.assertEqual(sum(counts.values()), 40)
+        # 38 shared 2:1 after the thin one is full
+        self.assertGreater(counts['big'], counts['dense'])
+        self.assertLessEqual(counts['dense'], 16)
+
+        # Not enough room: every tomogram gets its capacity
+        counts = planSubtomograms(stats, 1000, spacing=10)
+        self.assertEqual(counts, {'big': 64, 'dense': 16, 'thin': 2,
+                                  'empty': 0})
+
+    def test_features(self):
+        rng = np.random.default_rng(1)
+        tomo = rng.normal(size=(64, 64, 64)).astype(np.float32)
+        # A slab of 16 planes with structure in half of it
+        structure = rng.normal(0, 5, (4, 8, 16))
+        tomo[24:40, :32] += structure.repeat(4, 0).repeat(4, 1).repeat(4, 2)
+        thickness, coverage = getTomoFeatures(
+            self._writeVolume('features_tomo.mrc', tomo))
+        self.assertEqual(thickness, 16)
+        self.assertGreater(coverage, 0.02)
+        self.assertLess(coverage, 0.125)
+
+    def test_select(self):
+        # tsId: (defocus, thickness, coverage)
+        features = {'ts_%d' % i: (-20000 - 1000 * i, 100, 0.3)
+                    for i in range(9)}
+        features['thick'] = (-24000, 300, 0.3)
+        selected = selectRepresentative(features, 3)
+        # The typical defocus, the thick one and a defocus extreme
+        self.assertEqual(len(selected), 3)
+        self.assertIn('thick', selected)
+        self.assertIn('ts_4', selected)
+        self.assertTrue({'ts_0', 'ts_8'} & set(selected))
+        self.assertEqual(selected, [t for t in features if t in selected])
+        self.assertEqual(selectRepresentative(features, 20), list(features))
+        # Same features: no tomogram is chosen twice
+        same = {'ts_%d' % i: (1.0,) for i in range(4)}
+        self.assertEqual(len(selectRepresentative(same, 3)), 3)
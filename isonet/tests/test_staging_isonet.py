@@ -0,0 +1,99 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+from unittest import mock
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from .. import staging
+from ..staging import (stageFile, isStaged, HARDLINK, REFLINK, SYMLINK, COPY,
+                       STAGED, DETACHED_METHODS)
+
+
+def _fail(source, target):
+    raise OSError(18, 'Invalid cross-device link')
+
+
+class TestStaging(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _writeFile(self, name, size=1000):
+        fileName = self.getOutputPath(name)
+        with open(fileName, 'wb') as f:
+            f.write(os.urandom(size))
+        return fileName
+
+    def _read(self, fileName):
+        with open(fileName, 'rb') as f:
+            return f.read()
+
+    def test_hardlink(self):
+        source = self._writeFile('tomo_link.mrc')
+        target = self.getOutputPath('staged_link.mrc')
+        self.assertEqual(stageFile(source, target), HARDLINK)
+        self.assertTrue(os.path.samefile(source, target))
+        # Nothing is written again
+        self.assertEqual(stageFile(source, target), STAGED)
+
+    def test_fallback(self):
+        """ Across file systems: symbolic link, or a copy when those are
+        not allowed """
+        source = self._writeFile('tomo_fallback.mrc')
+        target = self.getOutputPath('staged_fallback.mrc')
+        stagers = dict(staging._STAGERS, **{HARDLINK: _fail, REFLINK: _fail})
+        with mock.patch.object(staging, '_STAGERS', stagers):
+            self.assertEqual(stageFile(source, target), SYMLINK)
+            self.assertTrue(os.path.islink(target))
+            self.assertEqual(self._read(source), self._read(target))
+
+            os.remove(target)
+            self.assertEqual(stageFile(source, target, DETACHED_METHODS), COPY)
+            self.assertFalse(os.path.islink(target))
+            self.assertEqual(self._read(source), self._read(target))
+            self.assertTrue(isStaged(source, target))
+            self.assertEqual(stageFile(source, target, DETACHED_METHODS),
+                             STAGED)
+        self.assertFalse(os.path.exists(target + staging.TMP_SUFFIX))
+
+    def test_replaceChanged(self):
+        source = self._writeFile('tomo_changed.mrc')
+        target = self._writeFile('staged_changed.mrc', 500)
+        self.assertFalse(isStaged(source, target))
+        stageFile(source, target)
+        self.assertEqual(self._read(source), self._read(target))
+
+    def test_allFail(self):
+        source = self._writeFile('tomo_fail.mrc')
+        target = self.getOutputPath('staged_fail.mrc')
+        with mock.patch.object(staging, '_STAGERS', {COPY: _fail}):
+            with self.assertRaises(OSError):
+                stageFile(source, target, (COPY,))
+        self.assertFalse(os.path.exists(target))
@@ -0,0 +1,144 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+
+import emtable
+import numpy as np
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from ..star import StarTable, HEADER
+
+TOMO_COLUMNS = ['rlnIndex', 'rlnMicrographName', 'rlnPixelSize',
+                'rlnDefocus', 'rlnNumberSubtomo', 'rlnMaskBoundary']
+
+
+class TestStarTable(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _writeEmtable(self, fileName, columns, rows):
+        table = emtable.Table(columns=columns)
+        for row in rows:
+            table.addRow(*row)
+        with open(fileName, 'w') as f:
+            f.write(HEADER)
+            table.writeStar(f)
+
+    def _assertSameTable(self, starTable, emTable):
+        self.assertEqual(starTable.getColumnNames(), emTable.getColumnNames())
+        self.assertEqual(len(starTable), len(emTable))
+        for row, emRow in zip(starTable, emTable):
+            for column, value in row.items():
+                expected = emRow.get(column)
+                self.assertIsInstance(value, type(expected))
+                if isinstance(expected, float):
+                    self.assertAlmostEqual(value, expected, places=6)
+                else:
+                    self.assertEqual(value, expected)
+
+    def _tomoRows(self, n):
+        return [(i, '/data/tomograms/TS_%03d.mrc' % i, 10.0 + i / 3.,
+                 -31250.5 * i, 100, 'None') for i in range(1, n + 1)]
+
+    def test_readEmtable(self):
+        fileName = self.getOutputPath('tomograms_emtable.star')
+        self._writeEmtable(fileName, TOMO_COLUMNS, self._tomoRows(50))
+        table = StarTable.read(fileName)
+        self._assertSameTable(table, emtable.Table(fileName=fileName,
+                                                   tableName=None))
+        self.assertEqual(table['rlnIndex'].dtype, np.int64)
+        self.assertEqual(table['rlnDefocus'].dtype, np.float64)
+
+    def test_writeEmtable(self):
+        fileName = self.getOutputPath('tomograms_startable.star')
+        rows = self._tomoRows(20)
+        table = StarTable(dict(zip(TOMO_COLUMNS, zip(*rows))))
+        table.write(fileName)
+        self._assertSameTable(table, emtable.Table(fileName=fileName,
+                                                   tableName=None))
+        # Written as emtable does
+        emFile = self.getOutputPath('tomograms_emtable2.star')
+        self._writeEmtable(emFile, TOMO_COLUMNS, rows)
+        self._assertSameTable(StarTable.read(emFile),
+                              emtable.Table(fileName=fileName, tableName=None))
+
+    def test_update(self):
+        fileName = self.getOutputPath('subtomograms.star')
+        columns = ['rlnSubtomoIndex', 'rlnImageName', 'rlnCubeSize',
+                   'rlnCropSize', 'rlnPixelSize']
+        rows = [(i, '%06d@/data/TS_01.mrcs' % i, 64, 96, 10.0)
+                for i in range(1, 2001)]
+        self._writeEmtable(fileName, columns, rows)
+
+        table = StarTable.read(fileName)
+        table['rlnPixelSize'] = table['rlnPixelSize'] * 2
+        table.update(rlnDefocus=25000.0, rlnDeconvTomoName='a long path.mrc')
+        table['rlnImageName'][0] = '/another/much/longer/name.mrc'
+        with self.assertRaises(ValueError):
+            table['rlnCubeSize'] = [1, 2]
+        table.write(fileName)
+        # Only the star file is left in the folder (atomic write)
+        self.assertEqual([f for f in os.listdir(self.getOutputPath())
+                          if f.startswith('.subtomograms')], [])
+
+        emTable = emtable.Table(fileName=fileName, tableName=None)
+        self.assertEqual(emTable.getColumnNames(), columns +
+                         ['rlnDefocus', 'rlnDeconvTomoName'])
+        self.assertEqual(emTable[0].get('rlnImageName'),
+                         '/another/much/longer/name.mrc')
+        self.assertEqual(emTable[0].get('rlnDeconvTomoName'), 'a long path.mrc')
+        self.assertEqual(emTable[1999].get('rlnPixelSize'), 20.0)
+        self.assertEqual(emTable[1999].get('rlnDefocus'), 25000.0)
+        self._assertSameTable(StarTable.read(fileName), emTable)
+
+    def test_selectConcatenate(self):
+        rows = self._tomoRows(6)
+        table = StarTable(dict(zip(TOMO_COLUMNS, zip(*rows))))
+        even = table.select(table['rlnIndex'] % 2 == 0)
+        self.assertEqual(list(even['rlnIndex']), [2, 4, 6])
+        joined = StarTable.concatenate([even, table.select([0])])
+        self.assertEqual(list(joined['rlnIndex']), [2, 4, 6, 1])
+        self.assertEqual(joined.getRow(3)['rlnMicrographName'],
+                         '/data/tomograms/TS_001.mrc')
+
+    def test_blocks(self):
+        fileName = self.getOutputPath('blocks.star')
+        with open(fileName, 'w') as f:
+            f.write("data_general\n\n_rlnTomoName   TS_01\n_rlnVoltage 300\n\n"
+                    "data_particles\n\nloop_\n_rlnIndex #1\n_rlnName #2\n"
+                    "1 'with space'\n2 plain\n")
+        general = StarTable.read(fileName, 'general')
+        self.assertEqual(general.getRow(0), {'rlnTomoName': 'TS_01',
+                                             'rlnVoltage': 300})
+        particles = StarTable.read(fileName, 'particles')
+        self.assertEqual(list(particles['rlnName']), ['with space', 'plain'])
+        with self.assertRaises(Exception):
+            StarTable.read(fileName, 'missing')
@@ -0,0 +1,166 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import io
+import json
+import os
+import socket
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from .. import worker
+
+# Stands for isonet.py: reports the worker that runs it and exits with the
+# requested code
+STUB_ISONET = """
+import os
+import sys
+import time
+
+print('args', ' '.join(sys.argv[1:]))
+print('worker', os.getppid())
+print('env', os.environ.get('ISONET_STUB_VAR'))
+print('cwd', os.getcwd())
+if sys.argv[1] == 'sleep':
+    time.sleep(float(sys.argv[2]))
+elif sys.argv[1] == 'fail':
+    sys.exit(int(sys.argv[2]))
+elif sys.argv[1] == 'crash':
+    raise RuntimeError('stub crashed')
+elif sys.argv[1] == 'burn':
+    data = bytearray(64 * 1024 * 1024)
+    start = time.process_time()
+    while time.process_time() - start < 0.3:
+        pass
+"""
+
+
+class TestIsoNetWorker(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.stub = cls.getOutputPath('isonet_stub.py')
+        with open(cls.stub, 'w') as f:
+            f.write(STUB_ISONET)
+        # Unix socket paths are limited to ~100 characters
+        cls.socketPath = os.path.join(tempfile.gettempdir(),
+                                      'isonet-test-%d.sock' % os.getpid())
+
+    @classmethod
+    def tearDownClass(cls):
+        worker.stop(cls.socketPath)
+        for ext in ['.lock', '.log']:
+            if os.path.exists(cls.socketPath + ext):
+                os.remove(cls.socketPath + ext)
+
+    def _run(self, *args):
+        output = io.BytesIO()
+        code = worker.run(self.socketPath, [self.stub] + list(args),
+                          output=output, preload=[], idleTimeout=60)
+        lines = output.getvalue().decode().splitlines()
+        return code, dict(line.split(' ', 1) for line in lines
+                          if ' ' in line and line.split(' ')[0] in
+                          ['args', 'worker', 'env', 'cwd']), lines
+
+    def test_runCommands(self):
+        os.environ['ISONET_STUB_VAR'] = 'value'
+        try:
+            code, out, _ = self._run('deconv', 'tomograms.star', '--ncpu', '4')
+        finally:
+            del os.environ['ISONET_STUB_VAR']
+        self.assertEqual(code, 0)
+        self.assertEqual(out['args'], 'deconv tomograms.star --ncpu 4')
+        # The command gets the client environment and working dir
+        self.assertEqual(out['env'], 'value')
+        self.assertEqual(out['cwd'], os.getcwd())
+
+        # The same worker runs the following commands
+        code, out2, _ = self._run('extract')
+        self.assertEqual(code, 0)
+        self.assertEqual(out2['worker'], out['worker'])
+        self.assertEqual(out2['env'], 'None')
+
+    def test_exitCodes(self):
+        code, _, _ = self._run('fail', '3')
+        self.assertEqual(code, 3)
+        code, _, lines = self._run('crash')
+        self.assertEqual(code, 1)
+        self.assertIn('RuntimeError: stub crashed', lines)
+
+    def test_concurrentCommands(self):
+        self._run('start')  # Be sure the worker is running
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            results = list(executor.map(lambda _: self._run('sleep', '1'),
+                                        range(3)))
+        self.assertLess(time.time() - start, 2.5)
+        self.assertEqual([r[0] for r in results], [0, 0, 0])
+        self.assertEqual(len({r[1]['worker'] for r in results}), 1)
+
+    def test_usage(self):
+        """ The resources of the forked worker that runs the command are
+        written to the file the monitor asks for """
+        statsFile = self.getOutputPath('worker_usage.json')
+        os.environ[worker.WORKER_STATS_VAR] = statsFile
+        try:
+            code, _, _ = self._run('burn')
+        finally:
+            del os.environ[worker.WORKER_STATS_VAR]
+        self.assertEqual(code, 0)
+        with open(statsFile) as f:
+            usage = json.load(f)
+        self.assertGreaterEqual(usage['cpuTime'], 0.3)
+        self.assertGreater(usage['maxRss'], 64 * 1024 * 1024)
+
+    def test_engineScript(self):
+        """ The engines import their sibling modules, as python does the
+        folder of the script goes first in the path """
+        script = os.path.join(os.path.dirname(worker.WORKER_SCRIPT),
+                              'engines', 'quantize.py')
+        output = io.BytesIO()
+        code = worker.run(self.socketPath, [script, '--help'], output=output,
+                          preload=[], idleTimeout=60)
+        self.assertEqual(code, 0, output.getvalue().decode())
+        self.assertIn(b'usage: quantize.py', output.getvalue())
+
+    def test_stalledClient(self):
+        """ A client that does not send its request does not hold the
+        rest """
+        self._run('start')  # Be sure the worker is running
+        stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stalled.connect(self.socketPath)
+        try:
+            start = time.time()
+            code, _, _ = self._run('extract')
+            self.assertEqual(code, 0)
+            self.assertLess(time.time() - start, 5)
+        finally:
+            stalled.close()
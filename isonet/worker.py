@@ -0,0 +1,311 @@
+# **************************************************************************
+# *
+# * Authors: Yunior C. Fonseca Reyna    (cfonseca@cnb.csic.es)
+# *
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Persistent IsoNet worker. It runs within the IsoNet environment, imports
+the heavy modules (numpy, tensorflow...) once and runs every IsoNet command
+it receives through a local socket in a forked copy of itself, so the
+commands start warm. A worker is shared by all the runs of the same user on
+a node and exits after some idle time.
+
+This file only uses the standard library, it is both the worker and the
+client that protocols launch instead of isonet.py:
+
+    python worker.py serve SOCKET [--preload numpy,tensorflow] [--idle 3600]
+    python worker.py run SOCKET -- /path/isonet.py deconv tomograms.star ...
+    python worker.py stop SOCKET
+
+The client starts the worker if it is not running, streams the command
+output and exits with the command exit code.
+"""
+import argparse
+import fcntl
+import json
+import os
+import resource
+import runpy
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+WORKER_SCRIPT = os.path.abspath(__file__)
+
+# Sent by the worker after the command output
+EXIT_MARK = b'\0ISONET_WORKER_EXIT '
+MAX_TRAILER = 1024
+# Variable with the file where the client writes the resources used by the
+# command (see monitor.py)
+WORKER_STATS_VAR = 'ISONET_WORKER_STATS'
+DEFAULT_PRELOAD = ['numpy', 'scipy', 'mrcfile', 'tensorflow']
+DEFAULT_IDLE = 3600
+START_TIMEOUT = 300
+# Seconds a forked worker waits for the request of its client
+REQUEST_TIMEOUT = 60
+# Exit status of a forked worker that received a stop request
+STOP_STATUS = 3
+
+
+def getSocketPath(name):
+    """ Socket of the worker of the given env for the current user """
+    return os.path.join(tempfile.gettempdir(),
+                        'isonet-worker-%d-%s.sock' % (os.getuid(), name))
+
+
+def getWorkerArgs(socketPath, program, args):
+    """ Arguments to run an IsoNet program through the worker client """
+    return '%s run %s -- %s %s' % (WORKER_SCRIPT, socketPath, program, args)
+
+
+# ------------------------------- Worker ----------------------------------
+def serve(socketPath, preload=DEFAULT_PRELOAD, idleTimeout=DEFAULT_IDLE):
+    """ Accept commands until the worker has been idle for idleTimeout
+    seconds (or a stop request is received). """
+    for module in preload:
+        try:
+            __import__(module)
+        except ImportError:
+            pass
+
+    if os.path.exists(socketPath):
+        os.remove(socketPath)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socketPath)
+    server.listen(64)
+    server.settimeout(1)
+    print("IsoNet worker %d listening on %s" % (os.getpid(), socketPath),
+          flush=True)
+
+    children = set()
+    lastActivity = time.time()
+    stopped = False
+    try:
+        while not stopped:
+            for pid in list(children):
+                pid, status = os.waitpid(pid, os.WNOHANG)
+                if pid:
+                    children.discard(pid)
+                    lastActivity = time.time()
+                    stopped |= (os.WIFEXITED(status) and
+                                os.WEXITSTATUS(status) == STOP_STATUS)
+            if stopped or (not children and
+                           time.time() - lastActivity > idleTimeout):
+                break
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                continue
+            # The request is read by the forked worker, so a client that
+            # does not send it does not hold the rest
+            pid = os.fork()
+            if pid == 0:
+                server.close()
+                _runRequest(conn)
+            children.add(pid)
+            conn.close()
+    finally:
+        server.close()
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+        for pid in children:
+            os.waitpid(pid, 0)
+
+
+def _runRequest(conn):
+    """ Read the request of the client in the forked worker and run its
+    IsoNet command with the output going to the client, then send the exit
+    code and finish. A stop request ends with STOP_STATUS. """
+    code = 1
+    try:
+        conn.settimeout(REQUEST_TIMEOUT)
+        try:
+            request = json.loads(conn.makefile('rb').readline())
+        except (OSError, ValueError):
+            os._exit(1)
+        if request.get('stop'):
+            os._exit(STOP_STATUS)
+        conn.settimeout(None)
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        fd = conn.fileno()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        sys.argv = request['argv']
+        # As python does for a script: its folder goes first in the path
+        sys.path[0] = os.path.dirname(os.path.abspath(sys.argv[0]))
+        try:
+            runpy.run_path(sys.argv[0], run_name='__main__')
+            code = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                code = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+        except BaseException:
+            traceback.print_exc()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        conn.sendall(EXIT_MARK + b'%d %s\n'
+                     % (code, json.dumps(getUsage()).encode()))
+    finally:
+        os._exit(0)
+
+
+def getUsage():
+    """ Resources used by this process (the forked worker that ran a
+    command) and its children, with the fields of the monitor job stats """
+    counters = dict()
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                counters[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    usages = [resource.getrusage(resource.RUSAGE_SELF),
+              resource.getrusage(resource.RUSAGE_CHILDREN)]
+    return {'cpuTime': sum(u.ru_utime + u.ru_stime for u in usages),
+            'maxRss': max(u.ru_maxrss for u in usages) * 1024,
+            'readBytes': counters.get('rchar', 0),
+            'writtenBytes': counters.get('wchar', 0)}
+
+
+# ------------------------------- Client ----------------------------------
+def _connect(socketPath):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socketPath)
+        return conn
+    except OSError:
+        conn.close()
+        return None
+
+
+def connect(socketPath, preload=DEFAULT_PRELOAD, idleTimeout=DEFAULT_IDLE):
+    """ Connect to the worker, starting it with the current python if it is
+    not running. """
+    conn = _connect(socketPath)
+    if conn is not None:
+        return conn
+
+    # Only one client starts the worker
+    with open(socketPath + '.lock', 'w') as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        conn = _connect(socketPath)
+        if conn is None:
+            with open(socketPath + '.log', 'a') as log:
+                subprocess.Popen([sys.executable, WORKER_SCRIPT, 'serve',
+                                  socketPath, '--preload', ','.join(preload),
+                                  '--idle', str(idleTimeout)],
+                                 stdout=log, stderr=subprocess.STDOUT,
+                                 stdin=subprocess.DEVNULL,
+                                 start_new_session=True)
+            deadline = time.time() + START_TIMEOUT
+            while conn is None and time.time() < deadline:
+                time.sleep(0.1)
+                conn = _connect(socketPath)
+        fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    if conn is None:
+        raise Exception("The IsoNet worker did not start, see %s.log"
+                        % socketPath)
+    return conn
+
+
+def run(socketPath, argv, output=None, **kwargs):
+    """ Run a command in the worker writing its output to output (stdout
+    by default). Return the exit code of the command. """
+    output = output or sys.stdout.buffer
+    conn = connect(socketPath, **kwargs)
+    request = {'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)}
+    with conn:
+        conn.sendall(json.dumps(request).encode() + b'\n')
+        # The last bytes received may be the exit mark (and the exit code
+        # and resources after it), keep them until the end of the stream
+        pending = b''
+        keep = len(EXIT_MARK) + MAX_TRAILER
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            pending += data
+            if len(pending) > keep:
+                output.write(pending[:-keep])
+                output.flush()
+                pending = pending[-keep:]
+
+    markPos = pending.rfind(EXIT_MARK)
+    if markPos < 0:
+        output.write(pending)
+        output.flush()
+        # The command died without reporting
+        return 1
+    output.write(pending[:markPos])
+    output.flush()
+    code, _, usage = pending[markPos + len(EXIT_MARK):].strip().partition(b' ')
+    statsFile = os.environ.get(WORKER_STATS_VAR)
+    if usage and statsFile:
+        with open(statsFile, 'wb') as f:
+            f.write(usage)
+    return int(code)
+
+
+def stop(socketPath):
+    """ Ask the worker to finish, if it is running """
+    conn = _connect(socketPath)
+    if conn is not None:
+        with conn:
+            conn.sendall(json.dumps({'stop': True}).encode() + b'\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('action', choices=['serve', 'run', 'stop'])
+    parser.add_argument('socket')
+    parser.add_argument('--preload', default=','.join(DEFAULT_PRELOAD))
+    parser.add_argument('--idle', type=float, default=DEFAULT_IDLE)
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    preload = [m for m in args.preload.split(',') if m]
+
+    if args.action == 'serve':
+        serve(args.socket, preload, args.idle)
+    elif args.action == 'stop':
+        stop(args.socket)
+    else:
+        command = args.command[1:] if args.command[:1] == ['--'] else args.command
+        sys.exit(run(args.socket, command, preload=preload,
+                     idleTimeout=args.idle))
+
+
+if __name__ == '__main__':
+    main()